@@ -23,6 +23,21 @@ class BaseAnalysis:
         out = {**self.interest_parameter_shapes(),**self.fixed_parameter_shapes(),**self.nuisance_parameter_shapes()}
         return out
 
+    def hessian_blocks(self):
+        """Describe the block structure of the Hessian of the log_prob function
+           of this analysis with respect to its (non-fixed) parameters.
+           Returns a list of blocks, each of which is a list of (parameter name, flat
+           element index) pairs. Parameters in different blocks must have zero
+           second derivatives with respect to each other.
+
+           By default all parameters are put into a single block. Analyses whose
+           log_prob separates into independent pieces (e.g. independent signal
+           regions) should override this to expose that structure.
+        """
+        shapes = {**self.interest_parameter_shapes(),**self.nuisance_parameter_shapes()}
+        block = [(par, i) for par,shape in shapes.items() for i in range(c.prod(shape) or 1)]
+        return [block]
+
     def bcast_parameters_samples(self,parameters,samples):
         """Broadcast dictionaries of distribution parameters against samples
            from those distribtuions, following tensorflow_probability rules
@@ -66,6 +66,14 @@ class BinnedAnalysis(BaseAnalysis):
         # for i,sr in enumerate(self.SR_names):
         #     print("   {0}: {1:.1f}".format(sr, np.abs(self.SR_n[i] - self.SR_b[i])/np.sqrt(self.SR_b[i] + self.SR_b_sys[i]**2)))
 
+    def get_spec(self):
+        """Constructor arguments to rebuild this analysis (see parallel.analysis_spec)"""
+        srs = None
+        if self.SR_names is not None:
+            srs = [(sr, self.SR_n[i], self.SR_b[i], self.SR_b_sys[i]) for i,sr in enumerate(self.SR_names)]
+        return {"name": self.name, "srs": srs, "cov": self.cov, "cov_order": self.cov_order,
+                "unlisted_corr_zero": self.unlisted_corr_zero}
+
     def get_cov_order(self):
         cov_order = None
         if self.cov is not None:
@@ -261,23 +269,56 @@ class BinnedAnalysis(BaseAnalysis):
            shape of each entry"""
         return {"theta": (len(self.SR_b),)} # Just one nuisance parameter per signal region, packaged into one 1D tensor. 
 
+    def hessian_blocks(self):
+        """Signal regions are independent except via the correlated nuisance
+           parameters, so the Hessian is 2x2 per uncorrelated signal region
+           (signal and nuisance parameter), plus one block covering all signal
+           regions included in the covariance matrix"""
+        blocks = []
+        if self.cov is not None:
+            blocks += [[("s",i) for i in self.covi] + [("theta",i) for i in self.covi]]
+        for i in range(len(self.SR_names)):
+            if self.cov is None or not self.in_cov[i]:
+                blocks += [[("s",i), ("theta",i)]]
+        return blocks
+
     def get_nuisance_parameters(self,sample_dict,fixed_pars):
         """Get nuisance parameters to be optimized, for input to "tensorflow_model"""
         seeds = self.get_seeds_nuis(sample_dict,fixed_pars) # Get initial guesses for nuisance parameter MLEs
-        stacked_seeds = np.stack([seeds[sr]['theta'] for sr in self.SR_names],axis=-1)
-        free_pars = {"theta": stacked_seeds} 
+        free_pars = {"theta": seeds['theta']} 
         fixed_pars_out = {"s": fixed_pars["s"]} 
         return free_pars, fixed_pars
 
     def get_all_parameters(self,sample_dict,fixed_pars):
         """Get all parameters (signal and nuisance) to be optimized, for input to "tensorflow_model"""
         seeds = self.get_seeds_s_and_nuis(sample_dict) # Get initial guesses for parameter MLEs
-        stacked_theta = np.stack([seeds[sr]['theta'] for sr in self.SR_names],axis=-1)
-        stacked_s     = np.stack([seeds[sr]['s'] for sr in self.SR_names],axis=-1)
-        free_pars = {"s": stacked_s, "theta": stacked_theta}
+        free_pars = {"s": seeds['s'], "theta": seeds['theta']}
         fixed_pars = {}
         return free_pars, fixed_pars
         
+    def profiled_neg2logL(self,samples,fixed_pars,nuisance_only=True):
+        """Closed-form -2*log-likelihood, evaluated at the exact MLEs of the free
+           parameters ('theta' for nuisance-only fits; 's' and 'theta' otherwise).
+           Allows fits to skip numerical optimisation and the generic log_prob entirely.
+           Only available when there is no covariance matrix (i.e. if exact_MLEs is True).
+           Returns -2logL along with the (non-scaled) free and fixed parameter
+           dictionaries, as for get_nuisance_parameters/get_all_parameters.
+        """
+        if not self.exact_MLEs:
+            msg = "Closed-form profiled -2logL is not available for BinnedAnalysis '{0}', since it has a covariance matrix (MLEs are not known exactly)".format(self.name)
+            raise ValueError(msg)
+        if nuisance_only:
+            free_pars, fixed_pars_out = self.get_nuisance_parameters(samples,fixed_pars)
+        else:
+            free_pars, fixed_pars_out = self.get_all_parameters(samples,fixed_pars)
+        pars = c.convert_to_TF_constants({**fixed_pars_out, **free_pars})
+        b = tf.constant(self.SR_b,dtype=c.TFdtype)
+        bsys = tf.constant(self.SR_b_sys,dtype=c.TFdtype)
+        rate = tf.abs(pars['s']+b+pars['theta'])+c.reallysmall # As in tensorflow_model
+        q = tf.math.reduce_sum(c.poisson_neg2logL(samples["n"],rate) 
+                             + c.normal_neg2logL(samples["x"],pars['theta'],bsys), axis=-1)
+        return q, free_pars, fixed_pars_out
+
     def as_dict_short_form(self):
         """Add contents to dictionary, ready for dumping to YAML file
            Compact format version"""
@@ -323,308 +364,124 @@ class BinnedAnalysis(BaseAnalysis):
             df.loc[data[0]] = data[1:]
         return df
 
+    def get_x_samples(self,samples):
+        """Extract the control measurement samples, as a single tensor
+           with the SR dimension (last axis) in the same order as SR_names"""
+        if self.cov is not None:
+            x_parts = [samples["x_cov"]]
+            if np.sum(~self.in_cov)>0:
+                x_parts += [samples["x_nocov"]]
+            x_all = tf.concat(x_parts,axis=-1)
+            # Position of each SR in the concatenated x_cov, x_nocov tensor
+            nocov_names = [sr for i,sr in enumerate(self.SR_names) if not self.in_cov[i]]
+            ncov = len(self.cov_order)
+            indices = [self.cov_order.index(sr) if self.in_cov[i] else ncov + nocov_names.index(sr) for i,sr in enumerate(self.SR_names)]
+            x = tf.gather(x_all,indices,axis=-1)
+        else:
+            x = samples["x"]
+        return x
+
     def get_seeds_s_and_nuis(self,samples):
         """Get seeds for full fit to free signal and nuisance
            parameters for every SR. Gives exact MLEs in the
-           absence of correlations"""
-        seeds={}
-
+           absence of correlations.
+           All SRs are computed at once, with SRs along the last axis.
+           Seeds are returned as float64 tensors"""
         threshold = 1e-4 # Smallness threshold, for fixing numerical errors and disallowing solutions too close to zero
 
-        n_all = samples["n"]
-        if self.cov is not None:
-            xcov_all = samples["x_cov"]
-            if np.sum(~self.in_cov)>0:
-                xnocov_all = samples["x_nocov"]
-        else:
-            x_all = samples["x"]
-
-        for i,sr in enumerate(self.SR_names): 
-            #print("Getting seeds for analysis {0}, region {1}".format(self.name,sr))
-            seeds[sr] = {}
-            # From input
-            n = n_all[...,i] 
-            if self.cov is not None:
-                if sr in self.cov_order:
-                    x = xcov_all[...,i]
-                else:
-                    x = xnocov_all[...,i]
-            else:
-                x = x_all[...,i]
-       
-            # From object member variables
-            b = tf.constant(self.SR_b[i],dtype=c.TFdtype)
-            bsys = tf.constant(self.SR_b_sys[i],dtype=c.TFdtype)
-
-            bcast = np.ones((x+b+n).shape) # For easier broadcasting
- 
-            theta_MLE_tmp = x*bcast
-            s_MLE = (n - x - b)*bcast
-            l_MLE_tmp = (s_MLE + b + theta_MLE_tmp)*bcast
-            # Sometimes get l < 0 predictions just due to small numerical errors. Fix these if they
-            # are small enough not to matter
-            mfix = (l_MLE_tmp.numpy()<threshold) & (l_MLE_tmp.numpy()>-threshold) # fix up these ones with small adjustment
-
-            #print("theta_MLE:",theta_MLE_tmp)
-            #print("s_MLE:",s_MLE)
-            #print("n:", n)
-            #print("b:",b)
-            #print("l_MLE:",l_MLE_tmp)
-            #print("mfix:",mfix)
-
-            theta_MLE = np.zeros(theta_MLE_tmp.shape)
-            theta_MLE[mfix] = x.numpy()[mfix] + 2*threshold
-            theta_MLE[~mfix] = x.numpy()[~mfix]
-
-            acheck = (s_MLE + b + theta_MLE).numpy()<threshold # Should have been fixed
-            # Error if too negative. rate MLE should never be negative.
-            if np.sum(acheck)>0:
-                print("Negative rate MLEs!:")
-                print("theta_MLE:",theta_MLE[acheck])
-                print("s_MLE:",s_MLE[acheck])
-                print("l_MLE:",(s_MLE+b+theta_MLE)[acheck])
-                raise ValueError("{0} negative rate MLEs detected!".format(np.sum(acheck)))
-
-            seeds[sr]['theta'] = theta_MLE #/ self.theta_scaling[i]
-            seeds[sr]['s']     = s_MLE #/ self.s_scaling[i]
-
-            #print("seeds[{0}], theta: {1}".format(sr,seeds[sr]['theta']))
-            #print("seeds[{0}], s    : {1}".format(sr,seeds[sr]['s']))
+        n = samples["n"]
+        x = self.get_x_samples(samples)
+        b = tf.constant(self.SR_b,dtype=c.TFdtype)
 
+        shape = tf.shape(x+b+n) # For easier broadcasting
+        theta_MLE_tmp = tf.broadcast_to(x,shape)
+        s_MLE = tf.broadcast_to(n - x - b,shape)
+        l_MLE_tmp = s_MLE + b + theta_MLE_tmp
+        # Sometimes get l < 0 predictions just due to small numerical errors. Fix these if they
+        # are small enough not to matter
+        mfix = (l_MLE_tmp<threshold) & (l_MLE_tmp>-threshold) # fix up these ones with small adjustment
+        theta_MLE = tf.where(mfix, theta_MLE_tmp + 2*threshold, theta_MLE_tmp)
+
+        acheck = (s_MLE + b + theta_MLE)<threshold # Should have been fixed
+        # Error if too negative. rate MLE should never be negative.
+        # (Check skipped when compiled into a tf.function, e.g. by Neg2LogLEngine.profiled_neg2logL)
+        if tf.executing_eagerly() and tf.math.reduce_any(acheck):
+            msg = "{0} negative rate MLEs detected! theta_MLE: {1}, s_MLE: {2}".format(tf.math.reduce_sum(tf.cast(acheck,tf.int32)),theta_MLE[acheck],s_MLE[acheck])
+            raise ValueError(msg)
+
+        seeds = {"theta": tf.cast(theta_MLE,tf.float64),
+                 "s":     tf.cast(s_MLE,tf.float64)}
         return seeds
 
-
     def get_seeds_nuis(self,samples,signal_pars):
         """Get seeds for (additive) nuisance parameter fits,
            assuming fixed signal parameters. Gives exact MLEs in
-           the absence of correlations
+           the absence of correlations.
+           All SRs are computed at once, with SRs along the last axis.
+           Seeds are returned as a float64 tensor.
            TODO: Check that signal parameters are, in fact, fixed?
            """
-        verbose = False # For debugging
-        if verbose: print("signal (seeds_nuis):",signal)
-        seeds={}
-        self.theta_both={} # For debugging, need to compare BOTH solutions to numerical MLEs.
-        self.theta_dat={}
-
         threshold = 1e-4 # Smallness threshold, for fixing numerical errors and disallowing solutions too close to zero
 
-        n_all = samples["n"]
-        if self.cov is not None:
-            xcov_all = samples["x_cov"]
-            if np.sum(~self.in_cov)>0:
-                xnocov_all = samples["x_nocov"]
-        else:
-            x_all = samples["x"]
-        s_all = signal_pars['s'] # non-scaled! 
- 
-        #print("s_all:", s_all)
-        #print("n_all:", n_all)
-        #print("x_all:", x_all)
-
-        # TODO: Could perhaps do all SRs at once, but that's a bit of a pain and this is fast enough anyway
-        for i,sr in enumerate(self.SR_names): 
-            #print("Getting seeds for analysis {0}, region {1}".format(self.name,sr))
-            seeds[sr] = {}
-            # From input
-            n = n_all[...,i] 
-            if self.cov is not None:
-                if sr in self.cov_order:
-                    x = xcov_all[...,i]
-                else:
-                    x = xnocov_all[...,i]
-            else:
-                x = x_all[...,i]
-            s = s_all[...,i]
-
-            #print("s:", s)
-            #print("n:", n)
-            #print("x:", x)
-
-            # From object member variables
-            b = tf.constant(self.SR_b[i],dtype=c.TFdtype)
-            bsys = tf.constant(self.SR_b_sys[i],dtype=c.TFdtype)
-
-            #print("s:", s)
-            #print("b:", b)
-            #print("x:", x)            
-
-            # Math!
-            A = 1./bsys**2
-            B = 1 + A*(s + b - x)
-            C = (s+b)*(1-A*x) - n
-            D = (B**2 - 4*A*C).numpy() # to be used in masks
-            #D<0:
-            #print("D:", D.shape)
-            #print("D<0", (D<0).shape)
-            bcast = np.ones((s+b+n).shape) # For easier broadcasting
-            theta_MLE = np.zeros(bcast.shape)
-            #print("theta_MLE", theta_MLE.shape)
-            #print("theta_MLE[D<0]", theta_MLE[D<0])
-            #print("s+b", (s+b).shape)
-            if verbose: print("broadcast:", (-(s+b)*bcast).shape)
-            #print("broadcast[D<0]:", (-(s+b)*bcast)[D<0].shape)
-            # No solutions! This is a drag, means MLE is on boundary of allowed space, not at a 'real' minima.
-            # Will mess up Wilk's theorem a bit. However MLE will necessarily just be on the boundary
-            # s + b + theta = 0
-            # so it is easy to compute at least
-            if verbose: print("s:",s)
-            if verbose: print("b:",b)
-            if verbose: print("D:", D.shape)
-            theta_MLE[D<0] = (-(s+b)*bcast)[D<0]
-            if verbose: print("No solution count:", np.sum(D<0))
-            #elif D==0:
-            # One real solution:
-            #print("B:",B)
-            #print("A:",A)
-            #print("D:",D)
-            #print("bcast.shape:", bcast.shape)
-            theta_MLE[D==0] = -B[D==0]/(2*A) # Is this always positive? Not sure...
-            if verbose: print("Single solution count:", np.sum(D==0))
-            #elif D>0:
-            # Two real solutions
-            # Hmm not sure how to pick... I guess first check that they are indeed in the "allowed" region
-            if verbose: print("Two solution count:", np.sum(D>0))
-            r1 = (-B + np.sqrt(D))/(2*A)
-            r2 = (-B - np.sqrt(D))/(2*A)
-            a1 = (s+b+r1 >= 0)
-            a2 = (s+b+r2 >= 0) 
-            # See if just one is allowed
-            ma= ((D>0) & a1 & a2).numpy()
-            mf= ((D>0) & (~a1) & (~a2)).numpy()
-            # m = ma | mf 
-            if verbose: print("   both allowed:", np.sum(ma))
-            if verbose: print("   both forbidden:", np.sum(mf))
-            # #print(list(zip(n[D>0]-s-b,r1,r2)))
-            # #if both allowed, pick the one closest to the MLE for theta that one would get without the nuisance constraint
-            # Actually just throw error, I think this should not happen
-            #if np.sum(ma)>0:
-            #    for r1i, r2i in zip(r1[ma],r2[ma]):
-            #        print("r1: {0}, r2: {1}, s+b: {2}".format(r1i,r2i,s+b))
-            #    raise ValueError("Found multiple allowed solutions for some MLEs! I'm pretty sure this shouldn't happen so I'm calling it an error/bug in the calculation") 
-            # If both are forbidden, make sure that it isn't just by some tiny amount due to numerical error.
-            fix1 = (~a1 & ((s+b)*bcast+r1 >= -np.abs(r1)*threshold)).numpy() 
-            fix2 = (~a2 & ((s+b)*bcast+r2 >= -np.abs(r2)*threshold)).numpy()
-            #m12 = (D>0) & fix1 & fix2 # Don't need to worry about this, means they are probably the same solution anyway
-            m1  = (D>0) & mf & fix1
-            m2  = (D>0) & mf & fix2
-            #print("Corrected {0} positive solutions".format(np.sum(m1)))
-            #print("m1",m1.shape)
-            #print("r1",r1.shape)
-            #print("(s+b)*bcast",((s+b)*bcast).shape)
-            #print("theta_MLE", theta_MLE.shape)
-            #print("theta_MLE[m1]",theta_MLE[m1])
-            theta_MLE[m1] = -((s+b)*bcast + np.abs(r1)*threshold)[m1] # Make sure still positive after numerics
-            theta_MLE[m2] = -((s+b)*bcast + np.abs(r2)*threshold)[m2]
-            #if np.sum(mf & ~(fix1 | fix2) > 0):
-            #    for r1i, r2i in zip(r1[mf],r2[mf]):
-            #        print("r1: {0}, r2: {1}, s+b: {2}".format(r1i,r2i,s+b))
-            #    raise ValueError("Found both solutions forbidden (and unfixable) for some MLEs! I'm pretty sure this shouldn't happen so I'm calling it an error/bug in the calculation") 
-            # Edit: I think the above can happen for super low background signal regions. Then the nuisance fluctuation can make even the effective background estimate negative. So I think here we just have to stick the MLE on the boundary of the parameter space.
-            mbound = mf & ~(fix1 | fix2)
-            theta_MLE[mbound] = (-(s+b)*bcast + threshold)[mbound]
-
-            #d1 = (r1 - (n - s - b))**2
-            #d2 = (r2 - (n - s - b))**2
-            # Or the closest to the MLE using a normal approximation for the Poisson? And fixing variance with theta=0...
-            mzero = ((s+b)*bcast == 0).numpy()
-            #print("mzero:",mzero)
-            MLE_norm = ((x*A + (n-s-b)/(s+b)) / (A + 1./(s+b))).numpy()
-            MLE_norm[mzero] = 0 
-            d1 = (r1 - MLE_norm)**2
-            d2 = (r2 - MLE_norm)**2
-            # Use this if both solutions are allowed.
-            m1 = ((D>0) & a1 & a2 & (d1<d2)).numpy()
-            m2 = ((D>0) & a1 & a2 & (d1>=d2)).numpy()
-            if verbose: print("   both roots allowed, but positive is closer to gaussian estimate:", np.sum(m1))
-            if verbose: print("   both roots allowed, but negative is closer to gaussian estimate:", np.sum(m2))
-            theta_MLE[m1] = r1[m1]
-            theta_MLE[m2] = r1[m2]
-            # or just smallest in magnitude?
-            #d1 = r1**2
-            #d2 = r2**2
-            # The most proper thing is just to see which solution gives the best likelihood (or minimum log-likelihood)
-            #d1 = -sps.poisson.logpmf(n,s+b+r1) - sps.norm.logpdf(x,r1)
-            #d2 = -sps.poisson.logpmf(n,s+b+r2) - sps.norm.logpdf(x,r2)
-            #d1[~np.isfinite(d1)] = 1e99 # bad likelihood
-            #d2[~np.isfinite(d2)] = 1e99
-            #theta_MLE[(D>0) & (d1<d2)] = r1[(D>0) & (d1<d2)]
-            #theta_MLE[(D>0) & (d1>=d2)] = r2[(D>0) & (d1>=d2)]
-            #print("r1", "r2", "MLE_guess")
-            #for j in range(np.sum(D>0)):
-            #    print(r1[j], r2[j], MLE_norm[j])
-            #theta_MLE[D>0] = MLE_norm[D>0] # test...
-            # Seems like the positive root is always the right one for some reason...
-            #theta_MLE[D>0] = r1[D>0] 
-            # # If both solutions are forbidden then something weird is probably going on, but we'll pick one anyway
-            # # and let the parameter mapping sort it out.
-            m = ((D>0) & (a1) & (~a2)).numpy()
-            if verbose: print("   only positive root allowed:", np.sum(m))
-            theta_MLE[m] = r1[m]
-            m = ((D>0) & (~a1) & (a2)).numpy()
-            if verbose: print("   only negative root allowed:", np.sum(m))
-            theta_MLE[m] = r2[m]
-            # Save some extra info for diagnositic functions
-            self.theta_both[sr] = [copy.copy(theta_MLE), copy.copy(theta_MLE), MLE_norm, s + b] # Make sure to copy...
-            self.theta_both[sr][0][D>0] = r1[D>0]
-            self.theta_both[sr][1][D>0] = r2[D>0]
-            self.theta_dat[sr] = n,x,s,b,bsys
-            # Output!
-            if verbose: print("MLE theta_{0}:".format(i), theta_MLE) 
-            # Sanity check; are all these seeds part of the allowed parameter space?
-            l = s + b + theta_MLE
-            afix = ((l<=threshold) & (l>=-threshold)).numpy() # really small values can cause problems too.
-            theta_MLE[afix] = theta_MLE[afix] + threshold
-            acheck = (l<-threshold).numpy() # Raise error if too far negative to correct without problems
-            #print("sr:", sr)
-            #print("l:", l)
-            # TODO: Put this check back in! Might be some error in here because it keeps triggering. But might be due to covariance matrices?
-            #if np.sum(acheck)>0:
-            #     for soli, r1i, r2i in zip(theta_MLE[acheck],r1[acheck],r2[acheck]):
-            #        print("MLE: {0}, r1: {1}, r2: {2}, s+b: {3}, ? {4}".format(soli,r1i,r2i,s+b,s+b+r1i >= -np.abs(r1i)*1e-6))
-            #     raise ValueError("Computed {0} forbidden seeds (from {1} samples)! There is therefore a bug in the seed calculations".format(np.sum(acheck),acheck.shape))
-            # Did we get everything? Are there any NaNs left?
-            nnans = np.sum(~np.isfinite(theta_MLE))
-            if nnans>0: print("Warning! {0} NaNs left in seeds!".format(nnans))
-            seeds[sr]['theta'] = theta_MLE #/ self.theta_scaling[i] # Scaled by bsys to try and normalise variables in the fit. Input variables are scaled the same way.
-
-            # DEBUGGING
-            # Hessian cross-check (no covariance case)
-            # d2logp_ds2_i = - k_i / lambda_i^2
-            # d2logp_dtheta2_i = - 1 / sigma_theta_i^2 - k_i / lambda_i^2
-            # d2logp_ds_idtheta_i = - k_i / lambda_i^2
-
-            print("Hessian cross-check for binned_analysis")
-            k_i = n
-            lambda_i = s + b + theta_MLE
-            sigma_theta_i = bsys
-            print("k_i:", k_i)
-            print("x_i:", x)
-            print("s_i:", s)
-            print("b_i:", b)
-            print("theta_i_MLE:", theta_MLE)
-            print("lambda_i:", lambda_i)
-            print("sigma_theta_i:", sigma_theta_i)
-            dlogp_ds_i = k_i / lambda_i - 1
-            dlogp_dtheta_i = (x - theta_MLE) / sigma_theta_i**2 + k_i / lambda_i - 1
-            print("Grad components:")
-            print("dlogp_ds_i:", dlogp_ds_i)
-            print("dlogp_dtheta_i:", dlogp_dtheta_i)
-            d2logp_ds2_i = - k_i / lambda_i**2
-            d2logp_dtheta2_i = - 1 / sigma_theta_i**2 - k_i / lambda_i**2
-            d2logp_ds_idtheta_i = - k_i / lambda_i**2
-            print("Hessian components:")
-            print("d2logp_ds2_i:",        d2logp_ds2_i)     
-            print("d2logp_dtheta2_i:",    d2logp_dtheta2_i) 
-            print("d2logp_ds_idtheta_i:", d2logp_ds_idtheta_i)
-
-            print("Inverses (just 1/element for single parameter case)")
-            print("1/d2logp_ds2_i:",        1./d2logp_ds2_i)     
-            print("1/d2logp_dtheta2_i:",    1./d2logp_dtheta2_i) 
-            print("1/d2logp_ds_idtheta_i:", 1./d2logp_ds_idtheta_i)
-
-            print("B = ", (1./d2logp_dtheta2_i) * d2logp_ds_idtheta_i) 
-            print("A = ", (1./d2logp_dtheta2_i) * dlogp_dtheta_i)
-            
-
-        #print("seeds:", seeds)
+        n = samples["n"]
+        x = self.get_x_samples(samples)
+        s = signal_pars['s'] # non-scaled! 
+        b = tf.constant(self.SR_b,dtype=c.TFdtype)
+        bsys = tf.constant(self.SR_b_sys,dtype=c.TFdtype)
+
+        # Math! theta_MLE is a root of A*theta^2 + B*theta + C = 0
+        shape = tf.shape(s+b+n) # For easier broadcasting
+        A = 1./bsys**2
+        B = tf.broadcast_to(1 + A*(s + b - x),shape)
+        C = (s+b)*(1-A*x) - n
+        D = tf.broadcast_to(B**2 - 4*A*C,shape)
+        sb = tf.broadcast_to(s+b,shape)
+        theta_MLE = tf.zeros(shape,dtype=c.TFdtype)
+
+        # No solutions! This is a drag, means MLE is on boundary of allowed space, not at a 'real' minima.
+        # Will mess up Wilk's theorem a bit. However MLE will necessarily just be on the boundary
+        # s + b + theta = 0
+        # so it is easy to compute at least
+        theta_MLE = tf.where(D<0, -sb, theta_MLE)
+        # One real solution:
+        theta_MLE = tf.where(D==0, -B/(2*A), theta_MLE) # Is this always positive? Not sure...
+        # Two real solutions
+        # Need to check that they are in the "allowed" region
+        r1 = (-B + tf.sqrt(D))/(2*A)
+        r2 = (-B - tf.sqrt(D))/(2*A)
+        a1 = (sb+r1 >= 0)
+        a2 = (sb+r2 >= 0)
+        mf = (D>0) & (~a1) & (~a2)
+        # If both are forbidden, make sure that it isn't just by some tiny amount due to numerical error.
+        fix1 = ~a1 & (sb+r1 >= -tf.abs(r1)*threshold)
+        fix2 = ~a2 & (sb+r2 >= -tf.abs(r2)*threshold)
+        theta_MLE = tf.where(mf & fix1, -(sb + tf.abs(r1)*threshold), theta_MLE) # Make sure still positive after numerics
+        theta_MLE = tf.where(mf & fix2, -(sb + tf.abs(r2)*threshold), theta_MLE)
+        # Otherwise (e.g. for super low background signal regions, where the nuisance fluctuation can
+        # make even the effective background estimate negative) stick the MLE on the boundary of the
+        # parameter space.
+        mbound = mf & ~(fix1 | fix2)
+        theta_MLE = tf.where(mbound, -sb + threshold, theta_MLE)
+
+        # If both solutions are allowed, compare them to the MLE using a normal approximation
+        # for the Poisson (fixing variance with theta=0)
+        MLE_norm = (x*A + (n-s-b)/(s+b)) / (A + 1./(s+b))
+        MLE_norm = tf.where(sb==0, tf.zeros_like(sb), MLE_norm)
+        d1 = (r1 - MLE_norm)**2
+        d2 = (r2 - MLE_norm)**2
+        # Seems like the positive root is always the right one, so it is currently used in both cases
+        theta_MLE = tf.where((D>0) & a1 & a2 & (d1<d2), r1, theta_MLE)
+        theta_MLE = tf.where((D>0) & a1 & a2 & (d1>=d2), r1, theta_MLE)
+        # Only one root allowed
+        theta_MLE = tf.where((D>0) & a1 & (~a2), r1, theta_MLE)
+        theta_MLE = tf.where((D>0) & (~a1) & a2, r2, theta_MLE)
+
+        # Sanity check; are all these seeds part of the allowed parameter space?
+        # Really small rates can cause problems too, so shift them a little (in double precision)
+        l = sb + theta_MLE
+        afix = (l<=threshold) & (l>=-threshold)
+        theta_MLE = tf.cast(theta_MLE,tf.float64)
+        theta_MLE = tf.where(afix, theta_MLE + threshold, theta_MLE)
+
+        seeds = {"theta": theta_MLE}
         return seeds
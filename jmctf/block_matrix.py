@@ -0,0 +1,248 @@
+"""Container for batches of block-sparse matrices, used mainly to store Hessians
+   of the joint log_prob function. These are block-diagonal across analyses (and
+   often further within analyses, e.g. per signal region for uncorrelated binned
+   analyses), so storing the full dense (batch,N,N) tensor wastes a lot of memory
+   on zeros."""
+
+import functools
+import numpy as np
+import tensorflow as tf
+
+def _assemble_rows(parts,nrows):
+    """Combine per-block results, whose last dimension runs over the rows of
+       each block, into a dense tensor whose last dimension has size nrows.
+       Rows not covered by any block are filled with zeros."""
+    index = np.full(nrows, sum(len(rows) for rows,p in parts), dtype=np.int64)
+    k = 0
+    for rows,p in parts:
+        index[list(rows)] = np.arange(k,k+len(rows))
+        k += len(rows)
+    pshape = functools.reduce(tf.broadcast_dynamic_shape, [tf.shape(p)[:-1] for r,p in parts])
+    bparts = [tf.broadcast_to(p,tf.concat([pshape,tf.shape(p)[-1:]],axis=0)) for r,p in parts]
+    zeros = tf.zeros(tf.concat([pshape,[1]],axis=0),dtype=bparts[0].dtype)
+    return tf.gather(tf.concat(bparts + [zeros],axis=-1),index,axis=-1)
+
+class BlockMatrix:
+    """A batch of (nrows,ncols) matrices that are zero except in a set of
+       non-overlapping blocks.
+
+       Each block is stored as a tuple (rows, cols, M), where 'rows' and 'cols'
+       are tuples of the row/column indices (in the full matrix) covered by
+       the block, and M is a tensor of shape batch_shape + (len(rows),len(cols)).
+       Blocks must not share any rows or columns with each other (i.e. the
+       matrix is block-diagonal up to a permutation of rows and columns).
+
+       As for dense tensors, 'shape' is batch_shape + matrix_shape, where
+       matrix_shape = (nrows,ncols).
+    """
+
+    def __init__(self,blocks,matrix_shape,batch_shape=None):
+        self.blocks = [(tuple(rows), tuple(cols), M) for rows,cols,M in blocks]
+        self.matrix_shape = tuple(matrix_shape)
+        if batch_shape is None:
+            batch_shape = tuple(self.blocks[0][2].shape[:-2]) if len(self.blocks)>0 else ()
+        self.batch_shape = tuple(batch_shape)
+        all_rows = [r for rows,cols,M in self.blocks for r in rows]
+        all_cols = [j for rows,cols,M in self.blocks for j in cols]
+        if len(set(all_rows))!=len(all_rows) or len(set(all_cols))!=len(all_cols):
+            msg = "Blocks supplied to BlockMatrix overlap! Each row and column of the matrix may belong to at most one block."
+            raise ValueError(msg)
+        if any(r>=self.matrix_shape[0] for r in all_rows) or any(j>=self.matrix_shape[1] for j in all_cols):
+            msg = "Blocks supplied to BlockMatrix have indices outside the stated matrix shape {0}".format(self.matrix_shape)
+            raise ValueError(msg)
+
+    @property
+    def shape(self):
+        return self.batch_shape + self.matrix_shape
+
+    @property
+    def dtype(self):
+        return self.blocks[0][2].dtype
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def to_dense(self):
+        """Assemble the full dense tensor, of shape batch_shape + (nrows,ncols)"""
+        nrows, ncols = self.matrix_shape
+        batch_shape = self.batch_shape
+        nb = len(batch_shape)
+        # Scatter into a tensor with the matrix dimensions first, then move them back to the end
+        dense = tf.zeros([nrows,ncols] + list(batch_shape), dtype=self.dtype)
+        for rows,cols,M in self.blocks:
+            indices = np.array([(r,j) for r in rows for j in cols], dtype=np.int64)
+            perm = [nb,nb+1] + list(range(nb))
+            updates = tf.reshape(tf.transpose(M,perm),[len(indices)] + list(batch_shape))
+            dense = tf.tensor_scatter_nd_update(dense,indices,updates)
+        return tf.transpose(dense,list(range(2,nb+2)) + [0,1])
+
+    def slice_batch(self,sl,axis=0):
+        """Slice all blocks along a batch axis. Blocks with size 1 along
+           that axis (i.e. broadcast) are left as they are."""
+        if axis<0 or axis>=len(self.batch_shape):
+            msg = "Batch axis {0} out of range for BlockMatrix with batch_shape {1}".format(axis,self.batch_shape)
+            raise ValueError(msg)
+        index = (slice(None),)*axis + (sl,)
+        new_blocks = [(rows, cols, M if M.shape[axis]==1 else M[index]) for rows,cols,M in self.blocks]
+        batch_shape = list(self.batch_shape)
+        if batch_shape[axis]!=1:
+            batch_shape[axis] = len(range(*sl.indices(batch_shape[axis])))
+        return BlockMatrix(new_blocks,self.matrix_shape,batch_shape)
+
+    def transpose(self):
+        """Transpose of the matrix (batch dimensions untouched)"""
+        return BlockMatrix([(cols, rows, tf.linalg.matrix_transpose(M)) for rows,cols,M in self.blocks], self.matrix_shape[::-1], self.batch_shape)
+
+    def sub_matrix(self,rows,cols):
+        """Extract the sub-matrix formed from the selected rows and columns
+           (lists of indices, in the order desired for the output). Result is
+           another BlockMatrix, of shape (len(rows),len(cols)), or None if no
+           rows or columns are selected."""
+        if len(rows)==0 or len(cols)==0:
+            return None
+        row_pos = {r: i for i,r in enumerate(rows)}
+        col_pos = {j: i for i,j in enumerate(cols)}
+        new_blocks = []
+        for brows,bcols,M in self.blocks:
+            sel_r = [k for k,r in enumerate(brows) if r in row_pos]
+            sel_c = [k for k,j in enumerate(bcols) if j in col_pos]
+            if len(sel_r)==0 or len(sel_c)==0:
+                continue
+            subM = tf.gather(tf.gather(M,sel_r,axis=-2),sel_c,axis=-1)
+            new_blocks += [(tuple(row_pos[brows[k]] for k in sel_r), tuple(col_pos[bcols[k]] for k in sel_c), subM)]
+        return BlockMatrix(new_blocks,(len(rows),len(cols)),self.batch_shape)
+
+    def matvec(self,x):
+        """Matrix-vector product with x, of shape (...,ncols). Batch dimensions
+           of x are broadcast against those of the matrix, as for tf.linalg.matvec"""
+        parts = [(rows, tf.linalg.matvec(M,tf.gather(x,list(cols),axis=-1))) for rows,cols,M in self.blocks]
+        if len(parts)==0:
+            return tf.zeros(tf.concat([tf.shape(x)[:-1],[self.matrix_shape[0]]],axis=0),dtype=x.dtype)
+        return _assemble_rows(parts,self.matrix_shape[0])
+
+    def _diagonal_blocks(self):
+        if self.matrix_shape[0]!=self.matrix_shape[1] or any(rows!=cols for rows,cols,M in self.blocks):
+            msg = "Operation requires a square BlockMatrix whose blocks all lie on the diagonal (i.e. have matching row and column indices)"
+            raise ValueError(msg)
+        if sum(len(rows) for rows,cols,M in self.blocks)!=self.matrix_shape[0]:
+            msg = "Operation requires a BlockMatrix whose diagonal blocks cover the whole matrix, otherwise it is singular"
+            raise ValueError(msg)
+        return {rows: M for rows,cols,M in self.blocks}
+
+    def __neg__(self):
+        return BlockMatrix([(rows, cols, -M) for rows,cols,M in self.blocks], self.matrix_shape, self.batch_shape)
+
+    def solve(self,rhs):
+        """Solve the linear system self @ X = rhs, block by block.
+
+           The matrix must be square with diagonal blocks. rhs may be a dense
+           vector of shape (...,n), in which case a dense vector is returned,
+           or a BlockMatrix whose blocks each have rows matching the rows of
+           one of the diagonal blocks of this matrix (e.g. an off-diagonal
+           sub-matrix taken from the same Hessian), in which case a BlockMatrix
+           is returned."""
+        solvers = {rows: functools.partial(tf.linalg.solve,M) for rows,M in self._diagonal_blocks().items()}
+        return _solve_blocks(solvers,rhs,self.matrix_shape[0])
+
+    def cholesky(self):
+        """Cholesky factorise each (symmetric positive-definite) diagonal block.
+           Returns a BlockCholesky object, which can be used for repeated solves."""
+        factors = {rows: Cholesky(M) for rows,M in self._diagonal_blocks().items()}
+        return BlockCholesky(factors,self.matrix_shape,self.batch_shape)
+
+def _solve_blocks(solvers,rhs,n):
+    """Solve block-diagonal linear system using a dictionary of solver
+       functions (mapping (...,k,k) rhs matrices to solutions), one for each
+       diagonal block, keyed by the rows of that block. See BlockMatrix.solve."""
+    if isinstance(rhs,BlockMatrix):
+        new_blocks = []
+        for rows,cols,R in rhs.blocks:
+            if rows not in solvers.keys():
+                msg = "Block structure of right hand side does not match that of the matrix in BlockMatrix.solve (rows {0} are not those of any block)".format(rows)
+                raise ValueError(msg)
+            new_blocks += [(rows, cols, solvers[rows](R))]
+        return BlockMatrix(new_blocks,rhs.matrix_shape,rhs.batch_shape)
+    else:
+        parts = []
+        for rows,solve in solvers.items():
+            xb = tf.gather(rhs,list(rows),axis=-1)[...,tf.newaxis]
+            parts += [(rows, solve(xb)[...,0])]
+        return _assemble_rows(parts,n)
+
+class Cholesky:
+    """Cholesky factorisation of a batch of symmetric positive-definite matrices,
+       stored for re-use in repeated solves (each of which then only needs two
+       triangular solves). Any members of the batch for which the factorisation
+       fails (i.e. which are not numerically positive-definite) fall back to a
+       standard LU solve, while the others still use their factorisations.
+
+       On GPU tf.linalg.cholesky returns NaNs for the failed members, but on CPU
+       it raises an error if any member fails; in that case the failed members
+       are identified from their eigenvalues and the rest are factorised again.
+
+       The matrices themselves are only kept (as M) if some factorisations
+       failed, since they are only needed for the LU solves; otherwise M is None.
+
+       L and ok (mask of successful factorisations) can be supplied directly,
+       e.g. when restoring from disk, in which case they are not recomputed.
+    """
+
+    def __init__(self,M,L=None,ok=None):
+        if L is None:
+            try:
+                L = tf.linalg.cholesky(M)
+                ok = tf.reduce_all(tf.math.is_finite(L),axis=[-2,-1])
+            except tf.errors.InvalidArgumentError:
+                ok = tf.reduce_min(tf.linalg.eigvalsh(M),axis=-1) > 0
+                eye = tf.eye(M.shape[-1],dtype=M.dtype)
+                try:
+                    L = tf.linalg.cholesky(tf.where(ok[...,tf.newaxis,tf.newaxis],M,eye))
+                except tf.errors.InvalidArgumentError:
+                    L = None
+                    ok = tf.zeros(M.shape[:-2],dtype=tf.bool)
+        self.L = L
+        self.ok = ok
+        self.M = None if self.all_ok else M
+
+    @property
+    def all_ok(self):
+        return self.L is not None and bool(tf.reduce_all(self.ok))
+
+    def solve(self,rhs):
+        """Solve M @ X = rhs for rhs of shape (...,n,k)"""
+        if self.all_ok:
+            return tf.linalg.cholesky_solve(self.L,rhs)
+        # Some factorisations failed; use LU solves for those
+        rhs_b = tf.broadcast_to(rhs,tf.concat([tf.shape(self.M)[:-2],tf.shape(rhs)[-2:]],axis=0))
+        X_lu = tf.linalg.solve(self.M,rhs_b)
+        if self.L is None:
+            return X_lu
+        ok = self.ok[...,tf.newaxis,tf.newaxis]
+        L_safe = tf.where(ok,self.L,tf.eye(self.M.shape[-1],dtype=self.M.dtype))
+        X_chol = tf.linalg.cholesky_solve(L_safe,rhs)
+        return tf.where(ok,X_chol,X_lu)
+
+    def solvevec(self,rhs):
+        """Solve M @ x = rhs for rhs of shape (...,n)"""
+        return self.solve(rhs[...,tf.newaxis])[...,0]
+
+class BlockCholesky:
+    """Cholesky factorisations of the diagonal blocks of a BlockMatrix
+       (see BlockMatrix.cholesky)"""
+
+    def __init__(self,factors,matrix_shape,batch_shape):
+        self.factors = factors
+        self.matrix_shape = tuple(matrix_shape)
+        self.batch_shape = tuple(batch_shape)
+
+    @property
+    def all_ok(self):
+        return all(f.all_ok for f in self.factors.values())
+
+    def solve(self,rhs):
+        """As BlockMatrix.solve, but using the stored factorisations"""
+        solvers = {rows: f.solve for rows,f in self.factors.items()}
+        return _solve_blocks(solvers,rhs,self.matrix_shape[0])
+
+    def solvevec(self,rhs):
+        return self.solve(rhs)
@@ -0,0 +1,260 @@
+"""Columnar on-disk storage of per-event data and results, as a faster
+   alternative to the row-wise sqlite storage in sql_helpers for very large
+   numbers of events.
+
+   Each table is a directory of 'chunks', each of which holds one .npy file per
+   column, plus a JSON index recording the columns of the table and, for each
+   chunk, its size and range of primary key values. Appends write whole
+   columns in bulk; loads read only the requested columns (memory-mapped), and
+   only from chunks whose key range overlaps the requested keys. Conditional
+   'upserts' (keep the smaller/larger value) are done as vectorised min/max
+   operations in memory, rather than by SQL CASE statements row by row.
+
+   The methods mirror the functions in sql_helpers (minus the cursor
+   argument), so a ColumnStore can be used in place of an sqlite database.
+   Data may be supplied as pandas DataFrames (converted via to_records,
+   including the index, as in sql_helpers) or as dictionaries of numpy arrays.
+"""
+
+import os
+import json
+import numpy as np
+
+def _to_columns(data):
+    """Convert a DataFrame or dictionary of arrays into a dictionary of numpy arrays"""
+    if hasattr(data, "to_records"):
+        rec = data.to_records()
+        return {name: np.asarray(rec[name]) for name in rec.dtype.names}
+    return {k: np.asarray(v) for k,v in data.items()}
+
+def _collapse_duplicates(cols, primary, op, key=None):
+    """Reduce rows sharing a primary key value to one row per key, as the sqlite
+       upserts do when a batch contains repeated keys: the last row wins for plain
+       upserts (op None), columns are combined with op for upsert_if_smaller/larger,
+       and the row with the best value of column 'key' wins (the first of any ties)
+       for the *_by variants. Returns the columns sorted by primary key."""
+    keys = cols[primary]
+    if len(keys)==0:
+        return cols
+    if key is None:
+        order = np.argsort(keys, kind="stable")
+    else:
+        # Best key value first within each group of equal primary keys (NaNs last)
+        k = cols[key] if op is np.less else -cols[key]
+        order = np.lexsort((np.arange(len(keys)), k, keys))
+    sorted_keys = keys[order]
+    starts = np.flatnonzero(np.concatenate([[True], sorted_keys[1:]!=sorted_keys[:-1]]))
+    if len(starts)==len(keys):
+        return {k: v[order] for k,v in cols.items()}
+    if key is not None:
+        return {k: v[order][starts] for k,v in cols.items()}
+    if op is None:
+        last = np.concatenate([starts[1:], [len(keys)]]) - 1
+        return {k: v[order][last] for k,v in cols.items()}
+    return {k: (v[order][starts] if k==primary else op.reduceat(v[order], starts, axis=0)) for k,v in cols.items()}
+
+class ColumnStore:
+    """Collection of columnar tables stored under directory 'path'"""
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def _table_dir(self, table_name):
+        return os.path.join(self.path, table_name)
+
+    def _read_index(self, table_name):
+        with open(os.path.join(self._table_dir(table_name), "index.json")) as f:
+            return json.load(f)
+
+    def _write_index(self, table_name, index):
+        fname = os.path.join(self._table_dir(table_name), "index.json")
+        with open(fname + ".tmp", "w") as f:
+            json.dump(index, f)
+        os.replace(fname + ".tmp", fname) # Atomic, so readers never see a partial index
+
+    def _column_file(self, table_name, chunk, col):
+        return os.path.join(self._table_dir(table_name), chunk["name"], "{0}.npy".format(col))
+
+    def check_table_exists(self, table_name):
+        return os.path.exists(os.path.join(self._table_dir(table_name), "index.json"))
+
+    def create_table(self, table_name, columns=(), primary=None):
+        """Create a table if it doesn't already exist. Columns (list of (name, type)
+           pairs, as for sql_helpers.create_table) are optional; column types are
+           taken from the data when it is first stored."""
+        if self.check_table_exists(table_name):
+            return
+        os.makedirs(self._table_dir(table_name), exist_ok=True)
+        self._write_index(table_name, {"primary": primary, "columns": {}, "chunks": []})
+
+    def table_info(self, table_name):
+        """Return table metadata: {column name: {"dtype": ..., "shape": ...}}"""
+        return self._read_index(table_name)["columns"]
+
+    def n_rows(self, table_name):
+        return sum(ch["n"] for ch in self._read_index(table_name)["chunks"])
+
+    def _register_columns(self, index, cols):
+        for k,v in cols.items():
+            if k not in index["columns"]:
+                index["columns"][k] = {"dtype": v.dtype.str, "shape": list(v.shape[1:])}
+
+    def _missing(self, index, col, n):
+        """Fill values for a column that is absent from a chunk (NaN, or -1 for integers)"""
+        info = index["columns"][col]
+        dtype = np.dtype(info["dtype"])
+        fill = -1 if dtype.kind in "iu" else (False if dtype.kind=="b" else np.nan)
+        return np.full([n] + info["shape"], fill, dtype=dtype)
+
+    def append(self, table_name, data, primary=None):
+        """Append rows in bulk, as a new chunk, without checking for existing
+           primary key values (see upsert for that)"""
+        if not self.check_table_exists(table_name):
+            self.create_table(table_name, primary=primary)
+        cols = _to_columns(data)
+        n = {len(v) for v in cols.values()}
+        if len(n)!=1:
+            msg = "All columns appended to table `{0}` must have the same length! (got lengths {1})".format(table_name, {k: len(v) for k,v in cols.items()})
+            raise ValueError(msg)
+        n = n.pop()
+        if n==0:
+            return
+        index = self._read_index(table_name)
+        primary = primary if primary is not None else index["primary"]
+        if index["primary"] is None:
+            index["primary"] = primary
+        self._register_columns(index, cols)
+        chunk = {"name": "chunk_{0:06d}".format(len(index["chunks"])), "n": n, "columns": list(cols.keys())}
+        if primary is not None:
+            chunk["key_min"] = int(np.min(cols[primary]))
+            chunk["key_max"] = int(np.max(cols[primary]))
+        os.makedirs(os.path.join(self._table_dir(table_name), chunk["name"]), exist_ok=True)
+        for k,v in cols.items():
+            np.save(self._column_file(table_name, chunk, k), v)
+        index["chunks"] += [chunk]
+        self._write_index(table_name, index)
+
+    def insert_as_arrays(self, table_name, data):
+        """Equivalent of sql_helpers.insert_as_arrays: with columnar storage every
+           insert is already stored as whole arrays, so this is just append."""
+        self.append(table_name, data)
+
+    def upsert(self, table_name, data, primary):
+        """Insert rows, overwriting existing rows with the same primary key value"""
+        self._merge(table_name, data, primary, None)
+
+    def upsert_if_smaller(self, table_name, data, primary):
+        """As upsert, but only replaces existing values if the new values are smaller"""
+        self._merge(table_name, data, primary, np.fmin)
+
+    def upsert_if_larger(self, table_name, data, primary):
+        """As upsert, but only replaces existing values if the new values are larger"""
+        self._merge(table_name, data, primary, np.fmax)
+
+    def upsert_if_smaller_by(self, table_name, data, primary, key):
+        """As upsert, but only replaces existing rows (all columns together) if the
+           new value in column 'key' is smaller (see sql_helpers.upsert_if_smaller_by)"""
+        self._merge(table_name, data, primary, np.less, key)
+
+    def upsert_if_larger_by(self, table_name, data, primary, key):
+        """As upsert_if_smaller_by, but keeping rows with the largest 'key' values"""
+        self._merge(table_name, data, primary, np.greater, key)
+
+    def _merge(self, table_name, data, primary, op, key=None):
+        """Common function for upsert/upsert_if_smaller/larger(_by). op combines existing
+           and new values of each column (None means just take the new values), or, if
+           key is given, compares new against existing values of column 'key' to decide
+           which rows to replace"""
+        cols = _to_columns(data)
+        if primary not in cols.keys():
+            msg = "Primary key column `{0}` not found in data for table `{1}`".format(primary, table_name)
+            raise ValueError(msg)
+        cols = _collapse_duplicates(cols, primary, op, key)
+        if not self.check_table_exists(table_name):
+            self.append(table_name, cols, primary)
+            return
+        index = self._read_index(table_name)
+        self._register_columns(index, cols)
+        keys = cols[primary]
+        order = np.argsort(keys, kind="stable")
+        sorted_keys = keys[order]
+        done = np.zeros(len(keys), dtype=bool)
+        kmin, kmax = (sorted_keys[0], sorted_keys[-1]) if len(keys)>0 else (0, -1)
+        for chunk in index["chunks"]:
+            if chunk.get("key_min", kmin) > kmax or chunk.get("key_max", kmax) < kmin:
+                continue
+            old_keys = np.load(self._column_file(table_name, chunk, primary))
+            pos = np.clip(np.searchsorted(sorted_keys, old_keys), 0, len(keys)-1)
+            match = sorted_keys[pos]==old_keys
+            if not np.any(match):
+                continue
+            src = order[pos[match]] # Positions in new data of rows matching this chunk
+            done[src] = True
+            if key is not None:
+                if key in chunk["columns"]:
+                    old_key = np.load(self._column_file(table_name, chunk, key))[match]
+                else:
+                    old_key = self._missing(index, key, chunk["n"])[match]
+                replace = np.isnan(old_key) | op(cols[key][src], old_key)
+            for k,v in cols.items():
+                if k==primary:
+                    continue
+                existed = k in chunk["columns"]
+                if existed:
+                    old = np.load(self._column_file(table_name, chunk, k))
+                else:
+                    old = self._missing(index, k, chunk["n"])
+                    chunk["columns"] += [k]
+                new = v[src]
+                if key is not None:
+                    new = np.where(replace.reshape((-1,) + (1,)*(new.ndim-1)), new, old[match])
+                elif op is not None and existed:
+                    new = op(old[match], new)
+                old[match] = new
+                np.save(self._column_file(table_name, chunk, k), old)
+        self._write_index(table_name, index)
+        if not np.all(done):
+            self.append(table_name, {k: v[~done] for k,v in cols.items()}, primary)
+
+    def iter_load(self, table_name, cols, keys=None, primary=None):
+        """Generator yielding dictionaries of numpy column arrays chunk by chunk,
+           optionally selecting only rows whose primary key is in 'keys'."""
+        index = self._read_index(table_name)
+        primary = primary if primary is not None else index["primary"]
+        if len(cols)==0:
+            msg = "Load from table `{0}` failed: no columns specified! (cols={1})".format(table_name, cols)
+            raise ValueError(msg)
+        unknown = [col for col in cols if col not in index["columns"]]
+        if len(unknown)>0:
+            msg = "Columns {0} not found in table `{1}`".format(unknown, table_name)
+            raise ValueError(msg)
+        if keys is not None:
+            keys = np.asarray(keys)
+            kmin, kmax = np.min(keys), np.max(keys)
+        for chunk in index["chunks"]:
+            sel = slice(None)
+            if keys is not None:
+                if chunk.get("key_min", kmin) > kmax or chunk.get("key_max", kmax) < kmin:
+                    continue
+                sel = np.isin(np.load(self._column_file(table_name, chunk, primary), mmap_mode="r"), keys)
+                if not np.any(sel):
+                    continue
+            out = {}
+            for col in cols:
+                if col in chunk["columns"]:
+                    out[col] = np.asarray(np.load(self._column_file(table_name, chunk, col), mmap_mode="r")[sel])
+                else:
+                    out[col] = self._missing(index, col, chunk["n"])[sel]
+            yield out
+
+    def load(self, table_name, cols, keys=None, primary=None):
+        """Load the selected columns (optionally only rows with primary key values
+           in 'keys') as a dictionary of numpy arrays. Unlike sql_helpers.load,
+           results are columns rather than a list of row tuples. Rows are in
+           storage order; sort by the primary key column if needed."""
+        parts = list(self.iter_load(table_name, cols, keys, primary))
+        if len(parts)==0:
+            index = self._read_index(table_name)
+            return {col: self._missing(index, col, 0) for col in cols}
+        return {col: np.concatenate([p[col] for p in parts]) for col in cols}
@@ -1,12 +1,21 @@
 """Assorted common helper functions"""
 
+import io
+import bz2
+import zlib
+import lzma
+import time
+import struct
 import yaml
 import sqlite3
 import numpy as np
 import tensorflow as tf
 import scipy.interpolate as spi
-from functools import reduce
+from functools import reduce, lru_cache
 from collections.abc import Mapping
+from . import log
+
+logger = log.get_logger(__name__)
 
 # Reference dtype for consistency in TensorFlow operations
 TFdtype = np.float32
@@ -27,8 +36,7 @@ def blockseqtrue_rep(dumper, data):
 yaml.add_representer(blockseqtrue, blockseqtrue_rep)
 
 # Helpers for storing numpy arrays in sqlite tables
-# (see https://stackoverflow.com/a/55799782/1447953)
-compressor = 'zlib'  # zlib, bz2
+# (see https://stackoverflow.com/a/55799782/1447953, and encode_array below)
 
 def to_numpy(d):
     """Convert bottom level items in nested dictionary
@@ -71,29 +79,94 @@ def deep_binary(f):
         return out
     return deep_binary_decorator
 
+# Binary array format for sqlite BLOB cells: a small fixed header followed by
+# the raw (C-ordered) array buffer, so that decoding is just np.frombuffer.
+#   magic (4 bytes) | codec id (uint8) | ndim (uint8) | dtype string length (uint8)
+#   | dtype string (ascii, e.g. '<f4') | shape (ndim x uint64) | data
+# where data is the raw buffer, compressed by the codec if codec id != 0.
+array_magic = b"JMA1"
+_array_header = struct.Struct("<4sBBB")
+
+def _lz4_codec():
+    try:
+        import lz4.frame
+    except ImportError:
+        return None
+    return (lz4.frame.compress, lz4.frame.decompress)
+
+array_codecs = {None: 0, 'zlib': 1, 'bz2': 2, 'lzma': 3, 'lz4': 4}
+_codec_functions = {1: (zlib.compress, zlib.decompress),
+                    2: (bz2.compress, bz2.decompress),
+                    3: (lzma.compress, lzma.decompress)}
+if _lz4_codec() is not None: _codec_functions[4] = _lz4_codec()
+
+def encode_array(arr,compression=None):
+    """Serialise a numpy array into the compact binary array format, optionally
+       compressing the data buffer with one of the codecs in array_codecs.
+       Object arrays are not supported."""
+    arr = np.require(arr,requirements="C") # (ascontiguousarray would promote 0-d arrays to 1-d)
+    if arr.dtype.hasobject:
+        msg = "Cannot encode arrays of Python objects into binary array format"
+        raise TypeError(msg)
+    if compression not in array_codecs.keys() or (compression is not None and array_codecs[compression] not in _codec_functions.keys()):
+        msg = "Unknown or unavailable compression codec '{0}' requested for array encoding! Available codecs are: {1}".format(compression,[k for k,v in array_codecs.items() if v==0 or v in _codec_functions.keys()])
+        raise ValueError(msg)
+    codec = array_codecs[compression]
+    dt = arr.dtype.str.encode('ascii')
+    header = _array_header.pack(array_magic, codec, arr.ndim, len(dt)) + dt + struct.pack("<{0}Q".format(arr.ndim), *arr.shape)
+    data = arr.data if codec==0 else _codec_functions[codec][0](arr.data)
+    return header + bytes(data)
+
+def decode_array(buf,copy=False):
+    """Deserialise an array from the binary array format. Uncompressed arrays
+       are returned as (read-only) views into buf unless copy is True.
+       Also reads the older np.save-based format, for existing databases."""
+    mv = memoryview(buf)
+    if bytes(mv[:4])!=array_magic:
+        # Legacy format written by np.save
+        return np.load(io.BytesIO(mv))
+    magic, codec, ndim, ldt = _array_header.unpack_from(mv,0)
+    pos = _array_header.size
+    dtype = np.dtype(bytes(mv[pos:pos+ldt]).decode('ascii'))
+    pos += ldt
+    shape = struct.unpack_from("<{0}Q".format(ndim), mv, pos)
+    pos += 8*ndim
+    if codec==0:
+        arr = np.frombuffer(mv, dtype=dtype, offset=pos, count=prod(shape))
+    else:
+        if codec not in _codec_functions.keys():
+            msg = "Array was encoded with compression codec id {0}, which is not available (missing optional dependency?)".format(codec)
+            raise ValueError(msg)
+        arr = np.frombuffer(_codec_functions[codec][1](mv[pos:]), dtype=dtype)
+    arr = arr.reshape(shape)
+    return arr.copy() if copy else arr
+
+def choose_compression(arr,codecs=('zlib','lz4'),min_ratio=1.5):
+    """Choose a compression codec for a (representative) array by measurement:
+       returns the fastest codec (among those available) that shrinks the data
+       by at least a factor min_ratio, or None if none manage it (e.g. for
+       random floating point data, which barely compresses)."""
+    raw = len(encode_array(arr))
+    best = None
+    best_time = np.inf
+    for codec in codecs:
+        if array_codecs.get(codec) not in _codec_functions.keys():
+            continue
+        start = time.time()
+        size = len(encode_array(arr,codec))
+        elapsed = time.time() - start
+        if raw/size >= min_ratio and elapsed < best_time:
+            best, best_time = codec, elapsed
+    return best
+
 def adapt_array(arr):
-    """
-    http://stackoverflow.com/a/31312102/190597 (SoulNibbler)
-    """
-    # zlib uses similar disk size that Matlab v5 .mat files
-    # bz2 compress 4 times zlib, but storing process is 20 times slower.
-    out = io.BytesIO()
-    np.save(out, arr)
-    out.seek(0)
-    # Compression didn't seem to make much difference so I turned it off
-    #return sqlite3.Binary(codecs.encode(out.read(),compressor))  # zlib, bz2
-    return sqlite3.Binary(out.read())  # zlib, bz2
+    """Default (uncompressed) sqlite adapter for numpy arrays"""
+    return sqlite3.Binary(encode_array(arr))
 
 def convert_array(text):
-    out = io.BytesIO(text)
-    out.seek(0)
-    #out = io.BytesIO(codecs.decode(out.read(),compressor))
-    return np.load(out)
-
-#def adapt_array(arr):
-#    return arr.tobytes()
-#def convert_array(text):
-#    return np.frombuffer(text)
+    """sqlite converter for "array" columns; reads both current and legacy formats.
+       Returns writable arrays (copies), as np.load did for the legacy format."""
+    return decode_array(text,copy=True)
 
 sqlite3.register_adapter(np.ndarray, adapt_array)    
 sqlite3.register_converter("array", convert_array)
@@ -178,7 +251,7 @@ def print_with_id(d,id_only=False):
     if d is not None:
       out = "{"
       for k,v in d.items():
-        print(v)
+        logger.debug("%s", v)
         out += "{0}: ".format(k)
         if isinstance(v, Mapping):
             out+="{0}".format(print_with_id(v,id_only))
@@ -200,6 +273,8 @@ def convert_to_TF_variables(d):
        if isinstance(val,tf.Variable):
            out[k] = val # Already a Variable, no need to convert
            #print(k, 'was tf.Variable, left alone:', val)
+       elif isinstance(val,tf.Tensor) and val.dtype != TFdtype:
+           out[k] = tf.Variable(tf.cast(val,TFdtype)) # e.g. double precision starting guesses
        elif isinstance(val, Mapping):
            out[k] = convert_to_TF_variables(val) # We must go deeper
        else:
@@ -418,10 +493,10 @@ def squeeze_axis_0(pars):
        Also ensures that dim 0 is consistent size for all bottom-level objects"""
     # Ensure that 2d form is initially used
     pars_2d = atleast_2d(pars)
-    print("pars:", pars)
-    print("pars_2d:",pars_2d)
+    logger.debug("pars: %s", pars)
+    logger.debug("pars_2d: %s", pars_2d)
     size_axis0 = deep_size(pars,axis=0)
-    print("size_axis0:", size_axis0)
+    logger.debug("size_axis0: %s", size_axis0)
     if size_axis0==1:
         out = deep_squeeze(pars,axis=0)
     elif size_axis0==None:
@@ -550,12 +625,26 @@ def deep_minus(a,b):
        TODO: currently doesn't check for extra stuff that might be in b"""
     return a - b
 
+def normal_neg2logL(x,mu,sigma):
+    """-2*log(pdf) of a Normal distribution, as a closed-form expression.
+       Same as -2*tfd.Normal(mu,sigma).log_prob(x), without constructing
+       the distribution object."""
+    sigma = tf.cast(sigma,TFdtype)
+    z = (x - mu) / sigma
+    return z**2 + np.log(2*np.pi) + 2*tf.math.log(sigma)
+
+def poisson_neg2logL(n,rate):
+    """-2*log(pmf) of a Poisson distribution, as a closed-form expression.
+       Same as -2*tfd.Poisson(rate).log_prob(n), without constructing
+       the distribution object."""
+    return -2*(tf.math.xlogy(n,rate) - rate - tf.math.lgamma(n + 1))
+
 def _get_batch_shape(t,tail_shape):
     """Get the batch shape for a single sample component given its event_shape
        Also works for parameter tensors and parameter shapes.
     """
     tdims = rlen(tail_shape)
-    print("tdims:", tdims)
+    logger.debug("tdims: %s", tdims)
     if tdims is 0 or tdims is None:
         batch_shape = t.shape # Everything is batch shape
     elif t.shape[-tdims or None:] != tail_shape:
@@ -577,8 +666,8 @@ def sample_batch_shape(sample,event_shapes):
             eshape = event_shapes[name]
             bshape = _get_batch_shape(x,eshape)
         except ValueError as e:
-            print("x:", x)
-            print("event_shapes:", event_shapes)
+            logger.debug("x: %s", x)
+            logger.debug("event_shapes: %s", event_shapes)
             msg = "Supplied event shape for distribution {0} ({1}) does not match trailing dimensions of sample! ({2})!".format(name,eshape,x.shape)
             raise ValueError(msg) from e
         if batch_shape is None:
@@ -617,7 +706,10 @@ def all_dist_batch_shape(parameters,parameter_shapes):
     batch_shape = None
     for ka,pars in parameters.items():
         this_batch_shape = dist_batch_shape(pars,parameter_shapes[ka])
-        if batch_shape is None: 
+        if this_batch_shape is None:
+            # No parameters for this analysis, nothing to broadcast
+            continue
+        elif batch_shape is None: 
             batch_shape = this_batch_shape
         else:
             try:
@@ -779,13 +871,16 @@ def decat_tensor_to_pars(tensor,par_template,par_shapes,batch_shape):
 @deep()
 def get_parameter_indices(shape):
     """Returns flattened list of stringified indices given nested dictionaries of array shapes""" 
-    npars = prod(shape)
-    index_strings = ["" for i in range(npars)]
-    all_indices = np.indices(shape)
-    for dim_indices in all_indices:
-        for i,index in enumerate(dim_indices.flatten()):
-            index_strings[i] += "_{0}".format(index)
-    return index_strings
+    return list(_parameter_index_strings(tuple(int(d) for d in shape)))
+
+@lru_cache(maxsize=None)
+def _parameter_index_strings(shape):
+    """Stringified indices (e.g. '_0_2') of all elements of an array of the given
+       shape, in flattened (C) order. Memoised, since parameter shapes are few."""
+    if len(shape)==0:
+        return ("",)
+    all_indices = np.indices(shape).reshape(len(shape),-1).T
+    return tuple("".join("_{0}".format(i) for i in index) for index in all_indices)
 
 def prod(iterable,initializer=1):
     """Take product of all elements"""
@@ -0,0 +1,186 @@
+"""Importance sampling of pseudo-data from JointDistribution objects, for
+   efficient estimation of small tail probabilities (e.g. p-values at the
+   5 sigma level), plus weighted estimators to use with the resulting
+   weighted samples.
+
+   Proposal distributions are the same JointDistribution but with shifted
+   'interest' parameters. Shifts are specified in the scaled parameter space
+   used internally by the analyses (in which MLEs have variance of about 1),
+   so that a shift of 'bias' means roughly 'bias' sigma in every analysis,
+   whatever its type. For the Normal, MultivariateNormal and Poisson
+   components used by the analyses, shifting the mean/rate parameters in
+   this way is exactly an exponential tilting of the sampling distribution.
+   A 'defensive' fraction of samples is drawn from the nominal distribution,
+   and weights are computed against the full mixture, which keeps the
+   weights bounded (by 1/defensive).
+"""
+
+import numpy as np
+import tensorflow as tf
+from . import rng
+
+def effective_sample_size(logw,axis=0):
+    """Kish effective sample size, (sum w)^2 / sum(w^2), from log weights"""
+    logw = np.asarray(logw,dtype=np.float64)
+    empty = np.all(np.isneginf(logw),axis=axis)
+    # Replace all -inf slices by zeros so that no log(0) or inf-inf is evaluated
+    safe = np.where(np.expand_dims(empty,axis),0.,logw)
+    return np.where(empty,0.,np.exp(2*_logsumexp(safe,axis) - _logsumexp(2*safe,axis)))
+
+def _logsumexp(x,axis=0):
+    m = np.max(x,axis=axis,keepdims=True)
+    m = np.where(np.isfinite(m),m,0)
+    return np.squeeze(m,axis=axis) + np.log(np.sum(np.exp(x - m),axis=axis))
+
+def weighted_eCDF(t,logw,self_normalise=False):
+    """Weighted empirical CDF of test statistic values t (first dimension is
+       the sample dimension), with importance weights exp(logw).
+       Returns (t_sorted, cdf) where cdf[i] estimates Pr(t <= t_sorted[i]) under
+       the nominal distribution. Without self-normalisation the estimate is
+       unbiased but need not end exactly at 1."""
+    t = np.asarray(t)
+    w = np.exp(np.broadcast_to(np.asarray(logw,dtype=np.float64),t.shape))
+    order = np.argsort(t,axis=0)
+    t_sorted = np.take_along_axis(t,order,axis=0)
+    cdf = np.cumsum(np.take_along_axis(w,order,axis=0),axis=0)
+    norm = cdf[-1] if self_normalise else t.shape[0]
+    return t_sorted, cdf / norm
+
+def weighted_pvalue(t,logw,t_obs,self_normalise=False):
+    """Importance-sampling estimate of the p-value Pr(t >= t_obs) under the
+       nominal distribution, from test statistic values t (first dimension is
+       the sample dimension) of samples with log weights logw.
+
+       Returns (p, err, ess), where err is the estimated standard error of p,
+       and ess is the effective sample size of the samples falling in the
+       tail (t >= t_obs), which is the relevant diagnostic for the reliability
+       of the estimate (it should not be too small, say > 100).
+    """
+    t = np.asarray(t)
+    logw = np.broadcast_to(np.asarray(logw,dtype=np.float64),t.shape)
+    N = t.shape[0]
+    tail = t >= t_obs
+    w = np.exp(logw)
+    wI = np.where(tail,w,0)
+    if self_normalise:
+        sumw = np.sum(w,axis=0)
+        p = np.sum(wI,axis=0) / sumw
+        err = np.sqrt(np.sum(w**2 * (tail - p)**2,axis=0)) / sumw
+    else:
+        p = np.mean(wI,axis=0)
+        err = np.std(wI,axis=0) / np.sqrt(N)
+    ess = effective_sample_size(np.where(tail,logw,-np.inf))
+    return p, err, ess
+
+class ImportanceSampler:
+    """Draw samples from a mixture of shifted-parameter proposal distributions
+       for a JointDistribution, along with the log importance weights needed to
+       recover expectations under the original (nominal) distribution.
+
+       :param joint: The nominal JointDistribution (must have parameters).
+       :param bias: Shift, in units of the scaled parameters (roughly 'sigma'),
+               to apply along 'shift'. A list gives a mixture of proposals with
+               each shift, in equal proportions.
+       :param shift: Direction of the shift, as a dictionary {analysis: {par: direction}}
+               of values (broadcastable against the parameters) in scaled
+               parameter units. Default is +1 for all interest parameters of
+               all analyses.
+       :param defensive: Fraction of samples drawn from the nominal distribution.
+       :param seed: Seed for the random allocation of samples to mixture components.
+    """
+
+    def __init__(self,joint,bias=1.,shift=None,defensive=0.1,seed=None):
+        if joint.pars is None:
+            msg = "ImportanceSampler requires a JointDistribution with parameters to sample from"
+            raise ValueError(msg)
+        if not 0 <= defensive <= 1:
+            msg = "'defensive' mixture fraction must be between 0 and 1 (got {0})".format(defensive)
+            raise ValueError(msg)
+        self.joint = joint
+        self.defensive = defensive
+        if shift is None:
+            interest, fixed, nuisance = joint.decomposed_parameter_shapes()
+            shift = {ka: {kp: 1. for kp in a.keys()} for ka,a in interest.items()}
+        self.shift = shift
+        self.rng = np.random.default_rng(seed)
+        self.set_bias(bias)
+
+    def set_bias(self,bias):
+        """Set the shift(s) for the proposal distributions, and rebuild them"""
+        self.bias = list(np.atleast_1d(bias))
+        self.proposals = [self.shifted_joint(b) for b in self.bias]
+
+    def shifted_joint(self,bias):
+        """JointDistribution with interest parameters shifted by bias*shift (in scaled units)"""
+        pars = {}
+        for ka,a in self.joint.pars.items():
+            pars[ka] = {}
+            for kp,p in a.items():
+                if kp in self.shift.get(ka,{}).keys():
+                    pars[ka][kp] = p + bias*tf.cast(self.shift[ka][kp],p.dtype)
+                else:
+                    pars[ka][kp] = p
+        return type(self.joint)(self.joint.analyses.values(),pars,pre_scaled_pars=True)
+
+    def mixture_weights(self):
+        """Mixture fractions for (nominal, proposal_1, proposal_2, ...)"""
+        n = len(self.proposals)
+        return np.array([self.defensive] + [(1-self.defensive)/n]*n)
+
+    def log_weights(self,samples):
+        """log(p(x)/q(x)) for samples x, where p is the nominal distribution and q the
+           full proposal mixture (including the defensive component)"""
+        log_p = self.joint.log_prob(samples)
+        terms = []
+        for frac, dist in zip(self.mixture_weights(),[self.joint] + self.proposals):
+            if frac > 0:
+                terms += [np.log(frac) + (log_p if dist is self.joint else dist.log_prob(samples))]
+        log_q = tf.reduce_logsumexp(tf.stack(terms,axis=0),axis=0)
+        return log_p - log_q
+
+    def sample(self,N,seed=None):
+        """Draw N samples from the proposal mixture. Returns (samples, logw).
+           If a stateless seed is given (e.g. from rng.chunk_seed) then the
+           result depends only on that seed; otherwise the sampler's own
+           random state and the global TensorFlow random state are used."""
+        N = int(N)
+        if N == 0:
+            # No components are drawn from, so there is nothing to concatenate
+            samples = self.joint.sample(0)
+            return samples, self.log_weights(samples)
+        if seed is None:
+            choice_rng = self.rng
+            seeds = [None]*(len(self.proposals)+1)
+        else:
+            choice_rng = rng.numpy_rng(rng.chunk_seed(seed,0,"mixture"))
+            seeds = [rng.chunk_seed(seed,k,"component") for k in range(len(self.proposals)+1)]
+        counts = choice_rng.multinomial(N,self.mixture_weights())
+        parts = [dist.sample(n,seed=s) for n,dist,s in zip(counts,[self.joint] + self.proposals,seeds) if n > 0]
+        samples = {k: tf.concat([p[k] for p in parts],axis=0) for k in parts[0].keys()}
+        # Shuffle, so that any subset of the samples is also a valid draw from the mixture
+        perm = choice_rng.permutation(N)
+        samples = {k: tf.gather(v,perm,axis=0) for k,v in samples.items()}
+        return samples, self.log_weights(samples)
+
+    def tune(self,test_statistic,t_obs,biases=None,N_pilot=1000,verbose=False):
+        """Choose the proposal shift that minimises the estimated relative error of
+           the p-value for observed test statistic t_obs, using pilot runs of N_pilot
+           samples for each candidate shift in 'biases'. test_statistic should be a
+           function mapping samples to test statistic values (larger values being
+           more extreme). The best shift is set on this object and returned, along
+           with the relative errors for all candidates."""
+        if biases is None:
+            biases = np.linspace(0,6,13)
+        rel_errs = []
+        for b in biases:
+            self.set_bias(b)
+            samples, logw = self.sample(N_pilot)
+            t = test_statistic(samples)
+            p, err, ess = weighted_pvalue(np.asarray(t),np.asarray(logw),t_obs)
+            rel_err = np.max(np.where(p>0,err/np.where(p>0,p,1),np.inf))
+            rel_errs += [rel_err]
+            if verbose:
+                print("ImportanceSampler.tune: bias={0}, p={1}, rel. err={2}, tail ESS={3}".format(b,p,rel_err,ess))
+        best = biases[int(np.argmin(rel_errs))]
+        self.set_bias(best)
+        return best, np.array(rel_errs)
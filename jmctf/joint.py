@@ -8,14 +8,24 @@ from collections.abc import Mapping
 import contextlib
 import time
 import functools
+import concurrent.futures
 import massminimize as mm
 from . import common as c
+from .block_matrix import BlockMatrix, Cholesky, BlockCholesky
+from .reductions import BestFitReducer
+from .importance import ImportanceSampler
+from . import rng
+from . import telemetry
+from . import log
+from .parameters import ParameterLayout, get_layout, layout_key
 
 import traceback
 
 #tmp
 id_only = False
 
+logger = log.get_logger(__name__)
+
 #===================
 # Helper functions for optimizer test replacement
 # From examples at https://www.tensorflow.org/probability/examples/Optimizers_in_TensorFlow_Probability
@@ -41,11 +51,26 @@ def run(optimizer):
   return np_value(result)
 
 @contextlib.contextmanager
-def timed_execution():
+def timed_execution(name="run"):
   t0 = time.time()
-  yield
+  with telemetry.stage(name):
+    yield
   dt = time.time() - t0
   print('Evaluation took: %f seconds' % dt)
+
+def _n_samples(samples):
+  """Number of events along the first (sample) dimension of a samples
+     dictionary, for throughput telemetry"""
+  flat = tf.nest.flatten(samples)
+  if len(flat)==0 or len(flat[0].shape)==0:
+    return 1
+  return int(flat[0].shape[0])
+
+def _fit_iterations(fit_info):
+  """Total optimizer iterations recorded in a fit_info dictionary"""
+  if "analyses" in fit_info.keys():
+    return sum(_fit_iterations(a) for a in fit_info["analyses"].values())
+  return int(fit_info.get("iterations",0))
 #=================
 
 def combine_pars(pars1,pars2=None):
@@ -118,23 +143,491 @@ def neg2logL(pars,const_pars,analyses,data,transform=None):
     #quit()
     return total_loss, q, joint.descale_pars(all_pars), None
 
-def optimize(pars,const_pars,analyses,data,transform=None,log_tag='',verbose=False,force_numerical=False):
+class Neg2LogLEngine:
+    """Compiled version of neg2logL, built once per set of analyses.
+
+       neg2logL constructs a new JointDistribution (running prepare_pars,
+       tensorflow_model etc. for every analysis) on every call, which is
+       pure Python overhead when called at every step of an optimizer.
+       Here the same calculation is traced into a tf.function instead, with
+       an input signature fixed to the flattened parameter/sample tensors.
+       One concrete function is kept per input structure (parameter names,
+       shapes and dtypes), so repeated fits with the same structure re-use
+       the same graph across all iterations and across calls to 'optimize'.
+
+       Like the Hessian calculation, the graph skips the JointDistribution
+       object and sums the log_prob of the component distributions of each
+       analysis directly.
+
+       Parameters must be supplied pre-scaled, as for neg2logL.
+    """
+
+    def __init__(self, analyses):
+        """
+        :param analyses: dictionary of analysis-like objects, keyed by analysis name
+        :type analyses: dict
+        """
+        self.analyses = analyses
+        self.state = {name: _analysis_state(a) for name,a in analyses.items()}
+        self.functions = {} # Compiled functions, keyed by input structure
+        self.jit_compile_profiled = True # Use XLA to fuse the closed-form profiled fits
+
+    def is_current(self, analyses):
+        """Check that this engine was built for exactly these analysis objects,
+           and that none of their attributes have been reassigned since"""
+        return (list(analyses.keys())==list(self.analyses.keys())
+                and all(analyses[k] is a and _same_state(_analysis_state(a),self.state[k]) for k,a in self.analyses.items()))
+
+    def _neg2logL(self, pars, const_pars, data):
+        """Body of the compiled function. Mirrors neg2logL."""
+        all_pars = combine_pars(pars, const_pars)
+        q = 0
+        descaled_pars = {}
+        for a in self.analyses.values():
+            a_pars = a.add_default_nuisance(all_pars[a.name])
+            d = c.add_prefix(a.name,a.tensorflow_model(a_pars))
+            for dist_name, dist in d.items():
+                q += dist.log_prob(data[dist_name])
+            descaled_pars[a.name] = a.descale_pars(a_pars)
+        q = -2*q
+        total_loss = tf.math.reduce_sum(q)
+        return total_loss, q, descaled_pars, None
+
+    def get_function(self, structure, relax_batch_dim=False):
+        """Retrieve (or trace) the compiled function matching the structure of
+           the supplied (pars, const_pars, data) tuple.
+           If relax_batch_dim is True, the leading dimension of all inputs is
+           left unspecified in the signature, so that inputs whose batch has
+           been flattened to a single axis can change size without retracing."""
+        return self._get_compiled("neg2logL", self._neg2logL, structure, relax_batch_dim)
+
+    def _get_compiled(self, tag, body, structure, relax_batch_dim=False, jit_compile=False):
+        """Retrieve (or trace) a compiled version of 'body', with input signature
+           fixed to the flattened structure of its arguments (a tuple)"""
+        flat = tf.nest.flatten(structure)
+        layout = str(tf.nest.map_structure(lambda t: 0, structure)) # Captures the dictionary keys
+        shapes = [t.shape.as_list() for t in flat]
+        if relax_batch_dim:
+            shapes = [[None] + s[1:] if len(s)>0 else s for s in shapes]
+        key = (tag, layout) + tuple((tuple(s), t.dtype.name) for s,t in zip(shapes,flat))
+        if key not in self.functions:
+            signature = [tf.TensorSpec(shape=s, dtype=t.dtype) for s,t in zip(shapes,flat)]
+            def flat_body(*flat_args):
+                telemetry.count_trace(tag) # Python body only runs when (re)tracing
+                return body(*tf.nest.pack_sequence_as(structure, list(flat_args)))
+            self.functions[key] = tf.function(flat_body, input_signature=signature, jit_compile=jit_compile)
+        return self.functions[key]
+
+    def _profiled_neg2logL(self, samples, fixed_pars, nuisance_only):
+        """Body of the compiled closed-form fit. Sums the 'profiled_neg2logL'
+           kernels of all analyses."""
+        q = 0
+        fitted_pars = {}
+        const_pars = {}
+        for a in self.analyses.values():
+            a_q, a_fitted, a_const = a.profiled_neg2logL(samples[a.name], fixed_pars[a.name], nuisance_only)
+            q += a_q
+            fitted_pars[a.name] = c.convert_to_TF_constants(a_fitted)
+            const_pars[a.name] = c.convert_to_TF_constants({p: v for p,v in a_const.items() if p not in a_fitted.keys()})
+        return q, fitted_pars, const_pars
+
+    def profiled_neg2logL(self, samples, fixed_pars, nuisance_only=True):
+        """Closed-form fit for analyses that all provide exact 'profiled_neg2logL'
+           kernels (see JointDistribution.fit_profiled). The kernels (including
+           the computation of the MLEs) are compiled together into one function,
+           with XLA if jit_compile_profiled is True, so that they run as fused
+           tensor arithmetic.
+
+           fixed_pars are non-scaled. Returns -2logL, and the (non-scaled) fitted
+           and fixed parameters for each analysis.
+        """
+        a_samples = {}
+        a_fixed_pars = {}
+        for a in self.analyses.values():
+            # Broadcasting helpers are not graph-compatible, so do this part eagerly
+            s = c.convert_to_TF_constants(c.remove_prefix(a.name,{k: v for k,v in samples.items() if k.startswith("{0}::".format(a.name))}))
+            if nuisance_only:
+                if a.name not in fixed_pars:
+                    msg = "No fixed parameters supplied for analysis {0} during nuisance parameter fit! To fit only the nuisance parameters, fixed values for all non-nuisance parameters need to be provided".format(a.name)
+                    raise ValueError(msg)
+                a_fixed_pars[a.name], a_samples[a.name] = a.bcast_parameters_samples(c.convert_to_TF_constants(fixed_pars[a.name]),s)
+            else:
+                a_fixed_pars[a.name], a_samples[a.name] = c.convert_to_TF_constants(fixed_pars.get(a.name,{})), s
+        body = lambda samples, fixed_pars: self._profiled_neg2logL(samples, fixed_pars, nuisance_only)
+        tag = "profiled_nuisance" if nuisance_only else "profiled_all"
+        f = self._get_compiled(tag, body, (a_samples, a_fixed_pars), jit_compile=self.jit_compile_profiled)
+        return f(*tf.nest.flatten((a_samples, a_fixed_pars)))
+
+    def __call__(self, pars, const_pars, data, relax_batch_dim=False):
+        """Evaluate -2logL. Same signature and output as neg2logL (minus the
+           analyses, which are fixed for this object).
+
+           pars may contain TensorFlow Variables; gradients with respect to
+           them flow through the compiled function as normal.
+           See get_function for relax_batch_dim."""
+        # Restrict inputs to the analyses known to this engine, and make sure
+        # constants and samples are TensorFlow objects of the right type
+        pars = c.convert_to_TF_constants({a: pars.get(a,{}) for a in self.analyses.keys()},ignore_variables=True)
+        const_pars = c.convert_to_TF_constants({a: const_pars.get(a,{}) for a in self.analyses.keys()},ignore_variables=True)
+        data = c.convert_to_TF_constants(data)
+        structure = (pars, const_pars, data)
+        f = self.get_function(structure, relax_batch_dim)
+        return f(*tf.nest.flatten(structure))
+
+def _analysis_state(a):
+    """Snapshot of the attributes of an analysis, used to detect when they are
+       reassigned after a -2logL engine was traced from them"""
+    return tuple((k, v) for k,v in vars(a).items() if k!="_neg2logL_engines")
+
+def _same_state(state1, state2):
+    return len(state1)==len(state2) and all(k1==k2 and v1 is v2 for (k1,v1),(k2,v2) in zip(state1,state2))
+
+def get_neg2logL_engine(analyses):
+    """Retrieve the compiled -2logL engine for this set of analyses, building
+       it if it does not yet exist.
+
+       Engines are stored on the first analysis of the set, so they (and the
+       graphs traced for them) are released together with the analyses. An
+       engine is rebuilt if any attribute of its analyses has been reassigned
+       since it was traced; in-place modifications (e.g. of numpy arrays) are
+       not detected, call clear_neg2logL_engines after making those."""
+    analyses = dict(analyses)
+    first = next(iter(analyses.values()))
+    engines = first.__dict__.setdefault("_neg2logL_engines", {})
+    key = tuple(analyses.keys())
+    engine = engines.get(key)
+    if engine is None or not engine.is_current(analyses):
+        engine = Neg2LogLEngine(analyses)
+        engines[key] = engine
+    return engine
+
+def clear_neg2logL_engines(analyses):
+    """Discard the cached -2logL engines (and the graphs compiled for them)
+       stored on these analyses"""
+    for a in dict(analyses).values():
+        a.__dict__.pop("_neg2logL_engines", None)
+
+def minimize_mm(free_pars,f,analyses,opts):
+    """Optimizer backend using the massminimize package (gradient descent
+       with Adam etc.). All samples in the batch are iterated until the whole
+       batch meets the tolerance."""
+    mm_opts = {k: v for k,v in opts.items() if k in mm_option_names}
+    q, final_pars, null = mm.optimize(free_pars, f, **mm_opts)
+    fit_info = {"optimizer": opts["optimizer"]}
+    return q, final_pars, fit_info
+
+def minimize_quasi_newton(free_pars,f,analyses,opts):
+    """Optimizer backend using the batched quasi-Newton minimizers of
+       tensorflow_probability (L-BFGS or BFGS).
+
+       Each sample is an independent minimisation problem. All free parameters
+       are broadcast to the batch shape of the -2logL output and stacked into
+       a single (n_problems, n_pars) tensor, whose rows the tfp minimizers
+       treat as independent batch members with their own convergence
+       criteria. By default the optimizer stops once every batch member has
+       converged ('converged_all'); per-sample convergence and failure masks
+       are returned in the fit_info dictionary.
+    """
+    # Infer the batch shape of the minimisation problems from the initial -2logL values
+    total_loss, q0, pars0, null = f(free_pars)
+    batch_shape = tuple(q0.shape)
+    if all(len(a)==0 for a in free_pars.values()):
+        # Nothing to optimise (e.g. all parameters were moved to the 'const' category)
+        fit_info = {"optimizer": opts["optimizer"],
+                    "converged": tf.ones(batch_shape,dtype=tf.bool),
+                    "failed": tf.zeros(batch_shape,dtype=tf.bool),
+                    "iterations": 0,
+                    "objective_evaluations": 1}
+        return q0, pars0, fit_info
+    par_shapes = {a: analyses[a].parameter_shapes() for a in free_pars.keys()}
+    bcast_pars = c.bcast_all_dist_batch_shape(c.convert_to_TF_constants(free_pars,ignore_variables=True),par_shapes,batch_shape)
+    layout = get_layout(free_pars,par_shapes)
+    x0, x_batch_shape = layout.pack(bcast_pars)
+
+    def value_and_gradients(x):
+        def neg2logL_flat(x):
+            pars = layout.unpack(x,batch_shape)
+            total_loss, q, all_pars, null = f(pars)
+            return tf.reshape(q,[-1])
+        return tfp.math.value_and_gradient(neg2logL_flat, x)
+
+    if opts["optimizer"]=="LBFGS":
+        minimizer = functools.partial(tfp.optimizer.lbfgs_minimize, num_correction_pairs=opts["num_correction_pairs"])
+    else:
+        minimizer = tfp.optimizer.bfgs_minimize
+    stopping_conditions = {"converged_all": tfp.optimizer.converged_all,
+                           "converged_any": tfp.optimizer.converged_any}
+
+    # Note: the minimizer loop (including the line search) runs eagerly; only
+    # the -2logL evaluation is compiled, by Neg2LogLEngine. Wrapping the loop
+    # in a tf.function per fit costs several seconds of tracing every time,
+    # which outweighs the per-iteration Python overhead saved except for very
+    # large batches.
+    results = minimizer(value_and_gradients,
+                        initial_position=x0,
+                        tolerance=opts["grad_tol"],
+                        f_absolute_tolerance=opts["tol"],
+                        max_iterations=opts["max_it"],
+                        max_line_search_iterations=opts["max_line_search_it"],
+                        stopping_condition=stopping_conditions[opts["stopping_condition"]])
+    if logger.isEnabledFor(log.DEBUG): # Avoid the reductions when not logging
+        logger.debug("%s: %d iterations, %d objective evaluations, %d of %d problems converged, %d failed",
+                     opts["optimizer"],results.num_iterations,results.num_objective_evaluations,
+                     tf.math.reduce_sum(tf.cast(results.converged,tf.int32)),results.converged.shape[0],
+                     tf.math.reduce_sum(tf.cast(results.failed,tf.int32)))
+
+    final_free_pars = layout.unpack(results.position,batch_shape)
+    total_loss, q, final_pars, null = f(final_free_pars)
+    fit_info = {"optimizer": opts["optimizer"],
+                "converged": tf.reshape(results.converged,batch_shape),
+                "failed": tf.reshape(results.failed,batch_shape),
+                "iterations": int(results.num_iterations),
+                "objective_evaluations": int(results.num_objective_evaluations)}
+    return q, final_pars, fit_info
+
+def minimize_active_set(minimize,free_pars,const_pars,data,loss_f,analyses,opts):
+    """Run an optimizer backend on a shrinking 'active set' of samples.
+
+       Fits are done in rounds of at most opts["active_set_it"] iterations.
+       Before each round the samples whose fits have not yet converged are
+       gathered, along with their free and fixed parameters, into a compact
+       batch, so that late rounds cost in proportion to the number of
+       unconverged fits rather than the full number of samples. The results
+       of each round are scattered back into the full batch.
+
+       Convergence of each sample is taken from the 'converged' and 'failed'
+       masks of the backend where it provides them, and otherwise from the
+       change in -2logL over the round being smaller than opts["tol"].
+
+       To make the gathering simple, the batch dimensions of all parameters
+       and samples are broadcast against each other and flattened to a single
+       axis. Batches smaller than opts["active_set_min_size"] are passed
+       straight to the backend.
+
+       Note that the backend is restarted from the current parameter values
+       every round, so optimizer state (Adam moments, L-BFGS correction pairs)
+       is not carried between rounds, and for backends without convergence
+       masks (Adam) a sample counts as converged once -2logL moves by less
+       than opts["tol"] in one round. Results can therefore differ from a
+       single full-batch fit, which is why this is opt-in.
+    """
+    total_loss, q0, pars0, null = loss_f(free_pars,const_pars,data)
+    batch_shape = tuple(q0.shape)
+    M = c.prod(batch_shape)
+    if M < opts["active_set_min_size"] or all(len(a)==0 for a in free_pars.values()):
+        f = mm.tools.func_partial(loss_f,const_pars=const_pars,data=data)
+        return minimize(free_pars, f, analyses, opts)
+
+    par_shapes = {a: analyses[a].parameter_shapes() for a in analyses.keys()}
+    event_shapes = {}
+    for a in analyses.values():
+        event_shapes.update(c.add_prefix(a.name,a.event_shapes()))
+
+    def flatten_pars(pars):
+        pars = c.bcast_all_dist_batch_shape(c.convert_to_TF_constants(pars,ignore_variables=True),par_shapes,batch_shape)
+        return {ka: {kp: tf.reshape(p,[M]+list(par_shapes[ka][kp])) for kp,p in a.items()} for ka,a in pars.items()}
+
+    flat_free = flatten_pars(free_pars)
+    flat_const = flatten_pars(const_pars)
+    data = c.convert_to_TF_constants({k: x for k,x in data.items() if k in event_shapes.keys()})
+    flat_data = {k: tf.reshape(x,[M]+list(event_shapes[k])) for k,x in c.bcast_sample_batch_shape(data,event_shapes,batch_shape).items()}
+
+    q = tf.reshape(q0,[M])
+    converged = tf.zeros([M],dtype=tf.bool)
+    failed = tf.zeros([M],dtype=tf.bool)
+    active = tf.range(M)
+    gather = lambda d: tf.nest.map_structure(lambda x: tf.gather(x,active), d)
+    scatter = lambda d,new: tf.nest.map_structure(lambda x,y: tf.tensor_scatter_nd_update(x,active[:,tf.newaxis],y), d, new)
+
+    round_opts = dict(opts)
+    n_rounds = int(np.ceil(opts["max_it"] / opts["active_set_it"]))
+    active_set_sizes = []
+    iterations = 0
+    for i in range(n_rounds):
+        round_opts["max_it"] = min(opts["active_set_it"], opts["max_it"] - i*opts["active_set_it"])
+        active_set_sizes += [int(active.shape[0])]
+        if opts["verbose"]: print("Active set round {0}: fitting {1} of {2} samples".format(i,active.shape[0],M))
+
+        # Samples change size every round, so the compiled -2logL is traced with a free leading dimension
+        f = mm.tools.func_partial(loss_f,const_pars=gather(flat_const),data=gather(flat_data),relax_batch_dim=True)
+        q_active, pars_active, fit_info = minimize(c.convert_to_TF_variables(gather(flat_free)), f, analyses, round_opts)
+
+        # Fitted parameters come back de-scaled; re-scale the free ones as
+        # starting points for the next round
+        new_free = {}
+        for ka,a in flat_free.items():
+            scaled = analyses[ka].scale_pars(pars_active[ka])
+            new_free[ka] = {kp: tf.reshape(scaled[kp],[-1]+list(par_shapes[ka][kp])) for kp in a.keys()}
+        q_active = tf.reshape(q_active,[-1])
+        if "converged" in fit_info.keys():
+            c_active = tf.reshape(fit_info["converged"],[-1])
+            f_active = tf.reshape(fit_info["failed"],[-1])
+        else:
+            c_active = tf.abs(q_active - tf.gather(q,active)) < opts["tol"]
+            f_active = tf.zeros_like(c_active)
+        iterations += fit_info.get("iterations",round_opts["max_it"])
+
+        flat_free = scatter(flat_free,new_free)
+        q = tf.tensor_scatter_nd_update(q,active[:,tf.newaxis],q_active)
+        converged = tf.tensor_scatter_nd_update(converged,active[:,tf.newaxis],c_active)
+        failed = tf.tensor_scatter_nd_update(failed,active[:,tf.newaxis],f_active)
+        active = tf.boolean_mask(active,~(c_active | f_active))
+        if active.shape[0]==0: break
+
+    # Final evaluation in the original (un-flattened) layout, so that output
+    # parameters broadcast in the same way as for a direct fit
+    final_free = {ka: {kp: tf.reshape(p,list(batch_shape)+list(par_shapes[ka][kp])) for kp,p in a.items()} for ka,a in flat_free.items()}
+    total_loss, q, final_pars, null = loss_f(final_free,const_pars,data)
+    fit_info = {"optimizer": opts["optimizer"],
+                "converged": tf.reshape(converged,batch_shape),
+                "failed": tf.reshape(failed,batch_shape),
+                "iterations": iterations,
+                "active_set_sizes": tuple(active_set_sizes)}
+    return q, final_pars, fit_info
+
+def minimize_batch(minimize,free_pars,const_pars,data,loss_f,analyses,opts):
+    """Run an optimizer backend on the whole batch of samples, with or without
+       active set compaction (see minimize_active_set) depending on opts"""
+    if opts["active_set_it"] is not None:
+        return minimize_active_set(minimize, free_pars, const_pars, data, loss_f, analyses, opts)
+    else:
+        f = mm.tools.func_partial(loss_f,const_pars=const_pars,data=data)
+        return minimize(free_pars, f, analyses, opts)
+
+def minimize_decomposed(minimize,free_pars,const_pars,data,analyses,opts):
+    """Fit each analysis separately, and recombine the results.
+
+       Parameters are always specific to one analysis, and the joint -2logL
+       is just the sum of the -2logL of each analysis, so the joint fit
+       separates into independent fits for each analysis. Fitting them
+       separately lets each one run with its own convergence criterion and
+       its own compiled -2logL, so the total cost is the sum of the
+       per-analysis costs rather than the cost of the slowest fit times the
+       number of analyses. Analyses with no free parameters (e.g. those with
+       exact MLEs) are just evaluated once.
+
+       If opts["threads"] > 1 the fits are run in a thread pool.
+       fit_info contains the fit_info of each analysis under "analyses",
+       plus joint 'converged'/'failed' masks where the backend provides them.
+    """
+    def fit_analysis(name):
+        a_analyses = {name: analyses[name]}
+        engine = get_neg2logL_engine(a_analyses)
+        loss_f = lambda pars,const_pars,data,relax_batch_dim=False: engine(pars,const_pars,data,relax_batch_dim)
+        a_free_pars = {name: free_pars.get(name,{})}
+        a_const_pars = {name: const_pars.get(name,{})}
+        a_data = {k: x for k,x in data.items() if k.startswith("{0}::".format(name))}
+        a_opts = dict(opts, log_tag="{0}_{1}".format(opts["log_tag"],name)) if opts["log_tag"] else opts # Separate logs per analysis
+        if len(a_free_pars[name])==0:
+            total_loss, q, final_pars, null = loss_f(a_free_pars,a_const_pars,a_data)
+            fit_info = {"optimizer": None}
+        else:
+            q, final_pars, fit_info = minimize_batch(minimize, a_free_pars, a_const_pars, a_data, loss_f, a_analyses, a_opts)
+        return q, final_pars, fit_info
+
+    names = list(analyses.keys())
+    if opts["threads"] > 1:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=opts["threads"]) as executor:
+            results = list(executor.map(fit_analysis, names))
+    else:
+        results = [fit_analysis(name) for name in names]
+
+    q = 0
+    final_pars = {}
+    fit_info = {"optimizer": opts["optimizer"], "analyses": {}}
+    for name, (a_q, a_pars, a_fit_info) in zip(names, results):
+        q += a_q
+        final_pars.update(a_pars)
+        fit_info["analyses"][name] = a_fit_info
+    masks = [a_fit_info for a_fit_info in fit_info["analyses"].values() if "converged" in a_fit_info.keys()]
+    if len(masks)>0:
+        fit_info["converged"] = functools.reduce(tf.math.logical_and, [m["converged"] for m in masks]) & tf.ones(q.shape,dtype=tf.bool)
+        fit_info["failed"] = functools.reduce(tf.math.logical_or, [m["failed"] for m in masks]) | tf.zeros(q.shape,dtype=tf.bool)
+    return q, final_pars, fit_info
+
+# Options understood by massminimize
+mm_option_names = ["optimizer","step","tol","grad_tol","max_it","max_same","log_tag","verbose"]
+
+# Default options for 'optimize' that apply to all optimizer backends.
+# "decompose": fit each analysis separately (see minimize_decomposed)
+# "threads": number of threads to use for the separate fits
+common_optimizer_defaults = {"decompose": False,
+                             "threads": 1}
+
+# Available optimizer backends for 'optimize', and their default options.
+# All backends take arguments (free_pars, f, analyses, opts) and return
+# (q, final_pars, fit_info). Setting "active_set_it" to a number of
+# iterations enables the active set compaction of minimize_active_set (off
+# by default, since it restarts the optimizer every round). Backend defaults override
+# common_optimizer_defaults.
+optimizer_backends = {"Adam":  minimize_mm,
+                      "LBFGS": minimize_quasi_newton,
+                      "BFGS":  minimize_quasi_newton}
+
+optimizer_defaults = {"Adam":  {"step": 0.05,
+                                "tol": 0.01,
+                                "grad_tol": 1e-4,
+                                "max_it": 100,
+                                "active_set_it": None,
+                                "active_set_min_size": 1000,
+                                "max_same": 5},
+                      "LBFGS": {"tol": 1e-3,
+                                "grad_tol": 1e-3,
+                                "max_it": 100,
+                                "active_set_it": None,
+                                "active_set_min_size": 1000,
+                                "max_line_search_it": 20,
+                                "num_correction_pairs": 10,
+                                "stopping_condition": "converged_all"},
+                      "BFGS":  {"tol": 1e-3,
+                                "grad_tol": 1e-3,
+                                "max_it": 100,
+                                "active_set_it": None,
+                                "active_set_min_size": 1000,
+                                "max_line_search_it": 20,
+                                "stopping_condition": "converged_all"}
+                     }
+
+@telemetry.timed("optimize", items=lambda pars,const_pars,analyses,data,*args,**kwargs: _n_samples(data))
+def optimize(pars,const_pars,analyses,data,transform=None,log_tag='',verbose=False,force_numerical=False,optimizer="Adam",optimizer_options=None,build_joint=True):
     """Wrapper for optimizer step that skips it if the initial guesses are known
-       to be exact MLEs"""
-    opts = {"optimizer": "Adam",
-            "step": 0.05,
-            "tol": 0.01,
-            "grad_tol": 1e-4,
-            "max_it": 100,
-            "max_same": 5,
+       to be exact MLEs
+
+       The optimizer backend is selected by name from 'optimizer_backends'
+       ("Adam" for massminimize, or "LBFGS"/"BFGS" for the batched tfp
+       quasi-Newton minimizers). 'optimizer_options' can be used to override
+       entries of the default options for that backend (see 'optimizer_defaults').
+       Diagnostic information from the optimizer (e.g. per-sample convergence
+       masks) is attached to the returned JointDistribution as the 'fit_info'
+       attribute.
+       If the "active_set_it" option is set (it is None by default), the fit
+       is run in rounds that drop already-converged samples from the batch
+       being optimised (see minimize_active_set).
+       If the "decompose" option is True (default False), each analysis is
+       fitted separately (see minimize_decomposed).
+       If build_joint is False the fitted JointDistribution is not constructed,
+       and None is returned in its place.
+    """
+    if optimizer not in optimizer_backends.keys():
+        msg = "Unknown optimizer '{0}' requested! Available optimizers are: {1}".format(optimizer,list(optimizer_backends.keys()))
+        raise ValueError(msg)
+    opts = {"optimizer": optimizer,
+            **common_optimizer_defaults,
+            **optimizer_defaults[optimizer],
             "log_tag": log_tag,
             "verbose": verbose 
             }
-
-    kwargs = {'analyses': analyses,
-              'data': data,
-              'transform': transform
-              }
+    if optimizer_options is not None:
+        opts.update(optimizer_options)
+
+    # Use the compiled -2logL engine unless a parameter transform is required
+    # (not supported by the engine). Data is an explicit argument so that
+    # subsets of the samples can be fitted (see minimize_active_set).
+    if transform is None:
+        engine = get_neg2logL_engine(analyses)
+        loss_f = lambda pars,const_pars,data,relax_batch_dim=False: engine(pars,const_pars,data,relax_batch_dim)
+    else:
+        loss_f = lambda pars,const_pars,data,relax_batch_dim=False: neg2logL(pars,const_pars,analyses,data,transform)
     #print("In 'optimize'")
     #print("pars:", c.print_with_id(pars,id_only))
     #print("const_pars:", c.print_with_id(const_pars,id_only))
@@ -168,7 +661,8 @@ def optimize(pars,const_pars,analyses,data,transform=None,log_tag='',verbose=Fal
 
     if all_exact_MLEs:
         if verbose: print("All starting MLE guesses are exact: skipping optimisation") 
-        total_loss, q, final_pars, null = neg2logL(free_pars,const_pars,**kwargs)
+        total_loss, q, final_pars, null = loss_f(free_pars,const_pars,data)
+        fit_info = {"optimizer": None}
         #print("Finished using exact MLEs: final_pars = ", final_pars)
     else:
         # For analyses that have exact MLEs, we want to move those parameters from the
@@ -189,49 +683,20 @@ def optimize(pars,const_pars,analyses,data,transform=None,log_tag='',verbose=Fal
 
         if verbose: print("Beginning optimisation")
         #f = tf.function(mm.tools.func_partial(neg2logL,**kwargs))
-        kwargs["const_pars"] = enlarged_const_pars
-
-        # Optimization with massminimize
-        # -------------------
-        f = mm.tools.func_partial(neg2logL,**kwargs)
-        #print("About to enter optimizer")
-        #print("pars:", c.print_with_id(reduced_free_pars,False))
-        q, final_pars, null = mm.optimize(reduced_free_pars, f, **opts)
-        #print("Finished mm.optimize: final_pars = ", final_pars)
-        # ------------------
-
-        # # Optimization with tfp optimizers
-        # # So far doesn't work. No idea why, the
-        # # errors are completely opaque.
-        # # --------------------
-
-        # # Stack initial parameter guesses into single tensor
-        # start_point = c.cat_pars(reduced_free_pars)
-
-        # # Slightly altered function signature required
-        # # Need to de-stack single tensor back into parameter dictionary
-        # @make_val_and_grad_fn
-        # def neg2logL_tfp(catted_pars):
-        #     pars = c.uncat_pars(catted_pars, pars_template=reduced_free_pars)
-        #     total_loss, q, x1, x2 = neg2logL(pars,**kwargs)
-        #     return q
-
-        # # Function to run optimizer
-        # @tf.function
-        # def optimizer():
-        #    return tfp.optimizer.lbfgs_minimize(
-        #       neg2logL_tfp, initial_position=start_point,
-        #       stopping_condition=tfp.optimizer.converged_all,
-        #       max_iterations=100,
-        #       tolerance=1e-8)
- 
-        # results = run(optimizer)
-        # print("results:", results)
-        # quit()
-        # # --------------------
+
+        minimize = optimizer_backends[optimizer]
+        if opts["decompose"] and transform is None and len(analyses)>1:
+            q, final_pars, fit_info = minimize_decomposed(minimize, reduced_free_pars, enlarged_const_pars, data, analyses, opts)
+        else:
+            q, final_pars, fit_info = minimize_batch(minimize, reduced_free_pars, enlarged_const_pars, data, loss_f, analyses, opts)
+        telemetry.add_iterations(_fit_iterations(fit_info))
 
     # Rebuild distribution object with fitted parameters for output to user
-    joint = JointDistribution(analyses.values(),final_pars)
+    if build_joint:
+        joint = JointDistribution(analyses.values(),final_pars)
+        joint.fit_info = fit_info
+    else:
+        joint = None
 
     # Split parameters back into fitted vs const parameters
     # (as the user saw them; i.e. undoing the "reduced" free pars stuff in exact MLE case)
@@ -253,6 +718,155 @@ def optimize(pars,const_pars,analyses,data,transform=None,log_tag='',verbose=Fal
     #  parameter dictionary containing only the fixed ("bystander") parameters
     return joint, q, final_pars, final_free_pars, final_const_pars
 
+def _flatten_pars_for_save(prefix,pars,out):
+    for ka,a in pars.items():
+        out["{0}::{1}".format(prefix,ka)] = np.array(list(a.keys()),dtype=str)
+        for kp,p in a.items():
+            out["{0}::{1}::{2}".format(prefix,ka,kp)] = np.asarray(p)
+
+def _unflatten_pars_from_save(prefix,data):
+    pars = {}
+    for key in data.files:
+        parts = key.split("::")
+        if parts[0]==prefix and len(parts)==2:
+            pars[parts[1]] = {kp: tf.constant(data["{0}::{1}::{2}".format(prefix,parts[1],kp)]) for kp in data[key]}
+    return pars
+
+def _batch_axis(t,core_ndims,axis):
+    """Position of a batch axis of tensor t, which has core_ndims non-batch
+       (i.e. parameter or event) trailing dimensions. Negative axis counts
+       from the end of the batch dimensions. Returns None if t has no such
+       batch axis."""
+    batch_ndims = len(t.shape) - core_ndims
+    ax = axis if axis>=0 else batch_ndims + axis
+    if ax<0 or ax>=batch_ndims:
+        return None
+    return ax
+
+def _deep_batch_size(d,core_shapes,axis):
+    """Largest size of batch axis 'axis' amongst tensors in (possibly nested)
+       dictionary d, whose non-batch shapes are given by core_shapes"""
+    n = 1
+    for k,v in d.items():
+        if isinstance(v,Mapping):
+            n = max(n,_deep_batch_size(v,core_shapes[k],axis))
+        elif v is not None:
+            ax = _batch_axis(v,len(core_shapes[k]),axis)
+            if ax is not None:
+                n = max(n,v.shape[ax])
+    return n
+
+def _deep_slice_batch(d,core_shapes,sl,axis):
+    """Slice tensors in (possibly nested) dictionary d along batch axis 'axis'
+       Tensors without that batch axis, or with size 1 along it (i.e. which
+       will be broadcast) are left as they are."""
+    out = {}
+    for k,v in d.items():
+        if isinstance(v,Mapping):
+            out[k] = _deep_slice_batch(v,core_shapes[k],sl,axis)
+        else:
+            v = tf.convert_to_tensor(v)
+            ax = _batch_axis(v,len(core_shapes[k]),axis)
+            if ax is None or v.shape[ax]==1:
+                out[k] = v
+            else:
+                out[k] = v[(slice(None),)*ax + (sl,)]
+    return out
+
+class QuadPrep(dict):
+    """Quantities needed for the quadratic (second-order Taylor expansion)
+       approximation of the profile log-likelihood, as computed by
+       JointDistribution.quad_loglike_prep.
+
+       The dictionary entries are the keyword arguments for
+       JointDistribution._nuisance_quad (i.e. "A", "B", "interest" and
+       "nuisance"). The Cholesky factorisation of the (negated) nuisance
+       block of the Hessian is kept as the 'factor' attribute (a Cholesky
+       or BlockCholesky object, see block_matrix.py), so that further
+       solves against it don't require refactorisation. The Hessian block
+       itself is not kept, except for samples whose factorisation failed.
+    """
+
+    def __init__(self,A,B,interest,nuisance,factor=None):
+        super().__init__(A=A,B=B,interest=interest,nuisance=nuisance)
+        self.factor = factor
+
+    def save(self,filename):
+        """Save to disk (numpy .npz format), e.g. to checkpoint long runs"""
+        out = {}
+        _flatten_pars_for_save("interest",self["interest"],out)
+        _flatten_pars_for_save("nuisance",self["nuisance"],out)
+        if self["A"] is not None:
+            out["A"] = self["A"].numpy()
+            B = self["B"]
+            if isinstance(B,BlockMatrix):
+                out["B_matrix_shape"] = np.array(B.matrix_shape)
+                out["B_batch_shape"] = np.array(B.batch_shape,dtype=np.int64)
+                for k,(rows,cols,M) in enumerate(B.blocks):
+                    out["B_block_{0}_rows".format(k)] = np.array(rows,dtype=np.int64)
+                    out["B_block_{0}_cols".format(k)] = np.array(cols,dtype=np.int64)
+                    out["B_block_{0}".format(k)] = M.numpy()
+            else:
+                out["B"] = B.numpy()
+            if isinstance(self.factor,BlockCholesky):
+                out["factor_matrix_shape"] = np.array(self.factor.matrix_shape)
+                factors = list(self.factor.factors.items())
+            elif self.factor is not None:
+                factors = [(None,self.factor)]
+            else:
+                factors = []
+            for k,(rows,f) in enumerate(factors):
+                if rows is not None:
+                    out["factor_{0}_rows".format(k)] = np.array(rows,dtype=np.int64)
+                out["factor_{0}_ok".format(k)] = f.ok.numpy()
+                if f.M is not None:
+                    out["factor_{0}_M".format(k)] = f.M.numpy()
+                if f.L is not None:
+                    out["factor_{0}_L".format(k)] = f.L.numpy()
+        np.savez(filename,**out)
+
+    @classmethod
+    def load(cls,filename):
+        """Restore QuadPrep object previously saved with 'save'"""
+        with np.load(filename) as data:
+            interest = _unflatten_pars_from_save("interest",data)
+            nuisance = _unflatten_pars_from_save("nuisance",data)
+            if "A" not in data.files:
+                return cls(None,None,interest,nuisance)
+            A = tf.constant(data["A"])
+            if "B" in data.files:
+                B = tf.constant(data["B"])
+            else:
+                blocks = []
+                k = 0
+                while "B_block_{0}".format(k) in data.files:
+                    blocks += [(data["B_block_{0}_rows".format(k)].tolist(), data["B_block_{0}_cols".format(k)].tolist(), tf.constant(data["B_block_{0}".format(k)]))]
+                    k += 1
+                B = BlockMatrix(blocks,data["B_matrix_shape"].tolist(),data["B_batch_shape"].tolist())
+            factors = {}
+            k = 0
+            while "factor_{0}_ok".format(k) in data.files:
+                L = tf.constant(data["factor_{0}_L".format(k)]) if "factor_{0}_L".format(k) in data.files else None
+                M = tf.constant(data["factor_{0}_M".format(k)]) if "factor_{0}_M".format(k) in data.files else None
+                f = Cholesky(M,L=L,ok=tf.constant(data["factor_{0}_ok".format(k)]))
+                rows = tuple(data["factor_{0}_rows".format(k)].tolist()) if "factor_{0}_rows".format(k) in data.files else None
+                factors[rows] = f
+                k += 1
+            if "factor_matrix_shape" in data.files:
+                factor = BlockCholesky(factors,data["factor_matrix_shape"].tolist(),B.batch_shape)
+            elif len(factors)>0:
+                factor = factors[None]
+            else:
+                factor = None
+        return cls(A,B,interest,nuisance,factor=factor)
+
+class _LayoutCache:
+    """Holder for the layout metadata cached by a JointDistribution (a plain
+       object, so that TensorFlow's attribute tracking leaves it alone)"""
+    def __init__(self,key):
+        self.key = key
+        self.values = {}
+
 class JointDistribution(tfd.JointDistributionNamed):
     """Object to combine analyses together and treat them as a single
        joint distribution. Uses JointDistributionNamed for most of the
@@ -348,25 +962,100 @@ class JointDistribution(tfd.JointDistributionNamed):
        """Return a version of this JointDistribution object that has parameters fixed to the supplied values"""
        return JointDistribution(self.analyses.values(), pars)
 
-    def biased_sample(self, N, bias=1):
-       """Sample from biased versions of all analyses and return them along their with sampling probability. For use in importance sampling.
+    def biased_sample(self, N, bias=1, defensive=0.1):
+       """Sample from biased versions of all analyses and return them along with their
+          log importance weights, log(p(x)/q(x)), for use in importance sampling.
+          Convenience wrapper around importance.ImportanceSampler; use that
+          directly for more control (mixtures of shifts, tuning of the shift, etc.)
         
        :param N: Number of samples to draw
        :type N: int
        :param bias: indicates how many 'sigma' of upward bias to apply to the sample 
-               generation, computed, in terms of sqrt(variance) of the background.
-               Bias only applied to 'signal' parameters, not nuisance parameters.
-               NOTE: This doesn't really work properly. Importance sampling is a bit tricky, 
-               probably need a smarter way of choosing the 'importance' distribution. (default value=1)
+               generation, in terms of the scaled 'interest' parameters (whose MLEs
+               have variance of approx. 1). Bias only applied to 'signal' parameters,
+               not nuisance parameters. (default value=1)
        :type bias: float, optional
+       :param defensive: fraction of samples to draw from the unbiased distribution,
+               which keeps the importance weights bounded. (default value=0.1)
+       :type defensive: float, optional
        """
-       biased_analyses = copy.deepcopy(self.analyses)
-       for a in biased_analyses.values():
-           a.SR_b = a.SR_b + bias*np.sqrt(a.SR_b)
-       biased_joint = JointDistribution(biased_analyses.values(), self.pars, pre_scaled_pars=True)
-       samples = biased_joint.sample(N)
-       logw = self.log_prob(samples) - biased_joint.log_prob(samples) # log(weight) for each sample
-       return samples, logw
+       sampler = ImportanceSampler(self, bias=bias, defensive=defensive)
+       return sampler.sample(N)
+
+    def sample_chunk(self, chunk, chunk_size, seed, N):
+       """(Re)generate chunk number 'chunk' of the run of N samples with the given
+          seed, split into chunks of size chunk_size (see sample_chunks). The
+          result is identical to the corresponding chunk from sample_chunks,
+          regardless of where and in which order chunks are generated.
+          N is needed to get the size of the last (possibly partial) chunk.
+          Returns (event_ids, samples).
+       """
+       event_ids = rng.chunk_events(N,chunk_size,chunk)
+       return event_ids, self.sample(len(event_ids),seed=rng.chunk_seed(seed,chunk))
+
+    def sample_chunks(self, N, chunk_size=100000, seed=None, chunks=None):
+       """Generator yielding samples in chunks of at most chunk_size events,
+          so that very large numbers of samples can be processed (fitted,
+          stored) without ever holding all of them in memory at once.
+
+          Yields (event_ids, samples), where event_ids is an array of the
+          indices of the events in the chunk within the overall run of N
+          (suitable e.g. as the primary key when storing results), and
+          samples is a sample dictionary as returned by 'sample'.
+
+          If seed is given then each chunk is generated using the stateless
+          samplers, with a seed depending only on (seed, chunk index) (see
+          rng.chunk_seed), so any given chunk is reproducible independently of
+          the others, on any worker. Otherwise the global TensorFlow random
+          state is used.
+
+       :param N: Total number of samples to draw
+       :type N: int
+       :param chunk_size: Maximum number of samples in each chunk (default value=100000)
+       :type chunk_size: int, optional
+       :param seed: Base seed for the run (default value=None)
+       :type seed: int, optional
+       :param chunks: Indices of the chunks to generate, e.g. to generate only one shard
+               of a run (see rng.shard_chunks) or to resume a run from some chunk
+               onwards. Requires seed. (default value=None, i.e. all chunks)
+       :type chunks: iterable of int, optional
+       """
+       N = int(N)
+       chunk_size = int(chunk_size)
+       if chunk_size<1:
+           msg = "chunk_size must be at least 1 (got {0})".format(chunk_size)
+           raise ValueError(msg)
+       if chunks is None:
+           chunks = range(rng.n_chunks(N,chunk_size))
+       elif seed is None:
+           msg = "A seed is required to generate a selection of chunks reproducibly"
+           raise ValueError(msg)
+       for i in chunks:
+           if seed is None:
+               event_ids = rng.chunk_events(N,chunk_size,i)
+               yield event_ids, self.sample(len(event_ids))
+           else:
+               yield self.sample_chunk(i,chunk_size,seed,N)
+
+    def fit_chunks(self, sample_chunks, fit="all", fixed_pars=None, **fit_options):
+       """Generator applying fit_all (fit="all") or fit_nuisance (fit="nuisance")
+          to each chunk of samples from an iterable of (event_ids, samples), e.g.
+          from sample_chunks, yielding (event_ids, log_prob, par_dict) for each
+          chunk. Memory use is then bounded by the chunk size rather than the
+          total number of samples. fit_options are passed on to the fit
+          function; by default no fitted JointDistribution is constructed.
+       """
+       if fit=="all":
+           fit_f = self.fit_all
+       elif fit=="nuisance":
+           fit_f = self.fit_nuisance
+       else:
+           msg = "Unknown fit type '{0}' requested for fit_chunks! Must be 'all' or 'nuisance'".format(fit)
+           raise ValueError(msg)
+       fit_options = {"build_joint": False, **fit_options}
+       for event_ids, samples in sample_chunks:
+           log_prob, joint_fitted, par_dict = fit_f(samples,fixed_pars,**fit_options)
+           yield event_ids, log_prob, par_dict
 
     def prepare_pars(self,pars,pre_scaled_pars=False):
         """Prepare default nuisance parameters and return scaled signal and nuisance parameters for each analysis
@@ -459,6 +1148,34 @@ class JointDistribution(tfd.JointDistributionNamed):
         #print("fixed_pars:", c.print_with_id(fixed_pars,id_only))
         return pars, all_fixed_pars
 
+    def profiled_fit_available(self):
+        """Check whether all analyses have exact MLEs and provide a closed-form
+           'profiled_neg2logL' kernel, so that fits can be done by fit_profiled"""
+        return all(a.exact_MLEs and hasattr(a,"profiled_neg2logL") for a in self.analyses.values())
+
+    @telemetry.timed("fit_profiled", items=lambda self,samples,*args,**kwargs: _n_samples(samples))
+    def fit_profiled(self,samples,fixed_pars,nuisance_only=True,build_joint=True):
+        """Closed-form alternative to 'optimize', for when profiled_fit_available()
+           is True. Each analysis evaluates -2logL at its exact MLEs directly with
+           its 'profiled_neg2logL' method, so parameters are never converted to
+           Variables and the generic log_prob of the joint distribution is never
+           evaluated. The kernels of all analyses are compiled together (see
+           Neg2LogLEngine.profiled_neg2logL).
+
+           fixed_pars are non-scaled, as for fit_nuisance/fit_all.
+           Output is the same as for 'optimize', except that the fitted
+           JointDistribution is None if build_joint is False.
+        """
+        engine = get_neg2logL_engine(self.analyses)
+        q, fitted_pars, const_pars = engine.profiled_neg2logL(samples,fixed_pars,nuisance_only)
+        all_pars = c.deep_merge(const_pars,fitted_pars)
+        if build_joint:
+            joint = JointDistribution(self.analyses.values(),all_pars)
+            joint.fit_info = {"optimizer": None, "profiled": True}
+        else:
+            joint = None
+        return joint, q, all_pars, fitted_pars, const_pars
+
     def get_samples_for(self,name,samples):
         """Extract the samples for a specific analysis from a sample dictionary, and
            remove the analysis name prefix from the keys"""
@@ -490,42 +1207,73 @@ class JointDistribution(tfd.JointDistributionNamed):
             raise ValueError(msg)
         return pars, fixed_pars
 
+    def _cached(self,name,compute):
+        """Layout metadata (event shapes, parameter shapes, batch shape, parameter
+           layout) depends only on the analyses and on the shapes of the parameters,
+           so is computed once per object by compute() and cached under 'name'. The
+           cache is cleared if the parameters are replaced by ones of different shape."""
+        key = None if self.pars is None else tuple((ka,kp,tuple(p.shape)) for ka,a in self.pars.items() for kp,p in a.items())
+        cache = getattr(self,"_layout_cache",None)
+        if cache is None or cache.key != key:
+            cache = _LayoutCache(key)
+            self._layout_cache = cache
+        if name not in cache.values:
+            cache.values[name] = compute()
+        return cache.values[name]
+
     def decomposed_parameter_shapes(self):
         """Returns three dictionaries whose structure explains how parameters should be supplied
            to this object"""
-        interest  = {a.name: a.interest_parameter_shapes() for a in self.analyses.values()}
-        fixed = {a.name: a.fixed_parameter_shapes() for a in self.analyses.values()}
-        nuis  = {a.name: a.nuisance_parameter_shapes() for a in self.analyses.values()} 
-        return interest, fixed, nuis
+        def compute():
+            interest  = {a.name: a.interest_parameter_shapes() for a in self.analyses.values()}
+            fixed = {a.name: a.fixed_parameter_shapes() for a in self.analyses.values()}
+            nuis  = {a.name: a.nuisance_parameter_shapes() for a in self.analyses.values()} 
+            return interest, fixed, nuis
+        return tuple({k: dict(v) for k,v in d.items()} for d in self._cached("decomposed_parameter_shapes",compute))
 
     def event_shapes(self):
         """Returns dictionary explaining the 'base' event shapes for each distribution in each analysis.
            Analysis names are added as prefixes to the dict keys to match conventions for Osamples and
            Asamples members (generated in constructor)
         """
-        all_event_shapes = {}
-        for a in self.analyses.values():
-            all_event_shapes.update(c.add_prefix(a.name,a.event_shapes())) 
-        return all_event_shapes
+        def compute():
+            all_event_shapes = {}
+            for a in self.analyses.values():
+                all_event_shapes.update(c.add_prefix(a.name,a.event_shapes())) 
+            return all_event_shapes
+        return dict(self._cached("event_shapes",compute))
 
-    def fit_nuisance(self,samples,fixed_pars=None,log_tag='',verbose=False,force_numeric=False):
+    @telemetry.timed("fit_nuisance", items=lambda self,samples,*args,**kwargs: _n_samples(samples))
+    def fit_nuisance(self,samples,fixed_pars=None,log_tag='',verbose=False,force_numeric=False,optimizer="Adam",optimizer_options=None,build_joint=True):
         """Fit nuisance parameters to samples for a fixed signal
            (ignores parameters that were used to construct this object).
            If force_numeric is True then asserted 'exactness' of starting guesses
-           is ignored and numerical optimisation is run regardless."""
+           is ignored and numerical optimisation is run regardless.
+           If all analyses provide closed-form profiled likelihoods (see
+           fit_profiled) then these are used instead of the optimizer.
+           'optimizer' and 'optimizer_options' select the optimizer backend
+           used for numerical fits (see the 'optimize' function).
+           If build_joint is False then no fitted JointDistribution is
+           constructed (None is returned in its place), which saves time
+           when only the fitted log-likelihoods/parameters are needed."""
         if fixed_pars is None:
             fixed_pars = self.get_pars() # Assume hypotheses provided at construction time (but need de-scaled parameters here!)
-        print("fixed_pars:", fixed_pars)
+        logger.debug("fixed_pars: %s", fixed_pars)
         fp = c.convert_to_TF_constants(fixed_pars)
-        all_nuis_pars, all_fixed_pars = self.get_nuis_parameters(samples,fp)
-        print("all_nuis_pars:", all_nuis_pars)
-        print("all_fixed_pars:", all_fixed_pars)
-        print("samples:", samples)
+        if not force_numeric and self.profiled_fit_available():
+            # Exact closed-form fit; no optimisation needed
+            if verbose: print("All analyses provide closed-form profiled -2logL: skipping optimisation")
+            joint_fitted, q, all_pars, fitted_pars, const_pars = self.fit_profiled(samples,fp,nuisance_only=True,build_joint=build_joint)
+        else:
+            all_nuis_pars, all_fixed_pars = self.get_nuis_parameters(samples,fp)
+            logger.debug("all_nuis_pars: %s", all_nuis_pars)
+            logger.debug("all_fixed_pars: %s", all_fixed_pars)
+            logger.debug("samples: %s", samples)
 
-        # Note, parameters obtained from get_nuis_parameters, and passed to
-        # the 'optimize' function, are SCALED. All of them, regardless of whether
-        # they actually vary in this instance.
-        joint_fitted, q, all_pars, fitted_pars, const_pars = optimize(all_nuis_pars,all_fixed_pars,self.analyses,samples,log_tag=log_tag,verbose=verbose,force_numerical=force_numeric)
+            # Note, parameters obtained from get_nuis_parameters, and passed to
+            # the 'optimize' function, are SCALED. All of them, regardless of whether
+            # they actually vary in this instance.
+            joint_fitted, q, all_pars, fitted_pars, const_pars = optimize(all_nuis_pars,all_fixed_pars,self.analyses,samples,log_tag=log_tag,verbose=verbose,force_numerical=force_numeric,optimizer=optimizer,optimizer_options=optimizer_options,build_joint=build_joint)
 
         # Fitted/final parameters are returned de-scaled
         # Also it is nice to pack up the various parameter splits into a dictionary
@@ -560,7 +1308,8 @@ class JointDistribution(tfd.JointDistributionNamed):
     #    joint_fitted, q = optimize(pars,None,self.analyses,samples,pre_scaled_pars='nuis',transform=mu_to_sig,log_tag=log_tag,verbose=verbose)
     #    return q, joint_fitted, pars
   
-    def fit_all(self,samples,fixed_pars=None,log_tag='',verbose=False,force_numeric=False):
+    @telemetry.timed("fit_all", items=lambda self,samples,*args,**kwargs: _n_samples(samples))
+    def fit_all(self,samples,fixed_pars=None,log_tag='',verbose=False,force_numeric=False,optimizer="Adam",optimizer_options=None,build_joint=True):
         """Fit all signal and nuisance parameters to samples
            (ignores parameters that were used to construct this object)
            Some special parameters within analyses are also flagged as
@@ -571,19 +1320,30 @@ class JointDistribution(tfd.JointDistributionNamed):
            starting MLE guesses etc.
            If force_numeric is True then asserted 'exactness' of starting guesses
            is ignored and numerical optimisation is run regardless.
+           If all analyses provide closed-form profiled likelihoods (see
+           fit_profiled) then these are used instead of the optimizer.
+           'optimizer' and 'optimizer_options' select the optimizer backend
+           used for numerical fits (see the 'optimize' function).
+           If build_joint is False then no fitted JointDistribution is
+           constructed (None is returned in its place).
         """
         if fixed_pars is None:
             fixed_pars = self.get_pars() # Assume any extra fixed parameters were provided at construction time. If missing defaults will be used.
 
         # Make sure the samples are TensorFlow objects of the right type:
-        samples = {k: tf.constant(x,dtype="float32") for k,x in samples.items()}
+        samples = c.convert_to_TF_constants(samples) # No copy for samples that are already float32 tensors
         fp = c.convert_to_TF_constants(fixed_pars)
-        all_free_pars, all_fixed_pars = self.get_all_parameters(samples,fp)
+        if not force_numeric and self.profiled_fit_available():
+            # Exact closed-form fit; no optimisation needed
+            if verbose: print("All analyses provide closed-form profiled -2logL: skipping optimisation")
+            joint_fitted, q, all_pars, fitted_pars, const_pars = self.fit_profiled(samples,fp,nuisance_only=False,build_joint=build_joint)
+        else:
+            all_free_pars, all_fixed_pars = self.get_all_parameters(samples,fp)
 
-        # Note, parameters obtained from get_all_parameters, and passed to
-        # the 'optimize' function, are SCALED. All of them, regardless of whether
-        # they actually vary in this instance.
-        joint_fitted, q, all_pars, fitted_pars, const_pars = optimize(all_free_pars,all_fixed_pars,self.analyses,samples,log_tag=log_tag,verbose=verbose,force_numerical=force_numeric)
+            # Note, parameters obtained from get_all_parameters, and passed to
+            # the 'optimize' function, are SCALED. All of them, regardless of whether
+            # they actually vary in this instance.
+            joint_fitted, q, all_pars, fitted_pars, const_pars = optimize(all_free_pars,all_fixed_pars,self.analyses,samples,log_tag=log_tag,verbose=verbose,force_numerical=force_numeric,optimizer=optimizer,optimizer_options=optimizer_options,build_joint=build_joint)
 
         # Fitted/final parameters are returned de-scaled
         # Also it is nice to pack up the various parameter splits into a dictionary
@@ -593,14 +1353,88 @@ class JointDistribution(tfd.JointDistributionNamed):
         par_dict["fixed"]  = const_pars
         return -0.5*q, joint_fitted, par_dict 
 
-    def get_best_fit(self,samples):
+    def get_best_fit(self,samples,top_k=1):
         """Based on parameters belonging to this object, return the parameters that result
            in the highest log_prob value for the given input samples.
            Mainly intended to be used after fitting multiple hypotheses to the same samples.
-        """
-        log_probs = self.log_prob(samples)
 
+           Hypotheses are taken to run along the last batch dimension, and events
+           along the first, e.g. parameters fitted with batch shape (n_events,n_hypotheses).
+           Returns (reducer, best_pars), where reducer is a reductions.BestFitReducer
+           holding the lowest -2*log_prob values and the indices of the
+           corresponding hypotheses for each event, and best_pars are the
+           parameters of the best-fitting hypothesis for each event.
+        """
+        neg2logL = -2*self.log_prob(samples)
+        n_events = neg2logL.shape[0] if len(neg2logL.shape)>0 else 1
+        reducer = BestFitReducer(n_events,top_k)
+        reducer.update(tf.reshape(neg2logL,(n_events,-1,neg2logL.shape[-1] if len(neg2logL.shape)>1 else 1)))
 
+        # Gather the best-fit parameters for each event
+        batch_shape = self.bcast_batch_shape_tensor()
+        par_shapes = self.parameter_shapes()
+        index = np.maximum(reducer.argmin,0) # IDs are -1 if no finite values found
+        best_pars = {}
+        for ka,a in self.get_pars().items():
+            best_pars[ka] = {}
+            for kp,p in a.items():
+                pshape = tuple(par_shapes[ka][kp])
+                p = tf.broadcast_to(p,tuple(batch_shape)+pshape)
+                p = tf.reshape(p,(n_events,-1,batch_shape[-1] if len(batch_shape)>1 else 1)+pshape)
+                best_pars[ka][kp] = tf.gather(p,index,axis=2,batch_dims=1)
+        return reducer, best_pars
+
+    def best_fit_quad(self,samples,signal_chunks,top_k=1,memory_budget=2**28,prep=None,block=True):
+        """Find, for each event, the signal hypotheses with the lowest -2*log_prob
+           under the quadratic approximation of the profile likelihood (see
+           log_prob_quad_tiles), streaming over chunks of hypotheses so that
+           the full events x hypotheses matrix is never stored.
+
+           signal_chunks is an iterable of signal parameter dictionaries (with
+           hypotheses along their last batch dimension), or of (signal,ids)
+           tuples where ids are integer IDs for the hypotheses in that chunk.
+           Without IDs, hypotheses are numbered consecutively across chunks.
+
+           Returns a reductions.BestFitReducer.
+        """
+        if prep is None:
+            prep = self.quad_loglike_prep(samples,block)
+        n_events = _deep_batch_size(samples,self.event_shapes(),0)
+        reducer = BestFitReducer(n_events,top_k)
+        par_shapes = self.parameter_shapes()
+        for chunk in signal_chunks:
+            signal, ids = chunk if isinstance(chunk,tuple) else (chunk,None)
+            n_hypotheses = _deep_batch_size(signal,par_shapes,-1)
+            for event_slice, hyp_slice, log_prob in self.log_prob_quad_tiles(samples,signal,memory_budget,prep,block):
+                tile_ids = reducer.hypothesis_offset + np.arange(hyp_slice.start,hyp_slice.stop) if ids is None else np.asarray(ids)[hyp_slice]
+                reducer.update(-2*log_prob.numpy(),event_slice,tile_ids)
+            reducer.next_chunk(n_hypotheses)
+        return reducer
+
+    def best_fit_profiled(self,samples,signal_chunks,top_k=1,**fit_options):
+        """As best_fit_quad, but finding the profile likelihood for each
+           hypothesis by directly fitting the nuisance parameters (see
+           fit_nuisance) rather than by the quadratic approximation. Much slower,
+           but exact. Samples should have batch shape (n_events,1), so that they
+           broadcast against the hypotheses in each chunk.
+           fit_options are passed on to fit_nuisance. Returns a
+           reductions.BestFitReducer.
+        """
+        n_events = _deep_batch_size(samples,self.event_shapes(),0)
+        reducer = BestFitReducer(n_events,top_k)
+        par_shapes = self.parameter_shapes()
+        fit_options = {"build_joint": False, **fit_options}
+        for chunk in signal_chunks:
+            signal, ids = chunk if isinstance(chunk,tuple) else (chunk,None)
+            n_hypotheses = _deep_batch_size(signal,par_shapes,-1)
+            joint = JointDistribution(self.analyses.values(),signal)
+            log_prob, joint_fitted, pars = joint.fit_nuisance(samples,**fit_options)
+            reducer.update(-2*np.asarray(log_prob),hypothesis_ids=ids)
+            reducer.next_chunk(n_hypotheses)
+        return reducer
+
+
+    @telemetry.timed("Hessian", items=lambda self,samples: _n_samples(samples))
     def Hessian(self,samples):
         """Obtain Hessian matrix (and grad) of the log_prob function at 
            input parameter points
@@ -636,23 +1470,14 @@ class JointDistribution(tfd.JointDistributionNamed):
         #print("self.pars:", pars)
 
         # Separate "const" parameters
-        free_pars = {}
-        const_pars = {}
-        const_par_names = self.identify_const_parameters()
-        for a,p in pars.items():
-            free_pars[a] = {}
-            const_pars[a] = {}
-            for name,v in p.items():
-                if name in const_par_names[a]:
-                    const_pars[a][name] = v
-                else:
-                    free_pars[a][name] = v
+        free_pars, const_pars = self._split_const_pars(pars)
 
         # Stack parameters into a single tensorflow variable for
         # matrix manipulations
         par_shapes = self.parameter_shapes()
-        all_input_pars, bcast_batch_shape, column_names = c.cat_pars_to_tensor(free_pars,par_shapes)
-        npars = len(column_names)
+        layout = self._free_layout(free_pars)
+        all_input_pars, bcast_batch_shape = layout.pack(free_pars)
+        npars = layout.n
         #print("pars:",pars)
         #print("column_names:", column_names)
 
@@ -665,28 +1490,12 @@ class JointDistribution(tfd.JointDistributionNamed):
             with tf.GradientTape() as tape:
             #with tf.GradientTape(persistent=True,watch_accessed_variables=False) as tape:
                 tape.watch(input_pars)
-                # Don't need to go via JointDistribution, can just
-                # get log_prob for all component dists "manually"
-                # Avoids confusion about parameters getting copied and
-                # breaking TF graph connections etc.
                 #print("samples:", samples)
                 #print("free_pars:", free_pars)
                 #print("input_pars:", input_pars)
                 #print("const_pars:", const_pars)
                 #print("catted_pars:", catted_pars)
-                inpars = c.decat_tensor_to_pars(input_pars,free_pars,par_shapes,batch_shape) # need to unstack for use in each analysis
-         
-                # print("inpars:", inpars)
-                # merge with const parameters
-                all_inpars = c.deep_merge(inpars,const_pars)
-                scaled_inpars = self.scale_pars(all_inpars)
-                q = 0
-                for a in self.analyses.values():
-                    d = c.add_prefix(a.name,a.tensorflow_model(scaled_inpars[a.name])) 
-                    for dist_name, dist in d.items():
-                        #print("x[{0}]:".format(dist_name), samples[dist_name])
-                        #print("dist {0} description: {1}".format(dist_name,dist))
-                        q += dist.log_prob(samples[dist_name])
+                q = self._log_prob_flat_pars(input_pars,free_pars,const_pars,par_shapes,batch_shape,samples)
                 #print("q:", q)
             grads = tape.gradient(q, input_pars) #[0]
             #grads = tape.jacobian(q, catted_pars)
@@ -722,6 +1531,119 @@ class JointDistribution(tfd.JointDistributionNamed):
         #print("grads_out:", grads_out)
         return hessians_out, grads_out
 
+    def _split_const_pars(self,pars):
+        """Separate parameters into those which are free for the purposes of
+           computing derivatives, and those which are always "constant"
+           (see identify_const_parameters)"""
+        free_pars = {}
+        const_pars = {}
+        const_par_names = self.identify_const_parameters()
+        for a,p in pars.items():
+            free_pars[a] = {}
+            const_pars[a] = {}
+            for name,v in p.items():
+                if name in const_par_names[a]:
+                    const_pars[a][name] = v
+                else:
+                    free_pars[a][name] = v
+        return free_pars, const_pars
+
+    def _log_prob_flat_pars(self,input_pars,free_pars,const_pars,par_shapes,batch_shape,samples):
+        """Evaluate log_prob for samples, with the free parameters supplied
+           in stacked (catted) form, as produced by c.cat_pars_to_tensor"""
+        # Don't need to go via JointDistribution, can just
+        # get log_prob for all component dists "manually"
+        # Avoids confusion about parameters getting copied and
+        # breaking TF graph connections etc.
+        # Scale as one vector, then unstack for use in each analysis
+        layout = self._free_layout(free_pars)
+        scaled_free = layout.unpack(layout.scale(input_pars),batch_shape)
+        # merge with const parameters
+        scaled_inpars = c.deep_merge(scaled_free,self.scale_pars(const_pars))
+        q = 0
+        for a in self.analyses.values():
+            d = c.add_prefix(a.name,a.tensorflow_model(scaled_inpars[a.name])) 
+            for dist_name, dist in d.items():
+                q += dist.log_prob(samples[dist_name])
+        return q
+
+    def hessian_blocks(self,free_pars):
+        """Get the block structure of the Hessian with respect to the stacked
+           free parameters, from the blocks reported by each analysis (see
+           BaseAnalysis.hessian_blocks). Blocks are returned as tuples of
+           indices into the stacked parameter vector (as created by
+           c.cat_pars_to_tensor)."""
+        layout = self._free_layout(free_pars)
+        offsets = {ka: {} for ka in free_pars.keys()}
+        for (ka,kp),sl in layout.slices.items():
+            offsets[ka][kp] = sl.start
+        npars = layout.n
+        blocks = []
+        for ka in free_pars.keys():
+            for block in self.analyses[ka].hessian_blocks():
+                idx = tuple(offsets[ka][kp] + j for kp,j in block if kp in offsets[ka].keys())
+                if len(idx)>0:
+                    blocks += [idx]
+        covered = sorted(j for idx in blocks for j in idx)
+        if covered != list(range(npars)):
+            msg = "Hessian blocks reported by the analyses do not exactly cover all the free parameters! Please check the 'hessian_blocks' methods of the analysis classes."
+            raise ValueError(msg)
+        return blocks, npars
+
+    @telemetry.timed("block_Hessian", items=lambda self,samples: _n_samples(samples))
+    def block_Hessian(self,samples):
+        """Block-sparse version of Hessian. Returns the same Hessian matrix
+           (and grad), except that the Hessian is a BlockMatrix holding only
+           the non-zero blocks reported by the analyses (see hessian_blocks),
+           rather than a dense (batch_dims,N,N) tensor.
+
+           Since the blocks are independent, column j of every block is
+           obtained from a single forward-over-backward Hessian-vector product,
+           so the cost scales with the size of the largest block rather than
+           with the total number of parameters N.
+        """
+        batch_shape = self.bcast_batch_shape_tensor()
+        pars = self.get_pars()
+        free_pars, const_pars = self._split_const_pars(pars)
+        par_shapes = self.parameter_shapes()
+        all_input_pars, bcast_batch_shape = self._free_layout(free_pars).pack(free_pars)
+
+        if bcast_batch_shape != batch_shape:
+            msg = "Broadcasted batch shape inferred while stacking parameters into tensor did not match batch shape inferred from underlying distribution objects! This is a bug, if there is a problem with the input parameters it should have been detected before this."
+            raise ValueError(msg)
+
+        blocks, npars = self.hessian_blocks(free_pars)
+        max_size = max(len(idx) for idx in blocks)
+
+        input_pars = tf.convert_to_tensor(all_input_pars)
+        grads = None
+        Hcols = []
+        for j in range(max_size):
+            # Tangent selecting the j'th parameter of every block
+            tangent = np.zeros(npars)
+            for idx in blocks:
+                if j < len(idx):
+                    tangent[idx[j]] = 1
+            tangents = tf.broadcast_to(tf.constant(tangent,dtype=input_pars.dtype),input_pars.shape)
+            with tf.autodiff.ForwardAccumulator(input_pars,tangents) as acc:
+                with tf.GradientTape() as tape:
+                    tape.watch(input_pars)
+                    q = self._log_prob_flat_pars(input_pars,free_pars,const_pars,par_shapes,batch_shape,samples)
+                g = tape.gradient(q, input_pars)
+            if grads is None:
+                grads = g
+            Hcols += [acc.jvp(g)]
+        Hcols = tf.stack(Hcols,axis=-1) # (flat_batch, N, max_size)
+
+        out_blocks = []
+        for idx in blocks:
+            Hb = tf.gather(Hcols,list(idx),axis=-2)[...,:len(idx)]
+            Hb = tf.reshape(Hb,[d for d in batch_shape] + [len(idx),len(idx)])
+            out_blocks += [(idx, idx, Hb)]
+        H = BlockMatrix(out_blocks,(npars,npars))
+        grads_out = tf.reshape(grads,[d for d in batch_shape] + [npars])
+        return H, grads_out
+
     def decomposed_parameters(self,pars):
         """Separate input parameters into 'interest' and 'nuisance' lists,
            keeping tracking of their original 'indices' w.r.t. catted format.
@@ -761,7 +1683,9 @@ class JointDistribution(tfd.JointDistributionNamed):
     def sub_Hessian(self,H,pari,parj,idim=-1,jdim=-2):
         """Extract sub-Hessian matrix from full Hessian H,
            using dictionary that provides indices for selected
-           parameters in H"""
+           parameters in H. H may also be a BlockMatrix (see
+           block_Hessian), in which case a BlockMatrix is returned
+           (only the default idim/jdim are supported in that case)."""
         ilist = []
         for ai in pari.values():
             for i,Ni in ai.values():
@@ -773,6 +1697,12 @@ class JointDistribution(tfd.JointDistributionNamed):
         #print("H.shape:",H.shape)
         #print("ilist:",ilist)
         #print("jlist:",jlist)
+        if isinstance(H,BlockMatrix):
+            if (idim,jdim)!=(-1,-2):
+                msg = "sub_Hessian only supports the default idim/jdim for block-sparse Hessians"
+                raise ValueError(msg)
+            # gather along the last dim (idim) selects columns, along jdim selects rows
+            return H.sub_matrix(jlist,ilist)
         # Use gather to extract row/column slices from Hessian
         if len(ilist)>0:
             subH_i = tf.gather(H,      ilist, axis=idim)
@@ -803,13 +1733,27 @@ class JointDistribution(tfd.JointDistributionNamed):
         Hij = self.sub_Hessian(H,parsi,parsj) #Off-diagonal block. Symmetric so we don't need both.
         return Hii, Hjj, Hij
 
-    def quad_loglike_prep(self,samples):
+    @telemetry.timed("quad_loglike_prep", items=lambda self,samples,*args,**kwargs: _n_samples(samples))
+    def quad_loglike_prep(self,samples,block=True):
         """Compute second-order Taylor expansion of log-likelihood surface
            around input parameter point(s), and compute quantities needed
            for analytic determination of profile likelihood for fixed signal
-           parameters, under this approximation."""
+           parameters, under this approximation.
+
+           If block is True then the block-sparse Hessian is used (see
+           block_Hessian), and B is returned as a BlockMatrix. Otherwise
+           the dense Hessian is used.
+
+           Returns a QuadPrep object, which acts as a dictionary of the
+           keyword arguments for _nuisance_quad, and also keeps the
+           Cholesky factorisation of the nuisance block of the Hessian
+           (as attribute 'factor'). It can be saved to disk with
+           QuadPrep.save and restored with QuadPrep.load."""
         #print("Computing Hessian and various matrix operations for all samples...")
-        H, g = self.Hessian(samples)
+        if block:
+            H, g = self.block_Hessian(samples)
+        else:
+            H, g = self.Hessian(samples)
         #print("H:", H)
         #print("g:", g) # Should be close to zero if fits worked correctly
         pars = self.get_pars() # This is what Hessian uses internally
@@ -828,48 +1772,59 @@ class JointDistribution(tfd.JointDistributionNamed):
         #print("Hnn.shape:", Hnn.shape if Hnn is not None else None)
         #print("Hin.shape:", Hin.shape if Hin is not None else None)
         if Hnn is None: # Could be None if there aren't any nuisance parameters!
-            A = None
-            B = None
+            return QuadPrep(None,None,interest_p,nuisance_p)
+
+        # Factorise -Hnn (positive-definite at a maximum of log_prob) once,
+        # and get A = Hnn^-1 gn and B = Hnn^-1 Hin via triangular solves.
+        # Hin here has rows for the nuisance parameters and columns for the
+        # interest parameters, so no transpose is needed.
+        gn = self.sub_grad(g,nuisance_i)
+        #print("gn:", gn)
+        # Hmm, gn should always be zero if we maximised the logL w.r.t. the nuisance parameters at the expansion point? Should be at a maxima in that direction?
+        #gn *= 0. # Test effect of enforcing this
+        if isinstance(Hnn,BlockMatrix):
+            # Blocks of Hnn are independent, so are factorised separately.
+            factor = (-Hnn).cholesky()
+            A = -factor.solvevec(gn)
+            B = -factor.solve(Hin) if Hin is not None else BlockMatrix([],(Hnn.matrix_shape[0],0),Hnn.batch_shape)
         else:
-            Hnn_inv = tf.linalg.inv(Hnn)
-            #print("Hii:", Hii)
-            #print("Hin:", Hin)
-            #print("Hnn:", Hnn)
-            #print("Hnn_inv:", Hnn_inv)
-            gn = self.sub_grad(g,nuisance_i)
-            #print("gn:", gn)
-            # Hmm, gn should always be zero if we maximised the logL w.r.t. the nuisance parameters at the expansion point? Should be at a maxima in that direction?
-            #gn *= 0. # Test effect of enforcing this
-            A = tf.linalg.matvec(Hnn_inv,gn)
-            B = tf.linalg.matmul(Hnn_inv,Hin,transpose_b=True) # TODO: Not sure if transpose needed here. Doesn't seem to make a difference, which seems a little odd.
-        #print("...done!")
+            factor = Cholesky(-Hnn)
+            A = -factor.solvevec(gn)
+            B = -factor.solve(Hin) if Hin is not None else tf.zeros(Hnn.shape[:-1]+(0,),dtype=Hnn.dtype)
+        if not factor.all_ok:
+            logger.warning("Cholesky factorisation failed for some samples in quad_loglike_prep (Hessian not negative-definite for nuisance parameters); fell back to LU solves for those samples")
         #print("A:", A)
         #print("B:", B)
-        kwargs = {"A":A, "B":B, "interest":interest_p, "nuisance":nuisance_p}
-        #print("in quad prep:")
-        #print("kwargs:", kwargs)
-        return kwargs
+        return QuadPrep(A,B,interest_p,nuisance_p,factor=factor)
 
-    def log_prob_quad_f(self,samples):
+    def log_prob_quad_f(self,samples,block=True,prep=None):
         """Return a function that can be used to compute the profile log-likelihood
            for fixed signal parameters, for many different signal hypotheses, using a 
            second-order Taylor expandion of the likelihood surface about a point to
            determine the profiled nuisance parameter values. 
            Should be used after pars are fitted to the desired expansion point, e.g.
-           global best fit, or perhaps a null hypothesis point"""
+           global best fit, or perhaps a null hypothesis point.
+           'block' selects the block-sparse Hessian (see quad_loglike_prep).
+           A previously computed (or loaded from disk) QuadPrep object may be
+           supplied as 'prep', in which case it is used instead of recomputing
+           the expansion."""
         #print("quad_loglike_f; samples:", samples)
-        prep_kwargs = self.quad_loglike_prep(samples)
+        prep_kwargs = self.quad_loglike_prep(samples,block) if prep is None else prep
         f = mm.tools.func_partial(self._log_prob_quad,samples=samples,**prep_kwargs)
         return f
 
-    def nuisance_quad_f(self,samples):
+    def nuisance_quad_f(self,samples,block=True,prep=None):
         """Return a function that can be used to compute profiled (i.e. fitted, MLE) nuisance
            parameters for fixed signal parameters, for many different signal hypotheses, using a 
            second-order Taylor expandion of the likelihood surface about a point to
            determine the profiled nuisance parameter values. 
            Should be used after pars are fitted to the desired expansion point, e.g.
-           global best fit, or perhaps a null hypothesis point"""
-        prep_kwargs = self.quad_loglike_prep(samples)
+           global best fit, or perhaps a null hypothesis point.
+           'block' selects the block-sparse Hessian (see quad_loglike_prep).
+           A previously computed (or loaded from disk) QuadPrep object may be
+           supplied as 'prep', in which case it is used instead of recomputing
+           the expansion."""
+        prep_kwargs = self.quad_loglike_prep(samples,block) if prep is None else prep
         f = mm.tools.func_partial(self._nuisance_quad,**prep_kwargs)
         return f
 
@@ -912,9 +1867,10 @@ class JointDistribution(tfd.JointDistributionNamed):
             #nuisance_bcast = c.bcast_all_dist_batch_shape(nuisance,par_shapes,batch_shape)
 
             flatten = False # If flattening then need to undo it to restore original signal batch shape
-            s, s_bshape, s_names = c.cat_pars_to_tensor(parlist,par_shapes,flatten) 
-            s_0, s0_bshape, s0_names = c.cat_pars_to_tensor(interest,par_shapes,flatten) # stacked interest parameter values at expansion point
-            theta_0, t0_bshape, t0_names = c.cat_pars_to_tensor(nuisance,par_shapes,flatten) # stacked nuisance parameter values at expansion point
+            nuisance_layout = get_layout(nuisance,par_shapes)
+            s, s_bshape = get_layout(parlist,par_shapes).pack(parlist,flatten)
+            s_0, s0_bshape = get_layout(interest,par_shapes).pack(interest,flatten) # stacked interest parameter values at expansion point
+            theta_0, t0_bshape = nuisance_layout.pack(nuisance,flatten) # stacked nuisance parameter values at expansion point
 
             # print("s_bshape:", s_bshape)
             # print("s0_bshape:", s0_bshape)
@@ -938,7 +1894,10 @@ class JointDistribution(tfd.JointDistributionNamed):
             # print("s_0:", s_0)
             # print("sdiff:", sdiff)
             # print("sdiff.shape:", sdiff.shape)
-            Bvec = tf.linalg.matvec(B,sdiff)
+            if isinstance(B,BlockMatrix):
+                Bvec = B.matvec(sdiff)
+            else:
+                Bvec = tf.linalg.matvec(B,sdiff)
             # print("Bvec:", Bvec)
             #theta_prof = Ashift - Bvec
             theta_prof = theta_0 - Bvec
@@ -946,7 +1905,7 @@ class JointDistribution(tfd.JointDistributionNamed):
             # ^^^ now have a more general method for restoring batch shape
 
             # de-stack analytically profiled nuisance parameters
-            theta_prof_dict = c.decat_tensor_to_pars(theta_prof,nuisance,par_shapes,batch_shape) 
+            theta_prof_dict = nuisance_layout.unpack(theta_prof,batch_shape)
 
             # print("theta (in):", theta_0)
             # print("theta_prof:", theta_prof)
@@ -981,10 +1940,9 @@ class JointDistribution(tfd.JointDistributionNamed):
         # This is a little confusing, but basically need to make the sample_shape+batch_shape for the sample
         # match the batch_shape of the JointDistribution. Will assume axis 0 is always the "number of samples", so extra dims
         # are to be inserted into the batch dims of the sample at axis 1.
-        consistent, batch_shape = c.deep_equals(joint.batch_shape_tensor())
-        if not consistent:
-            msg = "Inconsistent batch dimensions found! Batch shape dictionary was: {0}".format(joint.batch_shape_tensor())
-            raise ValueError(msg)
+        # Components may have different (but broadcastable) batch shapes, e.g. when
+        # some analyses have no nuisance parameters. Raises ValueError if inconsistent.
+        batch_shape = joint.bcast_batch_shape_tensor()
         event_shape = joint.event_shape_tensor()
         s_batch_shape = c.sample_batch_shape(samples,event_shape)
         if s_batch_shape==() and (theta_prof_dict is None) : s_batch_shape = [0] # Interpret as one batch dim when zero. This is a little hacky, I probably need to tighten up the shape propagation.
@@ -1002,7 +1960,96 @@ class JointDistribution(tfd.JointDistributionNamed):
         # print("log_prob:", log_prob)
         return log_prob #c.squeeze_to(q,2,dont_squeeze=[0])
 
+    def quad_tile_sizes(self,samples,n_events,n_hypotheses,memory_budget):
+        """Choose the numbers of events and hypotheses to evaluate together in
+           each tile of log_prob_quad_tiles, such that the (roughly estimated)
+           memory used by the intermediate tensors of one tile stays below
+           memory_budget (in bytes)."""
+        interest, fixed, nuisance = self.decomposed_parameter_shapes()
+        npars = sum(c.prod(shape) or 1 for a in (interest,nuisance) for pars in a.values() for shape in pars.values())
+        ndata = sum(c.prod(shape) or 1 for shape in self.event_shapes().values())
+        # Several intermediate tensors of this size are alive at once when
+        # evaluating the expansion and the log_prob; 4 is a rough allowance
+        bytes_per_pair = 4 * (npars + ndata + 1) * np.dtype(c.TFdtype).itemsize
+        pairs = max(1, int(memory_budget // bytes_per_pair))
+        hyp_chunk = min(n_hypotheses, pairs)
+        event_chunk = max(1, min(n_events, pairs // hyp_chunk))
+        return event_chunk, hyp_chunk
+
+    def log_prob_quad_tiles(self,samples,signal,memory_budget=2**28,prep=None,block=True):
+        """Evaluate the quadratic approximation of the profile log-likelihood
+           (as returned by log_prob_quad_f) for many events and many signal
+           hypotheses, in tiles of events x hypotheses small enough that the
+           estimated peak memory use stays within memory_budget (in bytes),
+           regardless of the total number of events and hypotheses.
+
+           This is a generator, yielding (event_slice, hypothesis_slice, log_prob)
+           for each tile, where log_prob is the result for the events
+           samples[event_slice] and the hypotheses signal[...,hypothesis_slice].
+
+           Events are taken to run along the first batch axis of the samples
+           (and of the expansion point parameters in this object), and
+           hypotheses along the last batch axis of the signal parameters, as in
+           e.g. samples of shape (n_events,1) and signals of shape (1,n_hypotheses).
+
+           The expansion is computed once for all events (or can be supplied
+           as 'prep', see quad_loglike_prep), and sliced for each tile.
+        """
+        if prep is None:
+            prep = self.quad_loglike_prep(samples,block)
+        par_shapes = self.parameter_shapes()
+        event_shapes = self.event_shapes()
+        n_events = _deep_batch_size(samples,event_shapes,0)
+        n_hypotheses = _deep_batch_size(signal,par_shapes,-1)
+        event_chunk, hyp_chunk = self.quad_tile_sizes(samples,n_events,n_hypotheses,memory_budget)
+        for i in range(0,n_events,event_chunk):
+            event_slice = slice(i,min(i+event_chunk,n_events))
+            samples_i = _deep_slice_batch(samples,event_shapes,event_slice,0)
+            prep_i = {"interest": _deep_slice_batch(prep["interest"],par_shapes,event_slice,0),
+                      "nuisance": _deep_slice_batch(prep["nuisance"],par_shapes,event_slice,0)}
+            for key in ["A","B"]:
+                X = prep[key]
+                if X is None:
+                    prep_i[key] = None
+                elif isinstance(X,BlockMatrix):
+                    prep_i[key] = X.slice_batch(event_slice,0) if len(X.batch_shape)>0 else X
+                else:
+                    prep_i[key] = _deep_slice_batch({key: X},{key: X.shape[-(2 if key=="B" else 1):]},event_slice,0)[key]
+            for j in range(0,n_hypotheses,hyp_chunk):
+                hyp_slice = slice(j,min(j+hyp_chunk,n_hypotheses))
+                signal_j = _deep_slice_batch(signal,par_shapes,hyp_slice,-1)
+                yield event_slice, hyp_slice, self._log_prob_quad(signal_j,samples_i,**prep_i)
+
+    def log_prob_quad_tiled(self,samples,signal,memory_budget=2**28,prep=None,block=True,reducer=None):
+        """Memory-bounded version of log_prob_quad_f(samples)(signal), see
+           log_prob_quad_tiles.
+
+           If 'reducer' is None, the full result is assembled into a numpy array
+           of shape (n_events,...,n_hypotheses) and returned. Otherwise only one
+           tile is held in memory at a time: each tile is passed to
+           reducer(log_prob,event_slice,hypothesis_slice) as it is computed
+           (e.g. to keep running minima, see jmctf.reductions), and the reducer
+           is returned.
+        """
+        out = None
+        for event_slice, hyp_slice, log_prob in self.log_prob_quad_tiles(samples,signal,memory_budget,prep,block):
+            if reducer is not None:
+                reducer(log_prob,event_slice,hyp_slice)
+                continue
+            if out is None:
+                n_events = _deep_batch_size(samples,self.event_shapes(),0)
+                n_hypotheses = _deep_batch_size(signal,self.parameter_shapes(),-1)
+                out = np.empty((n_events,) + tuple(log_prob.shape[1:-1]) + (n_hypotheses,),dtype=log_prob.dtype.as_numpy_dtype)
+            out[event_slice,...,hyp_slice] = log_prob.numpy()
+        return out if reducer is None else reducer
+
     def bcast_batch_shape_tensor(self):
+        """Common batch shape of all components of the JointDistribution
+           (see _bcast_batch_shape). Cached, since it depends only on the
+           parameter shapes."""
+        return self._cached("batch_shape",self._bcast_batch_shape)
+
+    def _bcast_batch_shape(self):
         """The built-in batch_shape_tensor method for NamedJointDistribution in
            tensorflow_probability returns a dictionary of batch shapes, one for
            each component of the JointDistribution.
@@ -1048,8 +2095,25 @@ class JointDistribution(tfd.JointDistributionNamed):
            sense for JointDistribution since it only accepts one input 'event_shape', whilst this 
            can obviously be different across the various component distributions. This function
            also works for analysis parameters rather than distribution parameters."""
-        param_shapes = {name: a.parameter_shapes() for name,a in self.analyses.items()}
-        return param_shapes
+        param_shapes = self._cached("parameter_shapes",lambda: {name: a.parameter_shapes() for name,a in self.analyses.items()})
+        return {k: dict(v) for k,v in param_shapes.items()}
+
+    def parameter_layout(self):
+        """The ParameterLayout (see parameters.py) of the parameters of this object,
+           giving the offset and shape of each parameter in the stacked parameter
+           vector, their scaling factors, and the column names used for them when
+           recording to disk."""
+        return self._cached("parameter_layout",lambda: ParameterLayout(self.pars,self.parameter_shapes(),self.analyses))
+
+    def _free_layout(self,free_pars):
+        """Scaled ParameterLayout of a subset of the parameters of this object
+           (e.g. the free parameters, see _split_const_pars), cached per structure"""
+        par_shapes = self.parameter_shapes()
+        return self._cached(("layout",layout_key(free_pars,par_shapes)),lambda: ParameterLayout(free_pars,par_shapes,self.analyses))
+
+    def column_names(self):
+        """Names of the stacked parameters of this object (see parameter_layout)"""
+        return self.parameter_layout().column_names
 
 
 
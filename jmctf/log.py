@@ -0,0 +1,56 @@
+"""Leveled logging for JMCTF.
+
+   Debugging output is sent to loggers from the standard 'logging' module,
+   named after the modules producing it ('jmctf.joint', 'jmctf.common',
+   'jmctf.normalte_analysis', ...), all children of the 'jmctf' logger. The
+   level of each can be set separately, so e.g. debugging output can be
+   switched on for just the fits:
+
+     from jmctf import log
+     log.enable("joint")
+
+   Nothing is printed by default. Messages use lazy %-style formatting, so
+   when a level is disabled the (possibly huge) tensors passed as arguments
+   are never converted to strings, and the cost of a disabled call is a
+   cached level check.
+"""
+
+import logging
+
+DEBUG = logging.DEBUG
+INFO = logging.INFO
+WARNING = logging.WARNING
+
+root_name = "jmctf"
+logger = logging.getLogger(root_name)
+logger.addHandler(logging.NullHandler()) # Library convention; users configure output
+logger.setLevel(logging.WARNING)
+
+def _full_name(subsystem):
+    if subsystem is None or subsystem==root_name:
+        return root_name
+    if subsystem.startswith(root_name + "."):
+        return subsystem
+    return "{0}.{1}".format(root_name, subsystem)
+
+def get_logger(subsystem):
+    """Logger for a JMCTF subsystem, e.g. get_logger("joint") or get_logger(__name__)"""
+    return logging.getLogger(_full_name(subsystem))
+
+def set_level(level, subsystem=None):
+    """Set the logging level of one subsystem (default: all of JMCTF)"""
+    get_logger(subsystem).setLevel(level)
+
+def enable(subsystem=None, level=DEBUG, stream=None):
+    """Switch on output of messages at 'level' and above for one subsystem
+       (default: all of JMCTF), adding a console handler to the 'jmctf'
+       logger if it does not have one yet."""
+    set_level(level, subsystem)
+    if not any(isinstance(h, logging.StreamHandler) for h in logger.handlers):
+        handler = logging.StreamHandler(stream)
+        handler.setFormatter(logging.Formatter("%(name)s %(levelname)s: %(message)s"))
+        logger.addHandler(handler)
+
+def disable(subsystem=None):
+    """Switch off all but warnings and errors for one subsystem (default: all of JMCTF)"""
+    set_level(WARNING, subsystem)
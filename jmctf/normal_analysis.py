@@ -33,6 +33,10 @@ class NormalAnalysis(BaseAnalysis):
         self.x_obs = x_obs
         self.exact_MLEs =  True # Let driver classes know that we can analytically provide exact MLEs, so no numerical fitting is needed.
 
+    def get_spec(self):
+        """Constructor arguments to rebuild this analysis (see parallel.analysis_spec)"""
+        return {"name": self.name, "x_obs": self.x_obs, "sigma": self.sigma}
+
     def tensorflow_model(self,pars):
         """Output tensorflow probability model object, to be combined with models from
            other analysis and sampled from.
@@ -140,6 +144,21 @@ class NormalAnalysis(BaseAnalysis):
         all_fixed_pars = {"mu": mu} # mu is fixed in nuisance-parameter-only fits
         return free_pars, all_fixed_pars
 
+    def profiled_neg2logL(self,samples,fixed_pars,nuisance_only=True):
+        """Closed-form -2*log-likelihood, evaluated at the exact MLEs of the free
+           parameters (nothing for nuisance-only fits; 'mu' otherwise). Allows
+           fits to skip numerical optimisation and the generic log_prob entirely.
+           Returns -2logL along with the (non-scaled) free and fixed parameter
+           dictionaries, as for get_nuisance_parameters/get_all_parameters.
+        """
+        if nuisance_only:
+            free_pars, fixed_pars_out = self.get_nuisance_parameters(samples,fixed_pars)
+        else:
+            free_pars, fixed_pars_out = self.get_all_parameters(samples,fixed_pars)
+        pars = c.convert_to_TF_constants({**fixed_pars_out, **free_pars})
+        q = c.normal_neg2logL(samples["x"],pars['mu'],self.sigma)
+        return q, free_pars, fixed_pars_out
+
     def get_all_parameters(self,sample_dict,fixed_pars):
         """Get all parameters (signal and nuisance) to be optimized, for input to "tensorflow_model
            (initial guesses assume free 'mu' and 'theta')
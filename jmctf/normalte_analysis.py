@@ -10,6 +10,9 @@ import copy
 from tensorflow_probability import distributions as tfd
 from .base_analysis import BaseAnalysis
 from . import common as c
+from . import log
+
+logger = log.get_logger(__name__)
 
 # Want to convert all this to YAML. Write a simple container to help with this.
 class NormalTEAnalysis(BaseAnalysis):
@@ -29,6 +32,10 @@ class NormalTEAnalysis(BaseAnalysis):
         self.exact_MLEs =  True # Let driver classes know that we can analytically provide exact MLEs, so no numerical fitting is needed.
         self.const_pars = ['sigma_t']
 
+    def get_spec(self):
+        """Constructor arguments to rebuild this analysis (see parallel.analysis_spec)"""
+        return {"name": self.name, "x_obs": self.x_obs, "sigma": self.sigma}
+
     def tensorflow_model(self,pars):
         """Output tensorflow probability model object, to be combined with models from
            other analysis and sampled from.
@@ -48,9 +55,9 @@ class NormalTEAnalysis(BaseAnalysis):
         mu = pars['mu'] * self.mu_scaling
         theta = pars['theta'] * self.theta_scaling 
  
-        print("mu:", mu)
-        print("theta:", theta)
-        print("sigma_t:", pars['sigma_t'])
+        logger.debug("mu: %s", mu)
+        logger.debug("theta: %s", theta)
+        logger.debug("sigma_t: %s", pars['sigma_t'])
 
         # Normal models
         norm       = tfd.Normal(loc=mu+theta, scale=self.sigma) # TODO: shapes probably need adjustment
@@ -184,6 +191,22 @@ class NormalTEAnalysis(BaseAnalysis):
         # #print("-2logL:", chi2_x + chi2_xt + const_x + const_xt)
         return free_pars, all_fixed_pars
 
+    def profiled_neg2logL(self,samples,fixed_pars,nuisance_only=True):
+        """Closed-form -2*log-likelihood, evaluated at the exact MLEs of the free
+           parameters ('theta' for nuisance-only fits; 'mu' and 'theta' otherwise).
+           Allows fits to skip numerical optimisation and the generic log_prob entirely.
+           Returns -2logL along with the (non-scaled) free and fixed parameter
+           dictionaries, as for get_nuisance_parameters/get_all_parameters.
+        """
+        if nuisance_only:
+            free_pars, fixed_pars_out = self.get_nuisance_parameters(samples,fixed_pars)
+        else:
+            free_pars, fixed_pars_out = self.get_all_parameters(samples,fixed_pars)
+        pars = c.convert_to_TF_constants({**fixed_pars_out, **free_pars})
+        q = c.normal_neg2logL(samples["x"],pars['mu']+pars['theta'],self.sigma) \
+          + c.normal_neg2logL(samples["x_theta"],pars['theta'],pars['sigma_t'])
+        return q, free_pars, fixed_pars_out
+
     def get_all_parameters(self,sample_dict,fixed_pars):
         """Get all parameters (signal and nuisance) to be optimized, for input to "tensorflow_model
            (initial guesses assume free 'mu' and 'theta')
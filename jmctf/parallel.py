@@ -0,0 +1,167 @@
+"""Multi-process toy studies.
+
+   The tensors involved in fitting toys for small analyses (e.g. NormalAnalysis,
+   or BinnedAnalysis with a few signal regions) are too small for TensorFlow's
+   own intra-op parallelism to make use of many cores. Instead, the toys of a
+   run are split into chunks (see JointDistribution.sample_chunks), and the
+   chunks are shared out between a pool of worker processes, each running
+   single-threaded TensorFlow.
+
+   Workers are started with the 'spawn' method (TensorFlow is not fork-safe)
+   and build their own JointDistribution from a serialised specification of
+   the analyses and parameters (see joint_spec), which is sent only once per
+   worker. Each chunk of toys is generated inside the worker from its
+   stateless seed (see rng.py), so toys never need to be transferred between
+   processes, and results are independent of the number of workers. Only
+   compact numpy arrays of fit results are sent back.
+"""
+
+import os
+import itertools
+import importlib
+import multiprocessing
+import concurrent.futures
+import numpy as np
+import tensorflow as tf
+from . import rng
+
+def analysis_spec(analysis):
+    """Serialisable (picklable) specification of an analysis, from which
+       analysis_from_spec can rebuild it. Analyses must provide a 'get_spec'
+       method returning a dictionary of constructor arguments (plain
+       Python/numpy objects) from which an identical copy can be built,
+       i.e. type(analysis)(**analysis.get_spec())."""
+    cls = type(analysis)
+    if not hasattr(analysis, "get_spec"):
+        msg = "Analysis class {0} does not provide a specification (get_spec) from which it can be reconstructed, so cannot be sent to worker processes".format(cls.__name__)
+        raise ValueError(msg)
+    return {"module": cls.__module__, "class": cls.__name__, "args": analysis.get_spec()}
+
+def analysis_from_spec(spec):
+    """Rebuild an analysis from its specification (see analysis_spec)"""
+    cls = getattr(importlib.import_module(spec["module"]), spec["class"])
+    return cls(**spec["args"])
+
+def _to_numpy(d):
+    """Convert nested dictionary of tensors into nested dictionary of numpy arrays"""
+    if isinstance(d, dict):
+        return {k: _to_numpy(v) for k,v in d.items()}
+    return np.asarray(d)
+
+def joint_spec(joint):
+    """Serialisable specification of a JointDistribution: specifications of all
+       its analyses, plus its (non-scaled) parameters, if it has any"""
+    pars = None if joint.pars is None else _to_numpy(joint.get_pars())
+    return {"analyses": [analysis_spec(a) for a in joint.analyses.values()], "pars": pars}
+
+def joint_from_spec(spec):
+    """Rebuild a JointDistribution from its specification (see joint_spec)"""
+    from .joint import JointDistribution
+    return JointDistribution([analysis_from_spec(a) for a in spec["analyses"]], spec["pars"])
+
+# Per-process state of worker processes
+_worker_joint = None
+
+def _init_worker(spec, threads):
+    global _worker_joint
+    try:
+        tf.config.threading.set_intra_op_parallelism_threads(threads)
+        tf.config.threading.set_inter_op_parallelism_threads(threads)
+    except RuntimeError:
+        pass # TensorFlow already initialised in this process; keep its settings
+    _worker_joint = joint_from_spec(spec)
+
+def fit_toy_chunk(joint, N, chunk_size, seed, chunk, fits=("all",), fixed_pars=None, fit_options=None):
+    """Generate chunk number 'chunk' of a run of toys (see JointDistribution.sample_chunk)
+       and fit it with each of the fit types in 'fits' ("all" and/or "nuisance").
+       Returns (event_ids, results), where results is a dictionary keyed by fit type
+       of (log_prob, fitted_pars) tuples of numpy arrays."""
+    fit_options = {"build_joint": False, **({} if fit_options is None else fit_options)}
+    event_ids, samples = joint.sample_chunk(chunk, chunk_size, seed, N)
+    results = {}
+    for fit in fits:
+        if fit=="all":
+            log_prob, joint_fitted, par_dict = joint.fit_all(samples, fixed_pars, **fit_options)
+        elif fit=="nuisance":
+            log_prob, joint_fitted, par_dict = joint.fit_nuisance(samples, fixed_pars, **fit_options)
+        else:
+            msg = "Unknown fit type '{0}' requested! Must be 'all' or 'nuisance'".format(fit)
+            raise ValueError(msg)
+        results[fit] = (np.asarray(log_prob), _to_numpy(par_dict["fitted"]))
+    return event_ids, results
+
+def _run_chunk(N, chunk_size, seed, chunk, fits, fixed_pars, fit_options):
+    return fit_toy_chunk(_worker_joint, N, chunk_size, seed, chunk, fits, fixed_pars, fit_options)
+
+def run_toys(joint, N, seed, chunk_size=10000, fits=("all",), fixed_pars=None, fit_options=None,
+             n_workers=None, threads_per_worker=1, chunks=None, max_pending=None):
+    """Generate and fit N toys from 'joint', sharded across a pool of n_workers worker
+       processes (default: one per CPU core). Generator yielding (event_ids, results)
+       for each chunk as it completes (i.e. not necessarily in order); see
+       fit_toy_chunk for the format of the results, and collect_toy_results to
+       assemble them into full arrays.
+
+       :param joint: JointDistribution (with parameters) to generate toys from.
+               Its analyses must provide get_spec so they can be rebuilt in the workers.
+       :param N: Total number of toys
+       :param seed: Run seed. Chunk i of the toys depends only on (seed, i).
+       :param chunk_size: Number of toys per chunk (the unit of work sent to workers)
+       :param fits: Fit types to perform on every toy ("all" and/or "nuisance")
+       :param fixed_pars: Fixed parameters for the fits (as for fit_all/fit_nuisance)
+       :param fit_options: Extra keyword arguments for fit_all/fit_nuisance
+       :param n_workers: Number of worker processes
+       :param threads_per_worker: TensorFlow threads per worker
+       :param chunks: Indices of chunks to run (default: all), e.g. to resume a run
+       :param max_pending: Maximum number of chunks submitted to the pool but not yet
+               yielded (default: two per worker). Results of completed chunks are held
+               in memory until they are yielded, so this bounds the memory used by
+               results waiting to be consumed, as well as by queued tasks.
+    """
+    if isinstance(fits, str):
+        fits = (fits,)
+    if fixed_pars is not None:
+        fixed_pars = _to_numpy(fixed_pars)
+    if chunks is None:
+        chunks = range(rng.n_chunks(N, chunk_size))
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    if max_pending is None:
+        max_pending = 2*n_workers
+    elif max_pending < 1:
+        msg = "max_pending must be at least 1 (got {0})".format(max_pending)
+        raise ValueError(msg)
+    spec = joint_spec(joint)
+    context = multiprocessing.get_context("spawn")
+    with concurrent.futures.ProcessPoolExecutor(max_workers=n_workers, mp_context=context,
+                                                initializer=_init_worker, initargs=(spec, threads_per_worker)) as pool:
+        chunk_iter = iter(chunks)
+        pending = set()
+        while True:
+            for i in itertools.islice(chunk_iter, max(max_pending - len(pending), 0)):
+                pending.add(pool.submit(_run_chunk, N, chunk_size, seed, i, tuple(fits), fixed_pars, fit_options))
+            if len(pending)==0:
+                break
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for f in done:
+                yield f.result()
+
+def collect_toy_results(chunk_results, N):
+    """Assemble per-chunk results from run_toys (or fit_toy_chunk) into full arrays
+       with N events along the first dimension, ordered by event ID.
+       Returns a dictionary keyed by fit type of (log_prob, fitted_pars)."""
+    out = {}
+    def _fill(target, src, ids):
+        for k,v in src.items():
+            if isinstance(v, dict):
+                _fill(target.setdefault(k, {}), v, ids)
+            else:
+                if k not in target:
+                    target[k] = np.full((N,) + v.shape[1:], np.nan, dtype=v.dtype)
+                target[k][ids] = v
+    for event_ids, results in chunk_results:
+        for fit, (log_prob, pars) in results.items():
+            if fit not in out:
+                out[fit] = ({}, {})
+            _fill(out[fit][0], {"log_prob": log_prob}, event_ids)
+            _fill(out[fit][1], pars, event_ids)
+    return {fit: (lp["log_prob"], pars) for fit,(lp,pars) in out.items()}
@@ -0,0 +1,203 @@
+"""Flat vector representation of JointDistribution parameters.
+
+   Internally, parameters are passed around as nested dictionaries,
+   {analysis name: {parameter name: tensor}}, and hot loops (optimizer steps,
+   Hessian evaluations, quadratic profiling) repeatedly stack them into a
+   single tensor and unstack them again (see common.cat_pars_to_tensor and
+   common.decat_tensor_to_pars), walking the dictionaries and recomputing
+   shapes, column names and scalings every time.
+
+   Here the structure of such a dictionary is instead described once by a
+   ParameterLayout: the order of the parameters, the slice of the flat
+   parameter axis belonging to each, their shapes, the scaling factor of
+   every flat parameter, and the column names used when recording parameters
+   to disk. Layouts without scalings depend only on the structure they
+   describe, so are cached keyed by that structure (see get_layout), and
+   building one for a structure that was seen before is a dictionary lookup.
+   Scalings depend on the analysis objects, so layouts with scalings are not
+   cached here; they are cached by the objects that own the analyses instead
+   (see JointDistribution).
+
+   A ParameterVector holds the values of all parameters as one tensor of shape
+   batch_shape + (n_flat_pars,), along with its layout. Scaling, merging (e.g.
+   of fitted and fixed parameters) and packing are then single vectorised
+   operations on that tensor, and nested dictionaries are only produced
+   (by to_dict/unpack) where they are needed, e.g. to call into the analyses.
+"""
+
+import functools
+import numpy as np
+import tensorflow as tf
+from . import common as c
+
+class ParameterLayout:
+    """Description of how the parameters in a nested parameter dictionary are
+       laid out along the flat parameter axis of a stacked parameter tensor
+
+       :param par_template: Nested dictionary {analysis: {parameter: ...}} whose
+               (ordered) keys define the parameters and their order. Values are ignored.
+       :param par_shapes: Nested dictionary of the primitive (non-batch) shapes of
+               (at least) all parameters in par_template, as returned by the
+               parameter_shapes() method of the analyses.
+       :param analyses: Optional dictionary of analysis objects, from which the
+               scaling factors of the parameters are obtained (see 'scaling').
+    """
+
+    def __init__(self,par_template,par_shapes,analyses=None):
+        self.entries = []
+        i = 0
+        for ka,a in par_template.items():
+            for kp in a.keys():
+                if ka not in par_shapes.keys():
+                    msg = "Failed to build parameter layout! 'par_shapes' dictionary did not contain any shapes for analysis {0}. par_shapes was: {1}".format(ka,par_shapes)
+                    raise ValueError(msg)
+                elif kp not in par_shapes[ka].keys():
+                    msg = "Failed to build parameter layout! 'par_shapes' dictionary did not contain the basic shape of parameter {0} in analysis {1}! par_shapes was: {2}".format(kp,ka,par_shapes)
+                    raise ValueError(msg)
+                shape = tuple(par_shapes[ka][kp])
+                n = c.prod(shape)
+                self.entries += [(ka,kp,shape,i,i+n)]
+                i += n
+        self.n = i
+        self.slices = {(ka,kp): slice(start,stop) for ka,kp,shape,start,stop in self.entries}
+        self.shapes = {(ka,kp): shape for ka,kp,shape,start,stop in self.entries}
+        self._column_names = None
+        self.scaling = None
+        if analyses is not None:
+            self.scaling = self._get_scaling(analyses)
+
+    def _get_scaling(self,analyses):
+        """Scaling factor of every flat parameter, such that scaled = descaled / scaling.
+           Obtained by de-scaling unit parameters with each analysis; parameters that
+           an analysis does not scale get factor 1."""
+        scaling = np.ones(self.n)
+        for ka,kp,shape,start,stop in self.entries:
+            if ka not in analyses.keys():
+                continue
+            descaled = analyses[ka].descale_pars({kp: np.ones(shape)})
+            if kp in descaled.keys():
+                scaling[start:stop] = np.broadcast_to(np.asarray(descaled[kp],dtype=float),shape).reshape(-1)
+        return tf.constant(scaling,dtype=c.TFdtype)
+
+    @property
+    def column_names(self):
+        """Names of the flat parameters, e.g. 'analysis::s_0', for recording to disk"""
+        if self._column_names is None:
+            par_shapes = {}
+            for ka,kp,shape,start,stop in self.entries:
+                par_shapes.setdefault(ka,{})[kp] = shape
+            indices = c.get_parameter_indices(par_shapes)
+            self._column_names = ["{0}::{1}{2}".format(ka,kp,index) for ka,kp,shape,start,stop in self.entries for index in indices[ka][kp]]
+        return self._column_names
+
+    def batch_shape(self,pars):
+        """Broadcast batch shape of a nested parameter dictionary with this layout"""
+        batch_shape = ()
+        for ka,kp,shape,start,stop in self.entries:
+            p = pars[ka][kp]
+            batch_shape = c.get_bcast_shape(p.shape[:len(p.shape)-len(shape)],batch_shape)
+        return tuple(batch_shape)
+
+    def pack(self,pars,flatten_batch=True):
+        """Stack a nested parameter dictionary into a single tensor of shape
+           batch_shape + (n,), broadcasting the batch shapes of all parameters
+           against each other (as common.cat_pars_to_tensor, but without
+           recomputing the column names). If flatten_batch is True then
+           the batch shape is flattened, giving a 2D tensor.
+           Returns (tensor, batch_shape)."""
+        if self.n==0:
+            msg = "Failed to concatenate parameters into tensor!"
+            raise ValueError(msg)
+        batch_shape = self.batch_shape(pars)
+        lead = [c.prod(batch_shape)] if flatten_batch else list(batch_shape)
+        parts = []
+        for ka,kp,shape,start,stop in self.entries:
+            p = tf.broadcast_to(pars[ka][kp],list(batch_shape)+list(shape))
+            parts += [tf.reshape(p,lead+[stop-start])]
+        return tf.concat(parts,axis=-1), batch_shape
+
+    def unpack(self,tensor,batch_shape):
+        """Split a stacked parameter tensor back into a nested dictionary, with
+           batch shape 'batch_shape' (as common.decat_tensor_to_pars)"""
+        out = {}
+        for ka,kp,shape,start,stop in self.entries:
+            out.setdefault(ka,{})[kp] = tf.reshape(tensor[...,start:stop],list(batch_shape)+list(shape))
+        return out
+
+    def scale(self,tensor):
+        """Apply parameter scaling to a stacked parameter tensor"""
+        return tensor / self.scaling
+
+    def descale(self,tensor):
+        """Remove parameter scaling from a stacked parameter tensor"""
+        return tensor * self.scaling
+
+    def mask(self,names):
+        """Boolean vector selecting the flat parameters of the parameters in
+           'names', a dictionary {analysis: [parameter names]}"""
+        m = np.zeros(self.n,dtype=bool)
+        for ka,kp,shape,start,stop in self.entries:
+            if kp in names.get(ka,()):
+                m[start:stop] = True
+        return tf.constant(m)
+
+def layout_key(par_template,par_shapes):
+    """Hashable description of the structure of a parameter dictionary"""
+    return tuple((ka,kp,tuple(par_shapes[ka][kp])) for ka,a in par_template.items() for kp in a.keys())
+
+@functools.lru_cache(maxsize=256)
+def _structural_layout(key):
+    """Unscaled ParameterLayout for the structure described by 'key' (see layout_key)"""
+    par_template = {}
+    par_shapes = {}
+    for ka,kp,shape in key:
+        par_template.setdefault(ka,{})[kp] = None
+        par_shapes.setdefault(ka,{})[kp] = shape
+    return ParameterLayout(par_template,par_shapes)
+
+def get_layout(par_template,par_shapes,analyses=None):
+    """Get the ParameterLayout for a parameter dictionary structure. Layouts
+       without scalings are cached (keyed on the structure only). Layouts with
+       scalings (analyses given) are built afresh, since the scalings belong to
+       the analysis objects; callers that need them repeatedly should keep them."""
+    if analyses is not None:
+        return ParameterLayout(par_template,par_shapes,analyses)
+    return _structural_layout(layout_key(par_template,par_shapes))
+
+class ParameterVector:
+    """Values of a set of parameters stored as one tensor, of shape
+       batch_shape + (layout.n,), along with their ParameterLayout"""
+
+    def __init__(self,values,layout,batch_shape):
+        self.values = values
+        self.layout = layout
+        self.batch_shape = tuple(batch_shape)
+
+    @classmethod
+    def from_dict(cls,pars,par_shapes,analyses=None):
+        """Build from a nested parameter dictionary (batch dimensions are broadcast)"""
+        layout = get_layout(pars,par_shapes,analyses)
+        values, batch_shape = layout.pack(c.convert_to_TF_constants(pars,ignore_variables=True),flatten_batch=False)
+        return cls(values,layout,batch_shape)
+
+    def to_dict(self):
+        return self.layout.unpack(self.values,self.batch_shape)
+
+    def scaled(self):
+        return ParameterVector(self.layout.scale(self.values),self.layout,self.batch_shape)
+
+    def descaled(self):
+        return ParameterVector(self.layout.descale(self.values),self.layout,self.batch_shape)
+
+    def merge(self,other,mask):
+        """Take values from 'other' (same layout) where the boolean vector
+           'mask' (see ParameterLayout.mask) is True, and from this vector elsewhere"""
+        if other.layout is not self.layout:
+            msg = "Cannot merge ParameterVectors with different layouts!"
+            raise ValueError(msg)
+        batch_shape = c.get_bcast_shape(self.batch_shape,other.batch_shape)
+        return ParameterVector(tf.where(mask,other.values,self.values),self.layout,batch_shape)
+
+    def __getitem__(self,key):
+        """Value of parameter key=(analysis, parameter), with its proper shape"""
+        return tf.reshape(self.values[...,self.layout.slices[key]],list(self.batch_shape)+list(self.layout.shapes[key]))
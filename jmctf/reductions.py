@@ -0,0 +1,237 @@
+"""Streaming reductions of -2*log-likelihood values over very large sets of
+   hypotheses, e.g. for look-elsewhere effect calculations where we only need
+   the best-fitting hypothesis for each event (toy), but have millions of
+   hypotheses. Results are accumulated chunk by chunk, so the full
+   events x hypotheses matrix never needs to be stored."""
+
+import numpy as np
+import pandas as pd
+from . import sql_helpers
+
+class BestFitReducer:
+    """Keeps running per-event minimum -2logL (and the ID of the hypothesis
+       giving it), or more generally the top_k lowest values and their IDs,
+       over hypotheses supplied in chunks.
+
+       Results are available as 'neg2logL' and 'ids', arrays of shape
+       (n_events,top_k) sorted so that column 0 is the best fit, or as
+       'min' and 'argmin' (shape (n_events,)) for just the best fit.
+       Events for which no finite value has been seen have neg2logL=inf and
+       ID -1. NaN values (e.g. from failed evaluations) are ignored.
+
+       Hypothesis IDs are integers; by default the position of each
+       hypothesis in the overall sequence of hypotheses, i.e. its position
+       within the current chunk plus 'hypothesis_offset'. When used as the
+       reducer for JointDistribution.log_prob_quad_tiled, call next_chunk
+       after each chunk of hypotheses to advance the offset.
+    """
+
+    def __init__(self,n_events,top_k=1):
+        self.n_events = n_events
+        self.top_k = top_k
+        self.neg2logL = np.full((n_events,top_k),np.inf)
+        self.ids = np.full((n_events,top_k),-1,dtype=np.int64)
+        self.hypothesis_offset = 0
+
+    @property
+    def min(self):
+        return self.neg2logL[:,0]
+
+    @property
+    def argmin(self):
+        return self.ids[:,0]
+
+    def next_chunk(self,n_hypotheses):
+        """Advance the hypothesis ID offset past a completed chunk of n_hypotheses"""
+        self.hypothesis_offset += n_hypotheses
+
+    def update(self,neg2logL,event_slice=slice(None),hypothesis_ids=None):
+        """Fold in -2logL values for a chunk of events and hypotheses.
+
+           neg2logL should have shape (n_events_in_chunk,...,n_hypotheses_in_chunk),
+           where any dimensions in between have size 1. hypothesis_ids gives the
+           IDs of the hypotheses along the last axis (default: consecutive
+           integers starting from hypothesis_offset).
+        """
+        neg2logL = np.asarray(neg2logL,dtype=np.float64)
+        if np.prod(neg2logL.shape[1:-1])!=1:
+            msg = "Could not interpret -2logL values of shape {0} for reduction! Expected shape (n_events,...,n_hypotheses), with any extra dimensions in between having size 1".format(neg2logL.shape)
+            raise ValueError(msg)
+        neg2logL = neg2logL.reshape(neg2logL.shape[0],neg2logL.shape[-1])
+        n_e, n_h = neg2logL.shape
+        if hypothesis_ids is None:
+            hypothesis_ids = self.hypothesis_offset + np.arange(n_h)
+        hypothesis_ids = np.asarray(hypothesis_ids,dtype=np.int64)
+        if hypothesis_ids.shape!=(n_h,):
+            msg = "Number of hypothesis IDs ({0}) does not match number of hypotheses in -2logL values ({1})".format(hypothesis_ids.shape,n_h)
+            raise ValueError(msg)
+        neg2logL = np.where(np.isnan(neg2logL),np.inf,neg2logL)
+
+        current_vals = self.neg2logL[event_slice]
+        current_ids = self.ids[event_slice]
+        if current_vals.shape[0]!=n_e:
+            msg = "Number of events in -2logL values ({0}) does not match the size of the selected event slice ({1})".format(n_e,current_vals.shape[0])
+            raise ValueError(msg)
+
+        if self.top_k==1:
+            # Fast path: just a running minimum
+            i = np.argmin(neg2logL,axis=-1)
+            chunk_min = np.take_along_axis(neg2logL,i[:,np.newaxis],axis=-1)
+            better = chunk_min < current_vals
+            self.neg2logL[event_slice] = np.where(better,chunk_min,current_vals)
+            self.ids[event_slice] = np.where(better,hypothesis_ids[i][:,np.newaxis],current_ids)
+        else:
+            vals = np.concatenate([current_vals,neg2logL],axis=-1)
+            ids = np.concatenate([current_ids,np.broadcast_to(hypothesis_ids,(n_e,n_h))],axis=-1)
+            k = self.top_k
+            if vals.shape[-1] > k:
+                part = np.argpartition(vals,k-1,axis=-1)[:,:k]
+                vals = np.take_along_axis(vals,part,axis=-1)
+                ids = np.take_along_axis(ids,part,axis=-1)
+            order = np.argsort(vals,axis=-1,kind="stable")
+            self.neg2logL[event_slice] = np.take_along_axis(vals,order,axis=-1)
+            self.ids[event_slice] = np.where(np.isinf(self.neg2logL[event_slice]),-1,np.take_along_axis(ids,order,axis=-1))
+
+    def __call__(self,log_prob,event_slice,hypothesis_slice):
+        """Reducer interface for JointDistribution.log_prob_quad_tiled.
+           Takes log_prob (not -2logL) values for a tile; hypothesis IDs are
+           offset by hypothesis_offset"""
+        ids = self.hypothesis_offset + np.arange(hypothesis_slice.start,hypothesis_slice.stop)
+        self.update(-2*np.asarray(log_prob),event_slice,ids)
+
+class EventReductionBuffer:
+    """In-memory buffer of per-event running minima (or maxima) of some value
+       (e.g. -2logL), keyed by EventID, along with the ID of the hypothesis
+       achieving it (and optionally other columns carried along with it, e.g.
+       fitted parameters).
+
+       Replaces repeated database upserts (sql_helpers.upsert_if_smaller) for
+       every chunk of hypotheses: updates are vectorised reductions in memory,
+       and the database is only written on flush, which happens every
+       flush_every updates (if a target is given) and on close. Flushes use
+       'upsert_if_smaller_by'/'upsert_if_larger_by' so that rows already in the
+       database are only replaced by better ones, with the hypothesis ID and
+       carried columns kept consistent with the value.
+
+       :param table_name: Table to write to on flush
+       :param target: Where to flush to: an sqlite3 cursor, a sql_helpers.SQLiteWriter,
+               or a column_store.ColumnStore (or None, for no automatic flushing)
+       :param mode: "min" or "max"
+       :param value_column: Name of the reduced column
+       :param id_column: Name of the column of IDs of the best hypotheses
+       :param primary: Name of the EventID column
+       :param flush_every: Number of calls to update between automatic flushes (default: only on close)
+    """
+
+    def __init__(self,table_name,target=None,mode="min",value_column="neg2logL",id_column="hypID",primary="EventID",flush_every=None):
+        if mode not in ("min","max"):
+            msg = "EventReductionBuffer mode must be 'min' or 'max' (got '{0}')".format(mode)
+            raise ValueError(msg)
+        self.table_name = table_name
+        self.target = target
+        self.mode = mode
+        self.value_column = value_column
+        self.id_column = id_column
+        self.primary = primary
+        self.flush_every = flush_every
+        self.n_updates = 0
+        self.clear()
+
+    def clear(self):
+        """Empty the buffer (without flushing)"""
+        self.event_ids = np.zeros(0,dtype=np.int64)
+        self.values = np.zeros(0)
+        self.ids = np.zeros(0,dtype=np.int64)
+        self.extra = None
+
+    def __len__(self):
+        return len(self.event_ids)
+
+    def update(self,event_ids,values,hypothesis_ids=None,extra=None):
+        """Fold in values for a chunk of events and hypotheses.
+
+           values has shape (n_events,...,n_hypotheses) (intermediate dimensions
+           must have size 1), or (n_events,) for a single hypothesis. event_ids
+           (shape (n_events,)) must be unique within one update. hypothesis_ids
+           (shape (n_hypotheses,)) defaults to 0,1,2,... extra is an optional
+           dictionary of further columns, of the same shape as values, whose
+           entries for the best hypothesis are kept along with the value.
+           NaN values are ignored.
+        """
+        event_ids = np.asarray(event_ids,dtype=np.int64)
+        values = np.asarray(values,dtype=np.float64)
+        n_e = len(event_ids)
+        if values.ndim==1:
+            values = values[:,np.newaxis]
+        if values.shape[0]!=n_e or np.prod(values.shape[1:-1])!=1:
+            msg = "Could not interpret values of shape {0} for {1} events! Expected shape (n_events,...,n_hypotheses), with any extra dimensions in between having size 1".format(values.shape,n_e)
+            raise ValueError(msg)
+        values = values.reshape(n_e,values.shape[-1])
+        n_h = values.shape[-1]
+        if hypothesis_ids is None:
+            hypothesis_ids = np.arange(n_h)
+        hypothesis_ids = np.asarray(hypothesis_ids,dtype=np.int64)
+        sign = 1 if self.mode=="min" else -1
+        # Best hypothesis for each event within this chunk
+        v = np.where(np.isnan(values),np.inf,sign*values)
+        i = np.argmin(v,axis=-1)
+        best = np.take_along_axis(v,i[:,np.newaxis],axis=-1)[:,0]
+        keep = np.isfinite(best)
+        new_extra = None
+        if extra is not None:
+            new_extra = {k: np.take_along_axis(np.asarray(x).reshape(n_e,n_h),i[:,np.newaxis],axis=-1)[keep,0] for k,x in extra.items()}
+        self._merge(event_ids[keep], sign*best[keep], hypothesis_ids[i][keep], new_extra)
+        self.n_updates += 1
+        if self.target is not None and self.flush_every is not None and self.n_updates % self.flush_every == 0:
+            self.flush()
+
+    def _merge(self,event_ids,values,ids,extra):
+        if (extra is None) != (self.extra is None) and len(self)>0:
+            msg = "Extra columns must be supplied either always or never for one EventReductionBuffer"
+            raise ValueError(msg)
+        sign = 1 if self.mode=="min" else -1
+        all_events = np.concatenate([self.event_ids,event_ids])
+        all_values = np.concatenate([self.values,values])
+        # Sort by event, then by value, and keep the first (best) entry for each event
+        order = np.lexsort((sign*all_values,all_events))
+        first = np.ones(len(order),dtype=bool)
+        first[1:] = all_events[order][1:]!=all_events[order][:-1]
+        sel = order[first]
+        self.event_ids = all_events[sel]
+        self.values = all_values[sel]
+        self.ids = np.concatenate([self.ids,ids])[sel]
+        if extra is not None:
+            old = self.extra if self.extra is not None else {k: np.zeros((0,)+x.shape[1:],dtype=x.dtype) for k,x in extra.items()}
+            self.extra = {k: np.concatenate([old[k],extra[k]])[sel] for k in extra.keys()}
+
+    def to_dataframe(self):
+        """Current buffer contents as a DataFrame indexed by EventID"""
+        cols = {self.value_column: self.values, self.id_column: self.ids}
+        if self.extra is not None:
+            cols.update(self.extra)
+        return pd.DataFrame(cols,index=pd.Index(self.event_ids,name=self.primary))
+
+    def flush(self,target=None):
+        """Write the buffer contents to the target (default: the target given at
+           construction), keeping only improvements over what is already stored,
+           and empty the buffer."""
+        target = self.target if target is None else target
+        if target is None:
+            msg = "No target supplied to flush EventReductionBuffer to"
+            raise ValueError(msg)
+        if len(self)==0:
+            return
+        df = self.to_dataframe()
+        method = "upsert_if_smaller_by" if self.mode=="min" else "upsert_if_larger_by"
+        if hasattr(target,method):
+            # SQLiteWriter or ColumnStore
+            getattr(target,method)(self.table_name,df,self.primary,self.value_column)
+        else:
+            # Raw sqlite cursor
+            getattr(sql_helpers,method)(target,self.table_name,df,self.primary,self.value_column)
+        self.clear()
+
+    def close(self):
+        """Flush any remaining contents (if there is a target)"""
+        if self.target is not None:
+            self.flush()
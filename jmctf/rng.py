@@ -0,0 +1,70 @@
+"""Counter-based ('stateless') random seeds for reproducible toy generation.
+
+   Toys generated using the global TensorFlow random state depend on
+   everything else that has consumed random numbers beforehand, so a run
+   split across processes, or resumed after an interruption, gives
+   different toys. Instead, every chunk of toys can be generated with the
+   TFP stateless samplers, using a seed computed purely from (run seed,
+   chunk index) by folding the counters into the run seed. Any chunk can
+   then be regenerated independently and identically on any worker, in any
+   order, which allows sharded parallel generation, regenerating toys rather
+   than storing them, and exact resumption of interrupted runs.
+
+   Separate 'streams' (integers or string labels) give independent seeds for
+   different purposes within the same run and chunk, e.g. for the samples
+   themselves and for the allocation of samples between importance
+   sampling proposals.
+"""
+
+import zlib
+import numpy as np
+import tensorflow as tf
+
+def run_seed(seed):
+    """Stateless seed (shape (2,) int32 tensor) for a run, from an integer seed of any size.
+       Seeds that are already stateless seed tensors/arrays of shape (2,) are passed through."""
+    if np.ndim(seed)==1 and np.shape(seed)[0]==2:
+        return tf.cast(seed,tf.int32)
+    if not isinstance(seed,(int,np.integer)) or seed<0:
+        msg = "Run seed must be a non-negative integer (or a stateless seed of shape (2,)), got {0}".format(seed)
+        raise ValueError(msg)
+    state = np.random.SeedSequence(int(seed)).generate_state(2)
+    return tf.constant(state.astype(np.int64) % 2**31, dtype=tf.int32)
+
+def _stream_id(stream):
+    if isinstance(stream,str):
+        return zlib.crc32(stream.encode()) % 2**31 # Stable across processes, unlike hash()
+    return int(stream)
+
+def chunk_seed(seed, chunk, stream=0):
+    """Stateless seed for chunk number 'chunk' of the run with seed 'seed', in
+       the given stream. Depends only on its arguments."""
+    s = tf.random.experimental.stateless_fold_in(run_seed(seed), _stream_id(stream))
+    return tf.random.experimental.stateless_fold_in(s, int(chunk))
+
+def numpy_rng(seed):
+    """NumPy Generator initialised deterministically from a stateless seed, for any
+       random choices that need to be made outside of TensorFlow"""
+    return np.random.default_rng(np.asarray(seed).astype(np.int64) % 2**31)
+
+def chunk_events(N, chunk_size, chunk):
+    """Indices of the events belonging to chunk number 'chunk', when N events are
+       split into chunks of size chunk_size"""
+    start = int(chunk)*int(chunk_size)
+    if start>=N or chunk<0:
+        msg = "Chunk {0} is out of range for {1} events in chunks of size {2}".format(chunk,N,chunk_size)
+        raise ValueError(msg)
+    return np.arange(start,min(start+int(chunk_size),int(N)))
+
+def n_chunks(N, chunk_size):
+    """Number of chunks needed to hold N events"""
+    return -(-int(N) // int(chunk_size))
+
+def shard_chunks(N, chunk_size, shard, n_shards, start_chunk=0):
+    """Chunk indices to be generated by worker number 'shard' (of n_shards) when the
+       chunks of a run are divided between workers round-robin, skipping any chunks
+       before start_chunk (e.g. those already completed when resuming a run)"""
+    if not 0 <= shard < n_shards:
+        msg = "Shard index {0} out of range for {1} shards".format(shard,n_shards)
+        raise ValueError(msg)
+    return [i for i in range(int(start_chunk),n_chunks(N,chunk_size)) if i % n_shards == shard]
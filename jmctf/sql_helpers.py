@@ -1,6 +1,13 @@
 """Small helper functions for interacting with sqlite3 databases"""
 
+import time
+import queue as queue_module
+import sqlite3
+import functools
+import threading
 import numpy as np
+from . import common as c
+from . import telemetry
 
 def create_table(cursor,table_name,columns):
     """Create an SQLite table if it doesn't already exist"""
@@ -22,14 +29,14 @@ def add_columns(cursor,table_name,columns):
     for command in commands:
        cursor.execute(command)
 
-def upsert(cursor,table_name,df,primary):
-    """Insert or overwrite data into a set of SQL columns.
-       Data assumed to be a pandas dataframe. Must specify
-       which column contains the primary key.
-    """
-    rec = df.to_records()
-    #print("rec:",rec)
-    columns = df.to_records().dtype.names  
+@functools.lru_cache(maxsize=256)
+def _upsert_command(table_name,columns,primary,op=None,key=None):
+    """Build (and cache) the SQL text for upsert/upsert_if/upsert_if_by. columns must
+       be a tuple. If op is None existing values are overwritten. Otherwise, if key
+       is None, each existing value is only replaced if it compares true against
+       the new value under op; if key is given, whole rows are replaced if the
+       new value of column 'key' compares true against the existing one under op
+       (or there is no existing value)."""
     command = "INSERT INTO `{0}` (`{1}`".format(table_name,columns[0])
     if len(columns)>1:
         for col in columns[1:]:
@@ -41,10 +48,27 @@ def upsert(cursor,table_name,df,primary):
     command += ")"
     if len(columns)>1:
         command += " ON CONFLICT(`{0}`) DO UPDATE SET ".format(primary)
-        for j,col in enumerate(columns):
-            if col is not primary:
-                command += "`{0}`=excluded.`{0}`".format(col)
-                if j<len(columns)-1: command += ","
+        updates = []
+        for col in columns:
+            if col != primary:
+                if op is None:
+                    updates += ["`{0}`=excluded.`{0}`".format(col)]
+                elif key is not None:
+                    # All SET expressions see the original row values, so 'key' here is the old key value
+                    updates += ["`{0}` = CASE WHEN `{1}` IS NULL OR excluded.`{1}`{2}`{1}` THEN excluded.`{0}` ELSE `{0}` END".format(col,key,op)]
+                else:
+                    updates += ["`{0}` = CASE      WHEN `{0}`{1}excluded.`{0}` THEN `{0}`      ELSE excluded.`{0}`      END".format(col,op)]
+        command += ",".join(updates)
+    return command
+
+@telemetry.timed("sql:upsert", items=lambda cursor,table_name,df,*args,**kwargs: len(df))
+def upsert(cursor,table_name,df,primary):
+    """Insert or overwrite data into a set of SQL columns.
+       Data assumed to be a pandas dataframe. Must specify
+       which column contains the primary key.
+    """
+    rec = df.to_records()
+    command = _upsert_command(table_name,tuple(rec.dtype.names),primary)
     #print("command:", command)
     cursor.executemany(command,  map(tuple, rec.tolist())) # sqlite3 doesn't understand numpy types, so need to convert to standard list. Seems fast enough though.
 
@@ -58,36 +82,43 @@ def upsert_if_larger(cursor,table_name,df,primary):
     """
     return upsert_if(cursor,table_name,df,primary,">")
   
+@telemetry.timed("sql:upsert_if", items=lambda cursor,table_name,df,*args,**kwargs: len(df))
 def upsert_if(cursor,table_name,df,primary,op):
     """Common function for upsert_if_smaller/larger
     """
     rec = df.to_records()
-    #print("rec:",rec)
-    columns = df.to_records().dtype.names  
-    command = "INSERT INTO `{0}` (`{1}`".format(table_name,columns[0])
-    if len(columns)>1:
-        for col in columns[1:]:
-            command += ",`{0}`".format(col)
-    command += ") VALUES (?"
-    if len(columns)>1:
-        for col in columns[1:]:
-            command += ",?"
-    command += ")"
-    if len(columns)>1:
-        command += " ON CONFLICT(`{0}`) DO UPDATE SET ".format(primary)
-        for j,col in enumerate(columns):
-            if col is not primary:
-                command += "`{0}` = CASE".format(col)
-                command += "      WHEN `{0}`{1}excluded.`{0}` THEN `{0}`".format(col,op)
-                command += "      ELSE excluded.`{0}`".format(col)
-                command += "      END"
-                if j<len(columns)-1: command += ","
+    command = _upsert_command(table_name,tuple(rec.dtype.names),primary,op)
     #print("command:", command)
     cursor.executemany(command,  map(tuple, rec.tolist())) # sqlite3 doesn't understand numpy types, so need to convert to standard list. Seems fast enough though.
 
-def insert_as_arrays(cursor,table_name,df):
+def upsert_if_smaller_by(cursor,table_name,df,primary,key):
+    """As upsert, but only replaces existing rows (all columns together) if the new
+       value in column 'key' is smaller than the existing one. Unlike
+       upsert_if_smaller, this keeps associated columns (e.g. the ID of the best
+       fitting hypothesis) consistent with the minimum.
+    """
+    return upsert_if_by(cursor,table_name,df,primary,key,"<")
+
+def upsert_if_larger_by(cursor,table_name,df,primary,key):
+    """As upsert_if_smaller_by, but for keeping rows with the largest 'key' values.
+    """
+    return upsert_if_by(cursor,table_name,df,primary,key,">")
+
+@telemetry.timed("sql:upsert_if_by", items=lambda cursor,table_name,df,*args,**kwargs: len(df))
+def upsert_if_by(cursor,table_name,df,primary,key,op):
+    """Common function for upsert_if_smaller_by/larger_by
+    """
+    rec = df.to_records()
+    command = _upsert_command(table_name,tuple(rec.dtype.names),primary,op,key)
+    cursor.executemany(command,  map(tuple, rec.tolist()))
+
+@telemetry.timed("sql:insert_as_arrays", items=lambda cursor,table_name,df,*args,**kwargs: len(df))
+def insert_as_arrays(cursor,table_name,df,compression=None):
     """Do not treat Pandas rows as SQL rows; just dump each 
-       column into one SQL entry as BLOB data"""
+       column into one SQL entry as BLOB data (see common.encode_array).
+       compression may be a codec name (see common.array_codecs), a dictionary
+       mapping column names to codecs, or "auto" to choose a codec for each
+       column by measurement (see common.choose_compression)."""
 
     columns = df.to_records().dtype.names[1:] # remove index column, don't care about it for this  
     command = "INSERT INTO {0} ({1}".format(table_name,columns[0])
@@ -100,44 +131,120 @@ def insert_as_arrays(cursor,table_name,df):
             command += ",?"
     command += ")"
 
-    cursor.execute(command, df.to_numpy().T) # Storing entire dataframe column as one entry in an SQL row
-
+    values = []
+    for col in columns:
+        arr = df[col].to_numpy() # Column by column, so that each keeps its own dtype
+        if compression=="auto":
+            codec = c.choose_compression(arr)
+        elif isinstance(compression,dict):
+            codec = compression.get(col,None)
+        else:
+            codec = compression
+        values += [sqlite3.Binary(c.encode_array(arr,codec))]
+    cursor.execute(command, values) # Storing entire dataframe column as one entry in an SQL row
 
-def load(cursor,table_name,cols,keys=None,primary=None):
-    """Load data from an sql table
-       with simple selection of items by primary key values.
-       Compressed primary key values into a set of ranges to
-       construct more efficient queries.
-       Assumes the primary key values are supplied 
-       in ascending order. If keys is None, all rows are loaded."""
+def migrate_array_columns(cursor,table_name,cols,compression=None):
+    """Re-encode BLOB array data in the given columns of an existing table from
+       the older np.save-based format into the current binary array format
+       (optionally compressed; see insert_as_arrays). Cells already in the
+       current format are left alone. Returns the number of cells converted."""
+    command = "SELECT rowid"
+    for col in cols:
+        command += ",CAST(`{0}` AS BLOB)".format(col) # CAST avoids any registered converters
+    command += " from `{0}`".format(table_name)
+    rows = cursor.execute(command).fetchall()
+    n = 0
+    for row in rows:
+        for col,val in zip(cols,row[1:]):
+            if val is None or bytes(val[:4])==c.array_magic:
+                continue
+            codec = compression.get(col,None) if isinstance(compression,dict) else compression
+            new = sqlite3.Binary(c.encode_array(c.decode_array(val),codec))
+            cursor.execute("UPDATE `{0}` SET `{1}`=? WHERE rowid=?".format(table_name,col),(new,row[0]))
+            n += 1
+    return n
 
-    if keys is not None:
-        splitdata = np.split(keys, np.where(np.diff(keys) != 1)[0]+1)
-        ranges = [(np.min(x), np.max(x)) for x in splitdata]
+# Max number of primary key ranges per query; keeps the number of bound parameters
+# below the SQLITE_MAX_VARIABLE_NUMBER limit of older sqlite versions (999)
+max_ranges_per_query = 400
 
+def _select_queries(table_name,cols,keys=None,primary=None):
+    """Build parameterised SELECT queries for the given columns, optionally
+       restricted to rows whose primary key values are in 'keys' (which are
+       compressed into ranges of consecutive values). Returns a list of
+       (command, parameters) pairs."""
     if len(cols)==0:
         msg = "SQL load from table `{0}` failed: no columns specified! (cols={1})".format(table_name,cols)
         raise ValueError(msg)
 
-    # Check columns
-    #c.execute('PRAGMA table_info({0})'.format(table_name))
-    #results = c.fetchall()
-    #print("cols: ", cols)
-
     command = "SELECT "
     for col in cols:
         command += "`{0}`,".format(col)
     command = command[:-1]
     command += " from `{0}`".format(table_name)
 
-    if keys is not None:
-        command += " WHERE "
-        for i,(start, stop) in enumerate(ranges):
-            command += " `{0}` BETWEEN {1} and {2}".format(primary,start,stop) # inclusive 'between' 
-            if i<len(ranges)-1: command += " OR "
-    #print("command:", command)
-    cursor.execute(command)
-    return cursor.fetchall() 
+    if keys is None:
+        return [(command, [])]
+    keys = np.asarray(keys)
+    if len(keys)==0:
+        return []
+    splitdata = np.split(keys, np.where(np.diff(keys) != 1)[0]+1)
+    ranges = [(int(np.min(x)), int(np.max(x))) for x in splitdata]
+    queries = []
+    for i in range(0,len(ranges),max_ranges_per_query):
+        group = ranges[i:i+max_ranges_per_query]
+        where = " OR ".join(["`{0}` BETWEEN ? and ?".format(primary)]*len(group)) # inclusive 'between'
+        queries += [(command + " WHERE " + where, [x for r in group for x in r])]
+    return queries
+
+@telemetry.timed("sql:load", items=lambda cursor,table_name,cols,keys=None,*args,**kwargs: 0 if keys is None else len(keys))
+def load(cursor,table_name,cols,keys=None,primary=None):
+    """Load data from an sql table
+       with simple selection of items by primary key values.
+       Compressed primary key values into a set of ranges to
+       construct more efficient queries.
+       Assumes the primary key values are supplied 
+       in ascending order. If keys is None, all rows are loaded.
+       Returns a list of row tuples; see iter_load for a constant-memory
+       alternative."""
+    results = []
+    for command, params in _select_queries(table_name,cols,keys,primary):
+        cursor.execute(command,params)
+        results += cursor.fetchall()
+    return results
+
+def _to_column(values):
+    if len(values)>0 and isinstance(values[0],np.ndarray):
+        return np.stack(values)
+    return np.asarray(values)
+
+def iter_load(cursor,table_name,cols,keys=None,primary=None,chunk_size=10000,out=None):
+    """As load, but a generator yielding the results in chunks of at most
+       chunk_size rows (fetched with cursor.fetchmany), each as a dictionary of
+       numpy arrays, one per column. Memory use is thus bounded by the chunk size.
+
+       If 'out' is supplied (a preallocated numpy structured array with fields named
+       after the columns, e.g. from np.zeros(N,dtype=[(col,type),...])), then
+       each chunk is instead written into successive rows of 'out', and the
+       view out[start:stop] of the rows just filled is yielded.
+    """
+    start = 0
+    for command, params in _select_queries(table_name,cols,keys,primary):
+        cursor.execute(command,params)
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if len(rows)==0:
+                break
+            if out is not None:
+                stop = start + len(rows)
+                if stop > len(out):
+                    msg = "Preallocated output array (length {0}) is too short for the rows selected from table `{1}`".format(len(out),table_name)
+                    raise ValueError(msg)
+                out[start:stop] = rows # Direct conversion of row tuples into structured array
+                yield out[start:stop]
+                start = stop
+            else:
+                yield {col: _to_column([r[i] for r in rows]) for i,col in enumerate(cols)}
 
 def table_info(cursor,table):
     """Return table metadata"""
@@ -155,3 +262,161 @@ def check_table_exists(cursor,table):
     else:
         return False
 
+class SQLiteWriter:
+    """Single writer for an sqlite database, which owns the database connection
+       in a background thread and applies write operations taken from a queue.
+       Producers (fitting loops, worker threads, or worker processes when a
+       multiprocessing queue is supplied) just put results on the queue and
+       carry on, so computation never waits for the disk, and there is never
+       more than one writer competing for the database lock.
+
+       The connection uses WAL journaling and relaxed ('NORMAL') synchronous
+       mode, and writes are grouped into large transactions, committed once
+       batch_rows rows have been written or flush_interval seconds have
+       passed (or on flush/close). In WAL mode, readers (e.g. sql_helpers.load
+       on other connections) are not blocked by the writer.
+
+       Operations are tuples (op, table_name, data, primary), where op is one of
+       "upsert", "upsert_if_smaller", "upsert_if_larger", "create_table" (with
+       data being the column list), "upsert_if_smaller_by" and
+       "upsert_if_larger_by" (with primary being a (primary, key) tuple), or
+       "insert_as_arrays" (with primary being the 'compression' argument of
+       insert_as_arrays). Use the methods of the same names, or put such tuples
+       directly on 'queue' from other processes.
+
+       Errors raised in the writer thread are re-raised in the owning thread on
+       the next call to submit, flush or close.
+    """
+
+    ops = {"upsert": upsert, "upsert_if_smaller": upsert_if_smaller, "upsert_if_larger": upsert_if_larger,
+           "upsert_if_smaller_by": lambda cur,table_name,df,primary_key: upsert_if_smaller_by(cur,table_name,df,*primary_key),
+           "upsert_if_larger_by": lambda cur,table_name,df,primary_key: upsert_if_larger_by(cur,table_name,df,*primary_key),
+           "insert_as_arrays": lambda cur,table_name,df,compression: insert_as_arrays(cur,table_name,df,compression),
+           "create_table": lambda cur,table_name,columns,primary: create_table(cur,table_name,columns)}
+
+    def __init__(self,filename,batch_rows=100000,flush_interval=1.,queue=None,maxsize=64,synchronous="NORMAL"):
+        self.filename = filename
+        self.batch_rows = batch_rows
+        self.flush_interval = flush_interval
+        self.synchronous = synchronous
+        self.queue = queue_module.Queue(maxsize) if queue is None else queue
+        self.error = None
+        self._flush_requested = 0
+        self._flush_done = 0
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run,daemon=True)
+        self._thread.start()
+
+    def _check_error(self):
+        if self.error is not None:
+            msg = "SQLiteWriter background thread failed while writing to {0}".format(self.filename)
+            raise RuntimeError(msg) from self.error
+
+    def submit(self,op,table_name,data,primary=None):
+        """Queue a write operation (see class docstring)"""
+        self._check_error()
+        if op not in self.ops.keys():
+            msg = "Unknown SQLiteWriter operation '{0}'! Must be one of {1}".format(op,list(self.ops.keys()))
+            raise ValueError(msg)
+        self._put((op,table_name,data,primary))
+
+    def _put(self,item):
+        # Don't block forever on a full queue if the writer thread has died
+        while True:
+            try:
+                self.queue.put(item,timeout=1)
+                return
+            except queue_module.Full:
+                self._check_error()
+
+    def create_table(self,table_name,columns):
+        self.submit("create_table",table_name,columns)
+
+    def upsert(self,table_name,df,primary):
+        self.submit("upsert",table_name,df,primary)
+
+    def upsert_if_smaller(self,table_name,df,primary):
+        self.submit("upsert_if_smaller",table_name,df,primary)
+
+    def upsert_if_larger(self,table_name,df,primary):
+        self.submit("upsert_if_larger",table_name,df,primary)
+
+    def upsert_if_smaller_by(self,table_name,df,primary,key):
+        self.submit("upsert_if_smaller_by",table_name,df,(primary,key))
+
+    def upsert_if_larger_by(self,table_name,df,primary,key):
+        self.submit("upsert_if_larger_by",table_name,df,(primary,key))
+
+    def insert_as_arrays(self,table_name,df,compression=None):
+        self.submit("insert_as_arrays",table_name,df,compression)
+
+    def flush(self):
+        """Block until all operations queued so far (by this process) have been
+           written and committed"""
+        self._check_error()
+        with self._cond:
+            self._flush_requested += 1
+            token = self._flush_requested
+        self._put(("flush",token))
+        with self._cond:
+            self._cond.wait_for(lambda: self._flush_done >= token or self.error is not None)
+        self._check_error()
+
+    def close(self):
+        """Write everything remaining, commit, and stop the writer thread"""
+        if self._thread.is_alive():
+            self._put(("close",))
+            self._thread.join()
+        self._check_error()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        self.close()
+
+    def _run(self):
+        con = None
+        try:
+            con = sqlite3.connect(self.filename,isolation_level=None) # Manage transactions ourselves
+            cur = con.cursor()
+            cur.execute("PRAGMA journal_mode=WAL")
+            cur.execute("PRAGMA synchronous={0}".format(self.synchronous))
+            cur.execute("PRAGMA temp_store=MEMORY")
+            in_transaction = False
+            rows = 0
+            started = time.time()
+            while True:
+                timeout = max(self.flush_interval - (time.time() - started),0) if in_transaction else None
+                try:
+                    item = self.queue.get(timeout=timeout)
+                except queue_module.Empty:
+                    item = ("commit",)
+                if item[0] in ("commit","flush","close") or rows >= self.batch_rows:
+                    if in_transaction:
+                        cur.execute("COMMIT")
+                        in_transaction = False
+                        rows = 0
+                if item[0]=="flush":
+                    with self._cond:
+                        self._flush_done = max(self._flush_done,item[1])
+                        self._cond.notify_all()
+                elif item[0]=="close":
+                    break
+                elif item[0]!="commit":
+                    op, table_name, data, primary = item
+                    if not in_transaction:
+                        cur.execute("BEGIN")
+                        in_transaction = True
+                        started = time.time()
+                    self.ops[op](cur,table_name,data,primary)
+                    rows += len(data)
+        except Exception as e:
+            self.error = e
+            with self._cond:
+                self._cond.notify_all()
+        finally:
+            if con is not None:
+                if self.error is None and con.in_transaction:
+                    con.commit()
+                con.close()
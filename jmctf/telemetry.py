@@ -0,0 +1,198 @@
+"""Stage-level timing and throughput telemetry for fits and toy studies.
+
+   Instrumented functions (fit_all, fit_nuisance, optimize, Hessian,
+   quad_loglike_prep, the sqlite helpers, ...) record, per named stage, the
+   number of calls, total wall time, number of items processed (toys/events
+   or database rows), optimizer iterations, tf.function (re)traces, and peak
+   memory use. Stages nest, and times are inclusive (e.g. the 'optimize'
+   time is also counted in 'fit_nuisance').
+
+   Telemetry is disabled by default, in which case the instrumentation costs
+   only a flag check per call. Enable it with telemetry.enable(), then get
+   the results with telemetry.report() (a dictionary), or dump them with
+   telemetry.to_json(filename) / telemetry.to_csv(filename).
+
+   Peak memory is taken from TensorFlow's allocator statistics when running
+   on a GPU, and is then the peak during the (outermost) stage. On CPU, where
+   TensorFlow does not provide these, the peak resident set size of the whole
+   process so far is reported instead, which can never decrease between
+   stages; the 'peak_memory_scope' field ("stage" or "process") says which
+   of the two was recorded. It is None where neither is available.
+
+   Each thread has its own stack of running stages, so e.g. database writes
+   in a background thread are not attributed to the fits running in the
+   main thread.
+"""
+
+import csv
+import sys
+import json
+import time
+import threading
+import functools
+import contextlib
+import tensorflow as tf
+try:
+    import resource
+except ImportError: # Not available on Windows
+    resource = None
+
+enabled = False
+
+class StageStats:
+    """Accumulated statistics for one named stage"""
+
+    fields = ["stage", "calls", "wall_time", "items", "items_per_second", "iterations", "retraces", "peak_memory_bytes", "peak_memory_scope"]
+
+    def __init__(self,name):
+        self.name = name
+        self.calls = 0
+        self.wall_time = 0.
+        self.items = 0
+        self.iterations = 0
+        self.retraces = 0
+        self.peak_memory_bytes = None
+        self.peak_memory_scope = None
+
+    def as_dict(self):
+        rate = self.items / self.wall_time if self.wall_time > 0 and self.items > 0 else None
+        return {"stage": self.name, "calls": self.calls, "wall_time": self.wall_time, "items": self.items,
+                "items_per_second": rate, "iterations": self.iterations, "retraces": self.retraces,
+                "peak_memory_bytes": self.peak_memory_bytes, "peak_memory_scope": self.peak_memory_scope}
+
+stages = {}
+_lock = threading.Lock() # Guards 'stages' and the counters of the StageStats in it
+_local = threading.local()
+
+def _active():
+    """Stack of StageStats of the stages currently running in this thread"""
+    if not hasattr(_local,"active"):
+        _local.active = []
+    return _local.active
+
+def enable():
+    global enabled
+    enabled = True
+
+def disable():
+    global enabled
+    enabled = False
+
+def reset():
+    """Discard all recorded statistics"""
+    with _lock:
+        stages.clear()
+
+def get_stage(name):
+    with _lock:
+        if name not in stages:
+            stages[name] = StageStats(name)
+        return stages[name]
+
+def _gpu_device():
+    gpus = tf.config.list_logical_devices("GPU")
+    return gpus[0].name if len(gpus)>0 else None
+
+def _reset_peak_memory():
+    device = _gpu_device()
+    if device is not None:
+        tf.config.experimental.reset_memory_stats(device)
+
+def _peak_memory():
+    """Returns (peak memory in bytes, scope of the measurement)"""
+    device = _gpu_device()
+    if device is not None:
+        return tf.config.experimental.get_memory_info(device)["peak"], "stage"
+    if resource is None:
+        return None, None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return (maxrss if sys.platform=="darwin" else maxrss * 1024), "process" # kB on Linux
+
+@contextlib.contextmanager
+def stage(name,items=0):
+    """Context manager recording the wall time etc. of a block of code as one
+       call of stage 'name', processing 'items' items. Yields the StageStats
+       object (or None if telemetry is disabled)."""
+    if not enabled:
+        yield None
+        return
+    s = get_stage(name)
+    active = _active()
+    if len(active)==0:
+        _reset_peak_memory() # Nested stages share the peak of the outermost
+    active.append(s)
+    t0 = time.perf_counter()
+    try:
+        yield s
+    finally:
+        dt = time.perf_counter() - t0
+        active.pop()
+        peak, scope = _peak_memory()
+        with _lock:
+            s.wall_time += dt
+            s.calls += 1
+            s.items += int(items)
+            if peak is not None:
+                s.peak_memory_bytes = peak if s.peak_memory_bytes is None else max(peak,s.peak_memory_bytes)
+                s.peak_memory_scope = scope
+
+def timed(name,items=None):
+    """Decorator recording every call of the decorated function as stage 'name'.
+       items, if given, is a function of the call arguments (*args, **kwargs)
+       returning the number of items processed by the call."""
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args,**kwargs):
+            if not enabled:
+                return f(*args,**kwargs)
+            n = 0
+            if items is not None:
+                try:
+                    n = items(*args,**kwargs)
+                except Exception:
+                    n = 0 # Never let telemetry break the actual call
+            with stage(name,n):
+                return f(*args,**kwargs)
+        return wrapper
+    return decorator
+
+def add_iterations(n):
+    """Add optimizer iterations to all stages currently running in this thread"""
+    if enabled:
+        with _lock:
+            for s in _active():
+                s.iterations += int(n)
+
+def count_trace(name):
+    """Record a tf.function (re)trace of the function 'name'. Call from within
+       the Python body of the traced function, which only runs when tracing."""
+    if enabled:
+        t = get_stage("trace:{0}".format(name))
+        with _lock:
+            t.retraces += 1
+            for s in _active():
+                s.retraces += 1
+
+def report():
+    """Dictionary of statistics for all stages, keyed by stage name"""
+    with _lock:
+        return {name: s.as_dict() for name,s in stages.items()}
+
+def to_json(filename):
+    with open(filename,"w") as f:
+        json.dump(report(),f,indent=2)
+
+def to_csv(filename):
+    with open(filename,"w",newline="") as f:
+        writer = csv.DictWriter(f,fieldnames=StageStats.fields)
+        writer.writeheader()
+        for row in report().values():
+            writer.writerow(row)
+
+def summary():
+    """Human-readable table of all stages"""
+    lines = ["{0:<30} {1:>8} {2:>12} {3:>12} {4:>14} {5:>10} {6:>8}".format("stage","calls","time (s)","items","items/s","iters","traces")]
+    for d in report().values():
+        rate = "" if d["items_per_second"] is None else "{0:.1f}".format(d["items_per_second"])
+        lines += ["{0:<30} {1:>8} {2:>12.4f} {3:>12} {4:>14} {5:>10} {6:>8}".format(d["stage"],d["calls"],d["wall_time"],d["items"],rate,d["iterations"],d["retraces"])]
+    return "\n".join(lines)
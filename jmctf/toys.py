@@ -0,0 +1,203 @@
+"""Adaptive generation of pseudo-experiments ('toys') for p-value estimation.
+
+   Rather than choosing the number of toys up front, toys are generated in
+   batches, the p-value estimate and its confidence interval are updated after
+   each batch, and generation stops once a requested relative precision is
+   reached (or a budget of toys or time is exhausted). Small p-values need
+   many more toys than large ones to reach the same relative precision, so
+   this avoids both wasted effort on easy cases and under-sampling of hard
+   ones. Works with plain sampling from a JointDistribution or with weighted
+   samples from an importance.ImportanceSampler.
+"""
+
+import time
+import numpy as np
+import scipy.stats as sps
+from . import rng
+
+class PValueEstimate:
+    """Running estimate of the p-value Pr(t >= t_obs), updated incrementally
+       as batches of test statistic values t arrive (optionally with log
+       importance weights). t_obs may be an array, in which case p-values are
+       estimated for all elements simultaneously (broadcast against the
+       trailing dimensions of t).
+
+       For unweighted toys the confidence interval is the exact
+       Clopper-Pearson binomial interval; for weighted toys a normal
+       approximation based on the estimated standard error is used.
+
+       If keep_values is True then all test statistic values (and weights)
+       are stored so that the eCDF can be constructed afterwards.
+    """
+
+    def __init__(self,t_obs,confidence=0.68,keep_values=False):
+        self.t_obs = np.asarray(t_obs)
+        self.confidence = confidence
+        self.keep_values = keep_values
+        self.N = 0
+        self.weighted = False
+        self.k = 0 # Number of toys in the tail (unweighted)
+        self.sum_wI = 0 # Sum of weights of toys in the tail
+        self.sum_wI2 = 0 # Sum of squared weights of toys in the tail
+        self.t_values = []
+        self.logw_values = []
+
+    def update(self,t,logw=None):
+        """Add a batch of test statistic values t (first dimension is the sample
+           dimension), with optional log importance weights logw"""
+        t = np.asarray(t)
+        tail = t >= self.t_obs
+        if logw is None:
+            if self.weighted:
+                msg = "Cannot mix weighted and unweighted toys in one PValueEstimate!"
+                raise ValueError(msg)
+            w = np.ones(t.shape)
+        else:
+            if self.N>0 and not self.weighted:
+                msg = "Cannot mix weighted and unweighted toys in one PValueEstimate!"
+                raise ValueError(msg)
+            self.weighted = True
+            logw = np.broadcast_to(np.asarray(logw,dtype=np.float64),t.shape)
+            w = np.exp(logw)
+        self.N += t.shape[0]
+        self.k = self.k + np.sum(tail,axis=0)
+        self.sum_wI = self.sum_wI + np.sum(np.where(tail,w,0),axis=0)
+        self.sum_wI2 = self.sum_wI2 + np.sum(np.where(tail,w**2,0),axis=0)
+        if self.keep_values:
+            self.t_values += [t]
+            if logw is not None:
+                self.logw_values += [logw]
+
+    @property
+    def p(self):
+        """Current p-value estimate"""
+        return self.sum_wI / self.N
+
+    @property
+    def err(self):
+        """Estimated standard error of the p-value estimate"""
+        p = self.p
+        return np.sqrt(np.maximum(self.sum_wI2/self.N - p**2,0) / self.N)
+
+    def interval(self):
+        """Confidence interval (lower, upper) on the p-value, at the requested
+           confidence level"""
+        alpha = 1 - self.confidence
+        if self.weighted:
+            z = sps.norm.ppf(1 - alpha/2)
+            return np.maximum(self.p - z*self.err,0), np.minimum(self.p + z*self.err,1)
+        k = self.k
+        N = self.N
+        lower = np.where(k==0, 0., sps.beta.ppf(alpha/2, np.maximum(k,1), N-k+1))
+        upper = np.where(k==N, 1., sps.beta.ppf(1-alpha/2, k+1, np.maximum(N-k,1)))
+        return lower, upper
+
+    def rel_precision(self):
+        """Half-width of the confidence interval relative to the p-value estimate
+           (infinite if no toys have yet landed in the tail)"""
+        lower, upper = self.interval()
+        p = self.p
+        return np.where(p>0, 0.5*(upper - lower)/np.where(p>0,p,1), np.inf)
+
+    def toys_needed(self,rel_precision):
+        """Rough estimate of the total number of toys needed to reach the target
+           relative precision, based on the current estimates"""
+        z = sps.norm.ppf(1 - (1-self.confidence)/2)
+        p = self.p
+        if self.weighted:
+            # Variance per toy
+            var1 = np.maximum(self.sum_wI2/self.N - p**2,0)
+        else:
+            var1 = p*(1-p)
+        return np.where(p>0, var1 * (z/(rel_precision*np.where(p>0,p,1)))**2, np.inf)
+
+    def eCDF(self):
+        """Empirical CDF of the stored test statistic values (requires keep_values=True).
+           Returns (t_sorted, cdf), as for importance.weighted_eCDF"""
+        if not self.keep_values:
+            msg = "Test statistic values were not stored (set keep_values=True to enable eCDF construction)"
+            raise ValueError(msg)
+        t = np.concatenate(self.t_values,axis=0)
+        logw = np.concatenate(self.logw_values,axis=0) if self.weighted else np.zeros(t.shape)
+        order = np.argsort(t,axis=0)
+        t_sorted = np.take_along_axis(t,order,axis=0)
+        cdf = np.cumsum(np.take_along_axis(np.exp(logw),order,axis=0),axis=0) / self.N
+        return t_sorted, cdf
+
+def LLR_statistic(joint_null,**fit_options):
+    """Build the usual profile log-likelihood ratio test statistic,
+       -2*(log L(null, profiled nuisance) - log L(global best fit)),
+       for a JointDistribution with its parameters fixed to the null
+       hypothesis, for use with 'sequential_pvalue'. fit_options are
+       passed to both fit_nuisance and fit_all."""
+    def statistic(samples):
+        log_prob_null, jn, pn = joint_null.fit_nuisance(samples,build_joint=False,**fit_options)
+        log_prob_fit, jf, pf = joint_null.fit_all(samples,build_joint=False,**fit_options)
+        return -2*(np.asarray(log_prob_null) - np.asarray(log_prob_fit))
+    return statistic
+
+def sequential_pvalue(joint_null,test_statistic,t_obs,rel_precision=0.1,confidence=0.68,
+                      batch_size=1000,max_batch_size=100000,max_toys=1e7,max_time=None,
+                      sampler=None,keep_values=False,seed=None,verbose=False):
+    """Estimate Pr(t >= t_obs) under the distribution 'joint_null' by generating toys
+       in batches until the requested relative precision on the p-value is reached.
+
+       :param joint_null: JointDistribution (with parameters) to sample toys from
+       :param test_statistic: Function mapping a dictionary of samples to test
+               statistic values (first dimension being the sample dimension), larger
+               values being more extreme. See e.g. LLR_statistic.
+       :param t_obs: Observed value(s) of the test statistic.
+       :param rel_precision: Target half-width of the confidence interval on p, relative to p.
+               Generation stops once all p-values (if t_obs is an array) reach this.
+       :param confidence: Confidence level of the interval on p.
+       :param batch_size: Size of the first batch of toys. Subsequent batch sizes are
+               chosen based on the number of toys estimated to still be needed,
+               but no smaller than this and no larger than max_batch_size.
+       :param max_toys: Budget on the total number of toys generated.
+       :param max_time: Budget on the total time (in seconds).
+       :param sampler: Optional importance.ImportanceSampler (or any object with a
+               sample(N) method returning (samples, logw)) to generate weighted toys
+               instead of sampling directly from joint_null.
+       :param keep_values: Store test statistic values so that their eCDF can be obtained.
+       :param seed: Run seed. If given, batch i of toys is generated with the stateless
+               seed rng.chunk_seed(seed,i), making the whole run reproducible.
+
+       Returns a PValueEstimate object, with an extra attribute 'stop_reason'
+       ("precision", "max_toys" or "max_time").
+    """
+    if sampler is not None and not hasattr(sampler,"sample"):
+        msg = "'sampler' must provide a sample(N) method returning (samples, log_weights)"
+        raise ValueError(msg)
+    estimate = PValueEstimate(t_obs,confidence,keep_values)
+    start = time.time()
+    N_next = int(batch_size)
+    batch = 0
+    while True:
+        N_next = int(min(N_next, max_toys - estimate.N))
+        batch_seed = None if seed is None else rng.chunk_seed(seed,batch)
+        batch += 1
+        if sampler is None:
+            samples = joint_null.sample(N_next,seed=batch_seed)
+            logw = None
+        else:
+            samples, logw = sampler.sample(N_next,seed=batch_seed)
+            logw = np.asarray(logw)
+        estimate.update(test_statistic(samples),logw)
+        prec = np.max(estimate.rel_precision())
+        if verbose:
+            print("sequential_pvalue: N={0}, p={1}, max rel. precision={2}".format(estimate.N,estimate.p,prec))
+        if prec <= rel_precision:
+            estimate.stop_reason = "precision"
+            break
+        if estimate.N >= max_toys:
+            estimate.stop_reason = "max_toys"
+            break
+        if max_time is not None and time.time() - start >= max_time:
+            estimate.stop_reason = "max_time"
+            break
+        # Aim for the estimated remaining number of toys; double the sample if there is no estimate yet
+        needed = np.max(estimate.toys_needed(rel_precision)) - estimate.N
+        if not np.isfinite(needed):
+            needed = estimate.N
+        N_next = int(np.clip(needed, batch_size, max_batch_size))
+    return estimate
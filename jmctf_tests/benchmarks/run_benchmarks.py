@@ -0,0 +1,235 @@
+"""Performance benchmarks for JMCTF
+
+   Times the main JointDistribution operations (sample, fit_all, fit_nuisance,
+   Hessian, log_prob_quad_f) over a grid of analysis types (NormalAnalysis,
+   NormalTEAnalysis, and BinnedAnalysis with and without a covariance matrix),
+   numbers of signal regions, numbers of toys, and numbers of signal
+   hypotheses fitted to every toy. NormalAnalysis and NormalTEAnalysis only
+   have a single signal region, so are only run with n_SR=1.
+
+   For every case the first call (which includes tracing/compilation) is timed
+   separately from the best of 'repeat' further calls. Results are written as
+   JSON (together with version/platform information), and can be compared
+   against a previous run ('baseline') to find regressions.
+
+   Execute as e.g.
+     python -m jmctf_tests.benchmarks.run_benchmarks --grid quick --output baseline.json
+     python -m jmctf_tests.benchmarks.run_benchmarks --grid quick --output new.json --baseline baseline.json
+
+   Analyses and toys are generated from fixed seeds, so runs are reproducible.
+   Cases whose tensors would be too large (see --max-elements) are skipped.
+"""
+
+import sys
+import json
+import time
+import argparse
+import platform
+import datetime
+import numpy as np
+import tensorflow as tf
+import jmctf.common as c
+from jmctf import NormalAnalysis, NormalTEAnalysis, BinnedAnalysis, JointDistribution, telemetry
+
+analysis_types = ["normal", "normalte", "binned", "binned_cov"]
+operations = ["sample", "fit_all", "fit_nuisance", "Hessian", "log_prob_quad_f"]
+
+grids = {"quick": {"n_SR": [1, 10], "n_toys": [100, 1000], "n_hyp": [1, 10]},
+         "full":  {"n_SR": [1, 10, 100, 1000], "n_toys": [100, 10000, 1000000], "n_hyp": [1, 10, 100]}}
+
+def make_analysis(kind, n_SR, seed=0):
+    """Create a test analysis of type 'kind' with n_SR signal regions"""
+    rng = np.random.default_rng(seed)
+    if kind=="normal":
+        return NormalAnalysis("normal", 5., 1.)
+    elif kind=="normalte":
+        return NormalTEAnalysis("normalte", 5., 1.)
+    elif kind in ["binned", "binned_cov"]:
+        b = rng.uniform(5, 100, n_SR)
+        b_sys = 0.1*b
+        n = rng.poisson(b)
+        bins = [("SR{0}".format(i), int(n[i]), float(b[i]), float(b_sys[i])) for i in range(n_SR)]
+        if kind=="binned":
+            return BinnedAnalysis("binned", bins)
+        corr = 0.2*np.ones((n_SR, n_SR)) + 0.8*np.eye(n_SR) # Positive definite for any n_SR
+        cov = (b_sys[:,np.newaxis] * corr * b_sys[np.newaxis,:]).tolist()
+        return BinnedAnalysis("binned", bins, cov, "use SR order")
+    else:
+        msg = "Unknown analysis type '{0}' requested! Must be one of {1}".format(kind, analysis_types)
+        raise ValueError(msg)
+
+def make_hypotheses(kind, n_SR, n_hyp):
+    """Signal hypotheses for an analysis from make_analysis, with batch shape (n_hyp,).
+       The first hypothesis is the background-only ('null') hypothesis."""
+    scale = np.linspace(0, 2, n_hyp) if n_hyp>1 else np.zeros(1)
+    if kind=="normal":
+        pars = {"mu": scale}
+    elif kind=="normalte":
+        pars = {"mu": scale, "theta": np.zeros(n_hyp), "sigma_t": 0.5*np.ones(n_hyp)}
+    else:
+        s = scale[:,np.newaxis] * np.ones((1, n_SR))
+        pars = {"s": s, "theta": np.zeros((n_hyp, n_SR))}
+    return {k: tf.constant(v, dtype=c.TFdtype) for k,v in pars.items()}
+
+def n_elements(kind, n_SR, n_toys, n_hyp, op):
+    """Rough size of the largest tensors involved in an operation, used to skip
+       cases too large to run"""
+    if op=="sample":
+        return n_toys*n_SR
+    elif op in ["Hessian", "log_prob_quad_f"]:
+        return n_toys*n_hyp*(2*n_SR)**2
+    elif kind=="binned_cov":
+        return n_toys*n_hyp*n_SR**2
+    return n_toys*n_hyp*n_SR
+
+def time_call(f, repeat):
+    """Time f(): returns (duration of the first call, best duration of 'repeat'
+       further calls, result of the last call)"""
+    t0 = time.perf_counter()
+    result = f()
+    first = time.perf_counter() - t0
+    best = None
+    for i in range(repeat):
+        t0 = time.perf_counter()
+        result = f()
+        t = time.perf_counter() - t0
+        best = t if best is None else min(best, t)
+    return first, best, result
+
+def run_case(kind, n_SR, n_toys, n_hyp, ops=operations, repeat=3, max_elements=1e8, seed=0):
+    """Run the benchmarks for one case, returning a list of result dictionaries
+       (one per operation)"""
+    analysis = make_analysis(kind, n_SR, seed)
+    hyps = make_hypotheses(kind, n_SR, n_hyp)
+    null = {k: v[:1] for k,v in hyps.items()}
+    joint0 = JointDistribution([analysis], {analysis.name: null})
+    joint_hyp = JointDistribution([analysis], {analysis.name: c.deep_expand_dims(hyps, axis=0)})
+    case = {"analysis": kind, "n_SR": n_SR, "n_toys": n_toys, "n_hyp": n_hyp}
+    state = {}
+    def get_samples():
+        if "samples" not in state:
+            state["samples"] = joint0.sample(n_toys, seed=tf.constant([seed, 0], dtype=tf.int32))
+        return state["samples"]
+    def get_joint_fitted():
+        if "joint_fitted" not in state:
+            log_prob, state["joint_fitted"], pars = joint0.fit_all(get_samples())
+        return state["joint_fitted"]
+    # Inputs for each operation, prepared outside the timed region
+    inputs = {"sample": lambda: None,
+              "fit_all": get_samples,
+              "fit_nuisance": get_samples,
+              "Hessian": get_joint_fitted,
+              "log_prob_quad_f": get_joint_fitted}
+    signal = c.deep_expand_dims({analysis.name: hyps}, axis=0)
+    funcs = {"sample": lambda: joint0.sample(n_toys, seed=tf.constant([seed, 1], dtype=tf.int32)),
+             "fit_all": lambda: joint0.fit_all(state["samples"], build_joint=False),
+             "fit_nuisance": lambda: joint_hyp.fit_nuisance(state["samples"], build_joint=False),
+             "Hessian": lambda: state["joint_fitted"].Hessian(state["samples"]),
+             "log_prob_quad_f": lambda: state["joint_fitted"].log_prob_quad_f(state["samples"])(signal)}
+    results = []
+    for op in ops:
+        out = dict(case, op=op)
+        size = n_elements(kind, n_SR, n_toys, n_hyp, op)
+        if op in ["sample", "fit_all", "Hessian"] and n_hyp>1:
+            continue # These do not depend on the number of hypotheses
+        if size > max_elements:
+            out["skipped"] = "too large ({0:.2g} elements)".format(size)
+            results += [out]
+            continue
+        try:
+            inputs[op]()
+            telemetry.reset()
+            telemetry.enable()
+            first, best, result = time_call(funcs[op], repeat)
+        except Exception as e:
+            out["error"] = "{0}: {1}".format(type(e).__name__, e)
+            results += [out]
+            continue
+        finally:
+            telemetry.disable()
+        report = telemetry.report()
+        n_fits = n_toys*(n_hyp if op=="fit_nuisance" else 1)
+        out.update({"first_time": first, "time": best, "per_second": n_fits/best if best>0 else None,
+                    "iterations": report.get("optimize", {}).get("iterations", 0) / (repeat + 1), # Per call
+                    "traces": sum(s["retraces"] for k,s in report.items() if k.startswith("trace:"))})
+        results += [out]
+    return results
+
+def case_key(r):
+    return "{analysis}/n_SR={n_SR}/n_toys={n_toys}/n_hyp={n_hyp}/{op}".format(**r)
+
+def environment():
+    return {"date": datetime.datetime.now().isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "processor": platform.processor(),
+            "tensorflow": tf.__version__,
+            "numpy": np.__version__,
+            "gpus": len(tf.config.list_physical_devices("GPU"))}
+
+def run(grid, analyses=analysis_types, ops=operations, repeat=3, max_elements=1e8, seed=0, verbose=True):
+    """Run all benchmark cases in 'grid' (a dictionary of lists of n_SR, n_toys
+       and n_hyp values). Returns a dictionary with the run environment and the
+       results of each case."""
+    results = []
+    for kind in analyses:
+        for n_SR in grid["n_SR"]:
+            if kind in ["normal", "normalte"] and n_SR!=1:
+                continue
+            for n_toys in grid["n_toys"]:
+                for n_hyp in grid["n_hyp"]:
+                    for r in run_case(kind, n_SR, n_toys, n_hyp, ops, repeat, max_elements, seed):
+                        if verbose: print(format_result(r))
+                        results += [r]
+    return {"environment": environment(), "grid": grid, "repeat": repeat, "results": results}
+
+def format_result(r):
+    if "skipped" in r:
+        return "{0:<60} skipped: {1}".format(case_key(r), r["skipped"])
+    if "error" in r:
+        return "{0:<60} error: {1}".format(case_key(r), r["error"])
+    return "{0:<60} {1:10.4f}s (first {2:.4f}s)".format(case_key(r), r["time"], r["first_time"])
+
+def compare(results, baseline, tolerance=0.2):
+    """Compare results against a baseline run. Returns a list of
+       (case key, baseline time, new time) for all cases more than a fraction
+       'tolerance' slower than in the baseline."""
+    base = {case_key(r): r for r in baseline["results"] if "time" in r}
+    regressions = []
+    for r in results["results"]:
+        key = case_key(r)
+        if "time" in r and key in base and r["time"] > (1 + tolerance)*base[key]["time"]:
+            regressions += [(key, base[key]["time"], r["time"])]
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run JMCTF performance benchmarks")
+    parser.add_argument("--grid", choices=list(grids.keys()), default="quick")
+    parser.add_argument("--analyses", nargs="+", choices=analysis_types, default=analysis_types)
+    parser.add_argument("--ops", nargs="+", choices=operations, default=operations)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--max-elements", type=float, default=1e8)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="File to write JSON results to")
+    parser.add_argument("--baseline", help="JSON results of a previous run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed fractional slowdown relative to the baseline")
+    args = parser.parse_args(argv)
+
+    results = run(grids[args.grid], args.analyses, args.ops, args.repeat, args.max_elements, args.seed)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        for key, t_old, t_new in regressions:
+            print("REGRESSION: {0}: {1:.4f}s -> {2:.4f}s".format(key, t_old, t_new))
+        if len(regressions)>0:
+            return 1
+        shared = {case_key(r) for r in results["results"]} & {case_key(r) for r in baseline["results"]}
+        print("No regressions relative to baseline ({0} cases compared)".format(len(shared)))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,49 @@
+"""Compare the optimizer backends available to JointDistribution fits
+   (massminimize Adam vs batched tfp L-BFGS/BFGS), in terms of wall time
+   and iterations, for nuisance parameter fits to a correlated BinnedAnalysis
+   (which does not have exact MLE starting guesses, so always requires
+   numerical optimisation)."""
+
+import time
+import numpy as np
+import tensorflow as tf
+from jmctf import NormalAnalysis, BinnedAnalysis, JointDistribution
+
+N = int(1e4)
+
+# make_binned
+# (name, n, b, sigma_b)
+bins = [("SR1", 10, 9, 2),
+        ("SR2", 50, 55, 4),
+        ("SR3", 25, 20, 3)]
+cov = [[4, 1, 0.5],
+       [1, 16, 2],
+       [0.5, 2, 9]]
+binned = BinnedAnalysis("Test binned", bins, cov=cov, cov_order="use SR order")
+norm = NormalAnalysis("Test normal", 5, 2.)
+
+joint = JointDistribution([norm, binned], {"Test normal": {"mu": [0.]}, "Test binned": {"s": [(0.,0.,0.)]}})
+samples = joint.sample(N)
+
+results = {}
+for optimizer, options in [("Adam", None),
+                           ("LBFGS", None),
+                           ("BFGS", None),
+                           ("LBFGS", {"grad_tol": 1e-2})]:
+    label = optimizer if options is None else "{0} {1}".format(optimizer, options)
+    t0 = time.time()
+    q, joint_fitted, pars = joint.fit_nuisance(samples, optimizer=optimizer, optimizer_options=options)
+    t = time.time() - t0
+    results[label] = (q, t, joint_fitted.fit_info)
+
+q_ref = results["Adam"][0]
+for label, (q, t, fit_info) in results.items():
+    print("{0}:".format(label))
+    print("   time: {0:.2f}s".format(t))
+    for key in ["iterations", "objective_evaluations"]:
+        if key in fit_info.keys():
+            print("   {0}: {1}".format(key, fit_info[key]))
+    if "converged" in fit_info.keys():
+        print("   converged: {0} of {1}".format(np.sum(fit_info["converged"]), N))
+    print("   max(q - q_Adam): {0}".format(np.max(q - q_ref)))
+    print("   min(q - q_Adam): {0}".format(np.min(q - q_ref)))
@@ -62,3 +62,25 @@ def test_BinnedAnalysis_tensorflow_model():
     model = get_model()
     assert "n" in model.keys()
     assert "x" in model.keys() # Uncorrelated case
+
+def get_samples(N=100):
+    model = get_model()
+    samples = {k: m.sample(N) for k,m in model.items()}
+    return samples
+
+def test_BinnedAnalysis_seeds_nuis():
+    obj = get_obj()
+    samples = get_samples()
+    s = get_three_hypotheses()['s']
+    seeds = obj.get_seeds_nuis({k: tf.expand_dims(v,1) for k,v in samples.items()},{'s': s})
+    assert seeds['theta'].shape == (100,3,len(bins))
+    assert tf.math.reduce_all(tf.math.is_finite(seeds['theta']))
+
+def test_BinnedAnalysis_seeds_s_and_nuis():
+    obj = get_obj()
+    samples = get_samples()
+    seeds = obj.get_seeds_s_and_nuis(samples)
+    assert seeds['s'].shape == (100,len(bins))
+    # Best fit Poisson rates should reproduce the observed counts
+    rate = seeds['s'] + obj.SR_b + seeds['theta']
+    assert c.tf_all_equal(tf.cast(rate,c.TFdtype), samples['n'], tol=1e-2)
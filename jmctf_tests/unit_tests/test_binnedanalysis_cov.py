@@ -46,3 +46,11 @@ def test_BinnedAnalysis_cov_shape_compatibility():
     pass
 
 
+
+def test_BinnedAnalysis_cov_x_samples_order():
+    # Control measurement samples should come back in SR order, regardless of
+    # the order of the SRs in the covariance matrix
+    obj = BinnedAnalysis(name,bins,cov,["SR2","SR1"])
+    samples = {"n": tf.constant([[10.,50.]]), "x_cov": tf.constant([[2.,1.]])}
+    x = obj.get_x_samples(samples)
+    assert c.tf_all_equal(x, tf.constant([[1.,2.]]))
@@ -0,0 +1,99 @@
+"""Unit tests for BlockMatrix class"""
+
+import pytest
+import numpy as np
+import tensorflow as tf
+import jmctf.common as c
+from jmctf.block_matrix import BlockMatrix, Cholesky
+
+# Batch of 3 random symmetric positive-definite blocks, on a 5x5 matrix
+# with a permuted block structure
+batch_shape = (3,)
+block_indices = [(0,3), (1,), (2,4)]
+
+@pytest.fixture(scope="module")
+def block_matrix():
+    rng = np.random.default_rng(1234)
+    blocks = []
+    for idx in block_indices:
+        n = len(idx)
+        X = rng.normal(size=batch_shape + (n,n))
+        M = X @ np.swapaxes(X,-1,-2) + n*np.eye(n)
+        blocks += [(idx, idx, tf.constant(M,dtype=c.TFdtype))]
+    return BlockMatrix(blocks,(5,5))
+
+def test_shape(block_matrix):
+    assert block_matrix.shape == batch_shape + (5,5)
+    assert block_matrix.to_dense().shape == batch_shape + (5,5)
+
+def test_to_dense(block_matrix):
+    H = block_matrix.to_dense().numpy()
+    for i in range(5):
+        for j in range(5):
+            if not any(i in idx and j in idx for idx in block_indices):
+                assert np.all(H[...,i,j]==0)
+
+def test_sub_matrix(block_matrix):
+    rows = [4,0,1]
+    cols = [3,2]
+    sub = block_matrix.sub_matrix(rows,cols)
+    H = block_matrix.to_dense()
+    expected = tf.gather(tf.gather(H,rows,axis=-2),cols,axis=-1)
+    assert sub.shape == expected.shape
+    assert c.tf_all_equal(sub.to_dense(), expected)
+
+def test_slice_batch(block_matrix):
+    sliced = block_matrix.slice_batch(slice(1,3))
+    assert sliced.shape == (2,5,5)
+    assert c.tf_all_equal(sliced.to_dense(), block_matrix.to_dense()[1:3])
+
+def test_matvec(block_matrix):
+    x = tf.constant(np.arange(10.).reshape(2,1,5),dtype=c.TFdtype) # Extra batch dim to check broadcasting
+    expected = tf.linalg.matvec(block_matrix.to_dense(),x)
+    assert c.tf_all_equal(block_matrix.matvec(x), expected, tol=1e-5)
+
+def test_solve(block_matrix):
+    H = block_matrix.to_dense()
+    v = tf.constant(np.arange(15.).reshape(3,5),dtype=c.TFdtype)
+    assert c.tf_all_equal(block_matrix.solve(v), tf.linalg.solve(H,v[...,tf.newaxis])[...,0], tol=1e-4)
+    # Solve against an off-diagonal sub-matrix with matching block structure
+    nuis = [0,1,2]
+    interest = [3,4]
+    Hnn = block_matrix.sub_matrix(nuis,nuis)
+    Hni = block_matrix.sub_matrix(nuis,interest)
+    B = Hnn.solve(Hni)
+    expected = tf.linalg.solve(Hnn.to_dense(),Hni.to_dense())
+    assert c.tf_all_equal(B.to_dense(), expected, tol=1e-4)
+
+def test_cholesky(block_matrix):
+    factor = block_matrix.cholesky()
+    assert factor.all_ok
+    H = block_matrix.to_dense()
+    v = tf.constant(np.arange(15.).reshape(3,5),dtype=c.TFdtype)
+    assert c.tf_all_equal(factor.solvevec(v), block_matrix.solve(v), tol=1e-6)
+    assert c.tf_all_equal(factor.solvevec(v), tf.linalg.solve(H,v[...,tf.newaxis])[...,0], tol=1e-4)
+    Hni = block_matrix.sub_matrix([0,1,2,3,4],[3,1])
+    assert c.tf_all_equal(factor.solve(Hni).to_dense(), block_matrix.solve(Hni).to_dense(), tol=1e-6)
+
+def test_cholesky_fallback():
+    """Matrices that are not positive-definite should fall back to LU solves"""
+    M = tf.constant([[[2.,0.],[0.,1.]],[[1.,2.],[2.,1.]]],dtype=c.TFdtype)
+    factor = Cholesky(M)
+    assert not factor.all_ok
+    assert factor.ok.numpy().tolist() == [True, False] # Failure is per member, also on CPU
+    v = tf.constant([[1.,2.],[1.,2.]],dtype=c.TFdtype)
+    expected = tf.linalg.solve(M,v[...,tf.newaxis])[...,0]
+    assert c.tf_all_equal(factor.solvevec(v), expected, tol=1e-6)
+
+def test_cholesky_drops_matrix():
+    """The factorised matrix is only kept if it is needed for LU fallbacks"""
+    M = tf.constant([[[2.,0.],[0.,1.]],[[2.,1.],[1.,2.]]],dtype=c.TFdtype)
+    factor = Cholesky(M)
+    assert factor.all_ok and factor.M is None
+    v = tf.constant([[1.,2.],[1.,2.]],dtype=c.TFdtype)
+    assert c.tf_all_equal(factor.solvevec(v), tf.linalg.solve(M,v[...,tf.newaxis])[...,0], tol=1e-6)
+
+def test_overlapping_blocks():
+    M = tf.eye(2,dtype=c.TFdtype)
+    with pytest.raises(ValueError):
+        BlockMatrix([((0,1),(0,1),M), ((1,2),(1,2),M)],(3,3))
@@ -0,0 +1,70 @@
+"""Unit tests for columnar storage of events and results"""
+
+import pytest
+import sqlite3
+import numpy as np
+import pandas as pd
+import jmctf.sql_helpers as sql
+from jmctf.column_store import ColumnStore
+
+@pytest.fixture
+def store(tmp_path):
+    return ColumnStore(str(tmp_path / "store"))
+
+def make_df(ids,rng):
+    df = pd.DataFrame({"neg2logL": rng.normal(size=len(ids)), "mu": rng.normal(size=len(ids))}, index=pd.Index(ids, name="EventID"))
+    return df
+
+def test_append_load(store):
+    rng = np.random.default_rng(1)
+    store.append("events", {"EventID": np.arange(10), "x": rng.normal(size=(10,3))}, primary="EventID")
+    store.append("events", {"EventID": np.arange(10,25), "x": rng.normal(size=(15,3))})
+    assert store.n_rows("events") == 25
+    out = store.load("events", ["x"], keys=[3,4,12])
+    assert out["x"].shape == (3,3)
+    all_x = store.load("events", ["x"])["x"]
+    assert np.array_equal(out["x"], all_x[[3,4,12]])
+
+def test_upsert_if_smaller_matches_sqlite(store):
+    """Reductions should give the same result as the sqlite upsert_if_smaller path"""
+    rng = np.random.default_rng(2)
+    con = sqlite3.connect(":memory:")
+    cur = con.cursor()
+    sql.create_table(cur, "results", [("EventID","integer primary key"), ("neg2logL","real"), ("mu","real")])
+    # Including batches with repeated keys, both for a new table and for merges
+    for ids in [np.concatenate([np.arange(0,20), [3,3,7]]), np.arange(10,30), np.array([5,6,6,7,31,31])]:
+        df = make_df(ids, rng)
+        sql.upsert_if_smaller(cur, "results", df, "EventID")
+        store.upsert_if_smaller("results", df, "EventID")
+    rows = np.array(sql.load(cur, "results", ["EventID","neg2logL","mu"]))
+    out = store.load("results", ["EventID","neg2logL","mu"])
+    order = np.argsort(out["EventID"])
+    assert np.array_equal(out["EventID"][order], rows[:,0])
+    assert np.allclose(out["neg2logL"][order], rows[:,1])
+    assert np.allclose(out["mu"][order], rows[:,2])
+
+@pytest.mark.parametrize("op",["upsert","upsert_if_larger","upsert_if_smaller_by","upsert_if_larger_by"])
+def test_duplicate_keys_match_sqlite(store,op):
+    rng = np.random.default_rng(4)
+    cur = sqlite3.connect(":memory:").cursor()
+    sql.create_table(cur, "results", [("EventID","integer primary key"), ("neg2logL","real"), ("mu","real")])
+    args = ("neg2logL",) if op.endswith("_by") else ()
+    for ids in [np.array([0,1,2,2,1]), np.array([1,1,3,3,2,4])]:
+        df = make_df(ids, rng)
+        getattr(sql, op)(cur, "results", df, "EventID", *args)
+        getattr(store, op)("results", df, "EventID", *args)
+    rows = np.array(sql.load(cur, "results", ["EventID","neg2logL","mu"]))
+    out = store.load("results", ["EventID","neg2logL","mu"])
+    order = np.argsort(out["EventID"])
+    assert np.array_equal(out["EventID"][order], rows[:,0])
+    assert np.allclose(out["neg2logL"][order], rows[:,1])
+    assert np.allclose(out["mu"][order], rows[:,2])
+
+def test_upsert_new_column(store):
+    store.upsert("results", {"EventID": np.arange(5), "a": np.ones(5)}, "EventID")
+    store.upsert("results", {"EventID": np.arange(3,8), "b": 2*np.ones(5)}, "EventID")
+    out = store.load("results", ["EventID","a","b"])
+    order = np.argsort(out["EventID"])
+    assert np.array_equal(out["EventID"][order], np.arange(8))
+    assert np.array_equal(np.isnan(out["a"][order]), np.arange(8)>=5)
+    assert np.array_equal(np.isnan(out["b"][order]), np.arange(8)<3)
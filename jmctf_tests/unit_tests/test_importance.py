@@ -0,0 +1,60 @@
+"""Unit tests for importance sampling of JointDistribution objects"""
+
+import pytest
+import warnings
+import numpy as np
+import tensorflow as tf
+import scipy.stats as sps
+import jmctf.common as c
+from jmctf import JointDistribution
+from jmctf.normal_analysis import NormalAnalysis
+from jmctf.importance import ImportanceSampler, weighted_pvalue, weighted_eCDF, effective_sample_size
+
+sigma = 2.
+
+@pytest.fixture(scope="module")
+def joint():
+    tf.random.set_seed(1234)
+    return JointDistribution([NormalAnalysis("normal",5,sigma)], {"normal": {"mu": [0.]}})
+
+def test_effective_sample_size():
+    assert np.isclose(effective_sample_size(np.zeros(100)),100)
+    assert np.isclose(effective_sample_size(np.array([0.,-np.inf,-np.inf])),1)
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        assert effective_sample_size(np.full(3,-np.inf)) == 0
+        ess = effective_sample_size(np.array([[0.,-np.inf],[0.,-np.inf]]),axis=0)
+    assert np.allclose(ess,[2,0])
+
+def test_sample_empty(joint):
+    sampler = ImportanceSampler(joint, bias=3., seed=1)
+    for seed in [None, 5]:
+        samples, logw = sampler.sample(0, seed=seed)
+        assert samples["normal::x"].shape[0] == 0
+        assert logw.shape[0] == 0
+
+def test_tail_pvalue(joint):
+    """4 sigma tail probability should be estimated to within a few percent from a few thousand samples"""
+    sampler = ImportanceSampler(joint, bias=4., seed=1)
+    samples, logw = sampler.sample(5000)
+    assert np.all(np.isfinite(logw))
+    assert np.max(logw) <= np.log(1/sampler.defensive) + 1e-4 # Weights bounded by defensive mixture
+    t = samples["normal::x"].numpy()
+    p, err, ess = weighted_pvalue(t, logw.numpy(), 4*sigma)
+    exact = sps.norm.sf(4)
+    assert np.all(np.abs(p - exact) < 4*err)
+    assert np.all(err/exact < 0.1)
+    assert np.all(ess > 100)
+
+def test_weighted_eCDF(joint):
+    samples, logw = joint.biased_sample(2000, bias=1.)
+    t_sorted, cdf = weighted_eCDF(samples["normal::x"].numpy(), logw.numpy(), self_normalise=True)
+    assert np.isclose(cdf[-1],1)
+    assert np.all(np.diff(cdf,axis=0) >= 0)
+    assert np.abs(np.interp(0., t_sorted[:,0], cdf[:,0]) - 0.5) < 0.05
+
+def test_tune(joint):
+    sampler = ImportanceSampler(joint, seed=2)
+    best, rel_errs = sampler.tune(lambda s: s["normal::x"].numpy(), 4*sigma, biases=[0.,2.,4.], N_pilot=1000)
+    assert best > 0
+    assert sampler.bias == [best]
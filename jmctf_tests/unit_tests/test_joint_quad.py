@@ -6,6 +6,7 @@
    """
 
 import pytest
+import numpy as np
 import tensorflow as tf
 from tensorflow_probability import distributions as tfd
 import jmctf.common as c
@@ -146,3 +147,44 @@ def test_plot_quad_logl(analysis,pars,samples,curve_par,test_name):
     fig.savefig("unit_test_output/log_prob_quad_comparison_{0}.png".format(test_name))
 
     # No real assertion test here, just need to look at the plots manually.
+
+def test_log_prob_quad_tiled(analysis,pars,samples):
+    """Check that tiled (memory-bounded) evaluation of log_prob_quad matches
+       evaluating everything at once"""
+    pars_batch = c.deep_expand_dims(pars,axis=0)
+    samples_batch = c.deep_expand_dims(samples,axis=1)
+    joint = JointDistribution([analysis],pars_batch)
+    log_prob_g, joint_fitted_all, fitted_pars_all = joint.fit_all(samples_batch)
+    prep = joint_fitted_all.quad_loglike_prep(samples_batch)
+    log_prob_quad = joint_fitted_all.log_prob_quad_f(samples_batch,prep=prep)(pars_batch)
+    # Tiny memory budget, to force splitting into many tiles
+    log_prob_quad_tiled = joint_fitted_all.log_prob_quad_tiled(samples_batch,pars_batch,memory_budget=256,prep=prep)
+    assert log_prob_quad_tiled.shape == log_prob_quad.shape
+    assert c.tf_all_equal(log_prob_quad_tiled, log_prob_quad, tol=1e-4)
+
+def hypothesis_chunk(joint,pars_batch,i,j):
+    """Select hypotheses i to j (running along batch axis 1) from pars_batch"""
+    par_shapes = joint.parameter_shapes()
+    out = {}
+    for ka,a in c.convert_to_TF_constants(pars_batch).items():
+        out[ka] = {}
+        for kp,p in a.items():
+            batch_ndims = len(p.shape) - len(par_shapes[ka][kp])
+            out[ka][kp] = p[:,i:j] if batch_ndims==2 and p.shape[1]>1 else p
+    return out
+
+def test_best_fit_quad(analysis,pars,samples):
+    """Check that streaming best-fit search over chunks of hypotheses matches
+       a direct search over the full log_prob_quad output"""
+    pars_batch = c.deep_expand_dims(pars,axis=0)
+    samples_batch = c.deep_expand_dims(samples,axis=1)
+    joint = JointDistribution([analysis],pars_batch)
+    log_prob_g, joint_fitted_all, fitted_pars_all = joint.fit_all(samples_batch)
+    prep = joint_fitted_all.quad_loglike_prep(samples_batch)
+    neg2logL = -2*joint_fitted_all.log_prob_quad_f(samples_batch,prep=prep)(pars_batch).numpy()
+    neg2logL = neg2logL.reshape(neg2logL.shape[0],-1)
+    # Split hypotheses into two chunks
+    n_hyp = neg2logL.shape[-1]
+    chunks = [hypothesis_chunk(joint,pars_batch,0,n_hyp//2), hypothesis_chunk(joint,pars_batch,n_hyp//2,n_hyp)]
+    reducer = joint_fitted_all.best_fit_quad(samples_batch,chunks,prep=prep)
+    assert np.all(reducer.argmin == np.argmin(neg2logL,axis=-1))
@@ -5,6 +5,7 @@ import tensorflow as tf
 from tensorflow_probability import distributions as tfd
 import jmctf.common as c
 from jmctf import JointDistribution
+from jmctf.joint import neg2logL, get_neg2logL_engine, optimize, QuadPrep
 from jmctf_tests.analysis_class_register import get_id_list, get_obj, get_test_hypothesis, get_hypothesis_lists
 
 # Common jmctf_test fixtures needed by these tests
@@ -104,6 +105,14 @@ def test_hessian_shape(hessian,Hshape):
     Hshape1[0] = 1 # Case for no nuisance parameters, so no nuisance fits, so only single Hessian returns.
     assert H.shape == Hshape or H.shape == Hshape1
 
+def test_block_hessian(hessian,joint_fitted_nuisance,samples):
+    """Check that the block-sparse Hessian matches the dense one"""
+    H, g = hessian
+    Hb, gb = joint_fitted_nuisance.block_Hessian(samples)
+    assert Hb.shape == H.shape
+    assert c.tf_all_equal(Hb.to_dense(), H, tol=1e-5)
+    assert c.tf_all_equal(gb, g, tol=1e-5)
+
 def test_sub_hessian_shapes(decomposed_hessian,sub_hessian_shapes):
     Hii, Hnn, Hin = decomposed_hessian
     Hii_shape, Hnn_shape, Hin_shape = sub_hessian_shapes
@@ -270,6 +279,89 @@ def test_quad_prep(quad_prep,joint0,samples):
         # de-stack analytically profiled nuisance parameters
         theta_prof_dict = c.decat_tensor_to_pars(theta_prof,nuisance,par_shapes,batch_shape) 
     
+def test_neg2logL_engine(joint_fitted_nuisance,samples):
+    """Check that the compiled -2logL engine matches the original neg2logL function,
+       that repeated calls with the same input structure (but new values) do not
+       retrace, and that engines are rebuilt when an analysis is modified"""
+    pars = joint_fitted_nuisance.pars # Internal, i.e. scaled, parameters
+    const_pars = {a: {} for a in pars.keys()}
+    shifted = {k: v + 1 for k,v in samples.items()}
+    engine = get_neg2logL_engine(joint_fitted_nuisance.analyses)
+    for data in [samples, shifted]:
+        total, q, all_pars, null = neg2logL(pars,const_pars,joint_fitted_nuisance.analyses,data)
+        total_e, q_e, all_pars_e, null_e = engine(pars,const_pars,data)
+        assert c.tf_all_equal(q, q_e, tol=1e-4)
+    assert len(engine.functions) == 1
+    f = next(iter(engine.functions.values()))
+    assert f.experimental_get_tracing_count() == 1
+    assert get_neg2logL_engine(joint_fitted_nuisance.analyses) is engine
+    analysis = next(iter(joint_fitted_nuisance.analyses.values()))
+    exact_MLEs = analysis.exact_MLEs
+    analysis.exact_MLEs = not exact_MLEs # Reassigned attribute invalidates the engine
+    assert get_neg2logL_engine(joint_fitted_nuisance.analyses) is not engine
+    analysis.exact_MLEs = exact_MLEs
+
+def test_quasi_newton_fit(joint0,samples):
+    """Check that the batched L-BFGS optimizer backend finds nuisance parameter
+       fits at least as good as the default optimizer (up to tolerance)"""
+    q_adam, joint_adam, pars_adam = joint0.fit_nuisance(samples,force_numeric=True)
+    q, joint_lbfgs, pars_lbfgs = joint0.fit_nuisance(samples,force_numeric=True,optimizer="LBFGS")
+    assert joint_lbfgs.fit_info["converged"].shape == q.shape
+    assert tf.reduce_all(q <= q_adam + 1e-2)
+
+def test_active_set_fit(joint0,samples):
+    """Check that fitting with active set compaction gives the same results
+       as fitting the whole batch every iteration"""
+    q_full, joint_full, pars_full = joint0.fit_nuisance(samples,force_numeric=True,optimizer="LBFGS",optimizer_options={"active_set_it": None})
+    q, joint_active, pars_active = joint0.fit_nuisance(samples,force_numeric=True,optimizer="LBFGS",optimizer_options={"active_set_it": 2, "active_set_min_size": 0})
+    assert q.shape == q_full.shape
+    assert c.tf_all_equal(q, q_full, tol=1e-2)
+
+def test_decomposed_fit(joint0,samples):
+    """Check that fitting each analysis separately gives the same results
+       as fitting all the analyses together"""
+    q_joint, joint_joint, pars_joint = joint0.fit_nuisance(samples,force_numeric=True,optimizer_options={"decompose": False})
+    q, joint_dec, pars_dec = joint0.fit_nuisance(samples,force_numeric=True,optimizer_options={"decompose": True, "threads": 2})
+    assert q.shape == q_joint.shape
+    assert c.tf_all_equal(q, q_joint, tol=1e-2)
+
+def test_fit_profiled(joint0,samples):
+    """Check that closed-form profiled fits match the generic exact-MLE fits"""
+    if not joint0.profiled_fit_available():
+        pytest.skip("Closed-form profiled fits not available for these analyses")
+    fixed_pars = c.convert_to_TF_constants(joint0.get_pars())
+    joint, q, all_pars, fitted_pars, const_pars = joint0.fit_profiled(samples,fixed_pars,nuisance_only=True)
+    nuis_pars, all_fixed_pars = joint0.get_nuis_parameters(samples,fixed_pars)
+    joint_o, q_o, all_pars_o, fitted_pars_o, const_pars_o = optimize(nuis_pars,all_fixed_pars,joint0.analyses,samples)
+    assert c.tf_all_equal(q, q_o, tol=1e-3)
+    joint, q, all_pars, fitted_pars, const_pars = joint0.fit_profiled(samples,{},nuisance_only=False,build_joint=False)
+    free_pars, all_fixed_pars = joint0.get_all_parameters(samples)
+    joint_o, q_o, all_pars_o, fitted_pars_o, const_pars_o = optimize(free_pars,all_fixed_pars,joint0.analyses,samples)
+    assert joint is None
+    assert c.tf_all_equal(q, q_o, tol=1e-3)
+
+def test_sample_chunks(joint0):
+    """Chunks should cover all events, and be reproducible given a seed"""
+    chunks = list(joint0.sample_chunks(25,chunk_size=10,seed=3))
+    assert [len(ids) for ids,s in chunks] == [10,10,5]
+    assert list(chunks[-1][0]) == list(range(20,25))
+    chunks2 = list(joint0.sample_chunks(25,chunk_size=10,seed=3))
+    for (ids,s),(ids2,s2) in zip(chunks,chunks2):
+        for k in s.keys():
+            assert c.tf_all_equal(s[k],s2[k])
+
+def test_fit_chunks(joint0):
+    """Fitting chunk by chunk should match fitting all samples at once"""
+    chunks = list(joint0.sample_chunks(25,chunk_size=10,seed=3))
+    all_samples = {k: tf.concat([s[k] for ids,s in chunks],axis=0) for k in chunks[0][1].keys()}
+    q_all, joint_all, pars_all = joint0.fit_nuisance(all_samples)
+    q_chunks = tf.concat([q for ids,q,pars in joint0.fit_chunks(chunks,fit="nuisance")],axis=0)
+    assert c.tf_all_equal(q_chunks, q_all, tol=1e-3)
+
+def test_unknown_optimizer(joint0,samples):
+    with pytest.raises(ValueError):
+        joint0.fit_nuisance(samples,optimizer="NotAnOptimizer")
+
 def test_fitted_pars(joint_fitted_nuisance,fitted_pars):
     """Check that parameters returned from fit match those in the accompanying "fitted" distribution"""
     print("fitted_pars['all']:", fitted_pars['all'])
@@ -301,6 +393,33 @@ def test_quad_logl_nuisance(joint_fitted_nuisance,fitted_pars,quad_prep):
         print("quad_nuis_pars - nuis_pars:", c.deep_minus(quad_nuis_pars,nuis_pars))
         assert c.deep_all_equal_frac_tol(quad_nuis_pars,nuis_pars,frac_tol=frac_tol,fallback_tol=tol)
 
+def test_quad_prep_dense(joint_fitted_nuisance,fitted_pars,quad_prep,samples):
+    """Check that the dense and block-sparse quad prep give the same nuisance parameters"""
+    signal = fitted_pars["fixed"]
+    dense_prep = joint_fitted_nuisance.quad_loglike_prep(samples,block=False)
+    if quad_prep["A"] is None:
+        assert dense_prep["A"] is None
+    else:
+        quad_nuis_pars = joint_fitted_nuisance._nuisance_quad(signal,**quad_prep)
+        dense_nuis_pars = joint_fitted_nuisance._nuisance_quad(signal,**dense_prep)
+        assert c.deep_all_equal_frac_tol(quad_nuis_pars,dense_nuis_pars,frac_tol=1e-4,fallback_tol=1e-5)
+
+def test_quad_prep_save_load(joint_fitted_nuisance,fitted_pars,quad_prep,tmp_path):
+    """Check that quad prep results survive a round trip to disk"""
+    filename = tmp_path / "quad_prep.npz"
+    quad_prep.save(filename)
+    loaded = QuadPrep.load(filename)
+    assert c.deep_all_equal(loaded["interest"],quad_prep["interest"])
+    assert c.deep_all_equal(loaded["nuisance"],quad_prep["nuisance"])
+    if quad_prep["A"] is None:
+        assert loaded["A"] is None
+    else:
+        signal = fitted_pars["fixed"]
+        quad_nuis_pars = joint_fitted_nuisance._nuisance_quad(signal,**quad_prep)
+        loaded_nuis_pars = joint_fitted_nuisance._nuisance_quad(signal,**loaded)
+        assert c.deep_all_equal(quad_nuis_pars,loaded_nuis_pars)
+        assert loaded.factor.all_ok == quad_prep.factor.all_ok
+
 def test_quad_logl(joint_fitted_nuisance,fitted_log_prob,fitted_pars,quad_prep,samples):
     """Check that shapes for log_prob_quad calculation make sense, and that values match
        the true log_prob at the expansion point
@@ -0,0 +1,39 @@
+"""Unit tests for JMCTF logging"""
+
+import pytest
+from jmctf import log, NormalTEAnalysis, JointDistribution
+
+class CountStr:
+    """Object that counts how many times it is converted to a string"""
+    def __init__(self):
+        self.n = 0
+    def __str__(self):
+        self.n += 1
+        return "CountStr"
+
+@pytest.fixture
+def reset_levels():
+    yield
+    log.disable()
+    log.disable("joint")
+
+def test_disabled_is_lazy(reset_levels):
+    obj = CountStr()
+    log.get_logger("joint").debug("obj: %s", obj)
+    assert obj.n == 0
+
+def test_enable_subsystem(reset_levels, caplog):
+    log.enable("joint")
+    assert log.get_logger("joint").isEnabledFor(log.DEBUG)
+    assert not log.get_logger("common").isEnabledFor(log.DEBUG)
+    log.get_logger("joint").debug("message from %s", "joint")
+    log.get_logger("common").debug("message from %s", "common")
+    assert [r.getMessage() for r in caplog.records] == ["message from joint"]
+
+def test_no_output_by_default(capsys):
+    joint = JointDistribution([NormalTEAnalysis("normalte", 5., 1.)], {"normalte": {"mu": [0.], "theta": [0.], "sigma_t": [0.5]}})
+    samples = joint.sample(10)
+    joint.fit_nuisance(samples)
+    joint.fit_all(samples)
+    out = capsys.readouterr()
+    assert out.out == ""
@@ -0,0 +1,90 @@
+"""Unit tests for the flat parameter vector representation"""
+
+import numpy as np
+import tensorflow as tf
+import jmctf.common as c
+from jmctf import JointDistribution
+from jmctf.binned_analysis import BinnedAnalysis
+from jmctf.normal_analysis import NormalAnalysis
+from jmctf.parameters import ParameterVector, get_layout
+
+bins = [("SR1", 10, 9, 2), ("SR2", 50, 55, 4), ("SR3", 25, 20, 3)]
+analyses = {"binned": BinnedAnalysis("binned", bins), "normal": NormalAnalysis("normal", 5, 2.)}
+par_shapes = {name: a.parameter_shapes() for name,a in analyses.items()}
+
+def get_pars():
+    return {"binned": {"s": tf.constant([[1., 2., 3.], [4., 5., 6.]]), "theta": tf.zeros((1, 3))},
+            "normal": {"mu": tf.constant([0.5, 1.5])}}
+
+def test_pack_matches_cat():
+    pars = get_pars()
+    layout = get_layout(pars, par_shapes)
+    x, batch_shape = layout.pack(pars)
+    x_cat, batch_shape_cat, names = c.cat_pars_to_tensor(pars, par_shapes)
+    assert batch_shape == batch_shape_cat
+    assert np.all(x.numpy() == x_cat.numpy())
+    assert layout.column_names == names
+    unpacked = layout.unpack(x, batch_shape)
+    decat = c.decat_tensor_to_pars(x_cat, pars, par_shapes, batch_shape_cat)
+    for ka,a in decat.items():
+        for kp,p in a.items():
+            assert np.all(unpacked[ka][kp].numpy() == p.numpy())
+
+def test_layout_cached():
+    assert get_layout(get_pars(), par_shapes) is get_layout(get_pars(), par_shapes)
+    assert get_layout(get_pars(), par_shapes) is not get_layout(get_pars(), par_shapes, analyses)
+
+def test_scaling_follows_analysis():
+    # Scaled layouts must never be shared between analysis objects, even if
+    # an old object is garbage collected and its id reused
+    pars = {"n": {"mu": tf.constant([1.])}}
+    shapes = {"n": NormalAnalysis("n", 5., 1.).parameter_shapes()}
+    for sigma in [1., 2., 5., 10.]:
+        a = NormalAnalysis("n", 5., sigma)
+        layout = get_layout(pars, shapes, {"n": a})
+        expected = a.descale_pars({"mu": np.ones(())})["mu"]
+        assert np.allclose(layout.scaling.numpy(), expected)
+
+def test_scaling_matches_analyses():
+    pars = get_pars()
+    v = ParameterVector.from_dict(pars, par_shapes, analyses)
+    scaled = v.scaled().to_dict()
+    for ka,a in analyses.items():
+        expected = a.scale_pars(pars[ka])
+        for kp,p in expected.items():
+            assert np.allclose(scaled[ka][kp].numpy(), np.broadcast_to(p, scaled[ka][kp].shape))
+    assert np.allclose(v.scaled().descaled().values.numpy(), v.values.numpy())
+
+def test_merge_and_getitem():
+    pars = get_pars()
+    v = ParameterVector.from_dict(pars, par_shapes)
+    w = ParameterVector(tf.zeros_like(v.values), v.layout, v.batch_shape)
+    merged = v.merge(w, v.layout.mask({"binned": ["theta"], "normal": ["mu"]}))
+    assert np.all(merged[("binned", "s")].numpy() == pars["binned"]["s"].numpy())
+    assert np.all(merged[("normal", "mu")].numpy() == 0)
+    assert merged[("binned", "theta")].shape == (2, 3)
+
+def test_joint_layout_cache():
+    a = BinnedAnalysis("binned", bins)
+    calls = []
+    event_shapes = a.event_shapes
+    a.event_shapes = lambda: calls.append(1) or event_shapes()
+    joint = JointDistribution([a], {"binned": {"s": [[0., 0., 0.], [1., 1., 1.]]}})
+    calls.clear()
+    shapes = joint.event_shapes()
+    shapes["extra"] = (1,) # Modifying the returned dictionary must not affect the cache
+    assert joint.event_shapes() == {k: v for k,v in shapes.items() if k!="extra"}
+    assert len(calls) == 1
+    assert joint.bcast_batch_shape_tensor() == (2,)
+    pars = joint.get_pars()
+    x, batch_shape, names = c.cat_pars_to_tensor(pars, joint.parameter_shapes())
+    assert joint.column_names() == names
+    assert joint.parameter_layout().slices[("binned", "theta")] == slice(3, 6)
+
+def test_joint_layout_scaling():
+    for sigma in [1., 3.]:
+        a = NormalAnalysis("n", 5., sigma)
+        joint = JointDistribution([a], {"n": {"mu": [0.]}})
+        expected = a.descale_pars({"mu": np.ones(())})["mu"]
+        assert np.allclose(joint.parameter_layout().scaling.numpy(), expected)
+        assert np.allclose(joint._free_layout(joint.get_pars()).scaling.numpy(), expected)
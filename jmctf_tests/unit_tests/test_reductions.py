@@ -0,0 +1,98 @@
+"""Unit tests for streaming reductions over hypotheses"""
+
+import pytest
+import sqlite3
+import numpy as np
+import jmctf.sql_helpers as sql
+from jmctf.reductions import BestFitReducer, EventReductionBuffer
+from jmctf.column_store import ColumnStore
+
+n_events = 7
+n_hyp = 50
+
+@pytest.fixture(scope="module")
+def neg2logL():
+    rng = np.random.default_rng(42)
+    x = rng.normal(size=(n_events,n_hyp))
+    x[2,:] = np.nan # An event where every evaluation failed
+    x[3,5] = np.nan
+    return x
+
+def reduce_in_chunks(neg2logL,top_k,chunk=13):
+    reducer = BestFitReducer(n_events,top_k)
+    for i in range(0,n_hyp,chunk):
+        reducer.update(neg2logL[:,np.newaxis,i:i+chunk]) # Extra singleton dim should be ignored
+        reducer.next_chunk(neg2logL[:,i:i+chunk].shape[-1])
+    return reducer
+
+@pytest.mark.parametrize("top_k",[1,3])
+def test_best_fit_reducer(neg2logL,top_k):
+    reducer = reduce_in_chunks(neg2logL,top_k)
+    x = np.where(np.isnan(neg2logL),np.inf,neg2logL)
+    expected_ids = np.argsort(x,axis=-1,kind="stable")[:,:top_k]
+    good = np.arange(n_events)!=2
+    assert np.all(reducer.ids[good]==expected_ids[good])
+    assert np.allclose(reducer.neg2logL[good],np.take_along_axis(x,expected_ids,axis=-1)[good])
+    assert np.all(reducer.ids[2]==-1)
+    assert np.all(np.isinf(reducer.neg2logL[2]))
+    assert np.all(reducer.argmin[good]==expected_ids[good,0])
+
+def test_best_fit_reducer_event_slices(neg2logL):
+    reducer = BestFitReducer(n_events)
+    ids = np.arange(n_hyp) + 100
+    reducer.update(neg2logL[:4],slice(0,4),ids)
+    reducer.update(neg2logL[4:],slice(4,None),ids)
+    good = np.arange(n_events)!=2
+    assert np.all(reducer.argmin[good]==np.nanargmin(neg2logL[good],axis=-1)+100)
+
+def test_best_fit_reducer_bad_shape(neg2logL):
+    reducer = BestFitReducer(n_events)
+    with pytest.raises(ValueError):
+        reducer.update(neg2logL[:3])
+    with pytest.raises(ValueError):
+        reducer.update(neg2logL,hypothesis_ids=np.arange(3))
+
+def feed_buffer(buffer,neg2logL,chunk=13):
+    """Feed values in hypothesis chunks, for two overlapping event subsets"""
+    for i in range(0,n_hyp,chunk):
+        h = np.arange(i,min(i+chunk,n_hyp))
+        buffer.update(np.arange(0,5),neg2logL[0:5,h],h+1000,extra={"mu": 0.1*h*np.ones((5,1))})
+        buffer.update(np.arange(3,7),neg2logL[3:7,h],h+1000,extra={"mu": 0.1*h*np.ones((4,1))})
+
+@pytest.mark.parametrize("mode",["min","max"])
+def test_event_reduction_buffer(neg2logL,mode):
+    buffer = EventReductionBuffer("results",mode=mode)
+    feed_buffer(buffer,neg2logL)
+    df = buffer.to_dataframe()
+    x = np.where(np.isnan(neg2logL),np.inf if mode=="min" else -np.inf,neg2logL)
+    best = np.argmin(x,axis=-1) if mode=="min" else np.argmax(x,axis=-1)
+    good = np.arange(n_events)!=2
+    assert list(df.index) == [i for i in range(n_events) if good[i]] # All-NaN event never appears
+    assert np.all(df["hypID"].to_numpy() == best[good]+1000)
+    assert np.allclose(df["neg2logL"].to_numpy(), np.take_along_axis(x,best[:,np.newaxis],axis=-1)[good,0])
+    assert np.allclose(df["mu"].to_numpy(), 0.1*best[good])
+
+@pytest.mark.parametrize("backend",["sqlite","column_store"])
+def test_event_reduction_buffer_flush(neg2logL,backend,tmp_path):
+    """Periodic flushes should give the same final result as one flush at the end"""
+    if backend=="sqlite":
+        cur = sqlite3.connect(":memory:").cursor()
+        sql.create_table(cur,"results",[("EventID","integer primary key"),("neg2logL","real"),("hypID","integer"),("mu","real")])
+        target = cur
+        load = lambda: np.array(sql.load(cur,"results",["EventID","neg2logL","hypID","mu"]))
+    else:
+        target = ColumnStore(str(tmp_path))
+        def load():
+            out = target.load("results",["EventID","neg2logL","hypID","mu"])
+            return np.stack([out[k] for k in ["EventID","neg2logL","hypID","mu"]],axis=-1)[np.argsort(out["EventID"])]
+    buffer = EventReductionBuffer("results",target,flush_every=3)
+    feed_buffer(buffer,neg2logL)
+    buffer.close()
+    reference = EventReductionBuffer("results")
+    feed_buffer(reference,neg2logL)
+    df = reference.to_dataframe()
+    rows = load()
+    assert np.array_equal(rows[:,0], df.index.to_numpy())
+    assert np.allclose(rows[:,1], df["neg2logL"].to_numpy())
+    assert np.array_equal(rows[:,2], df["hypID"].to_numpy())
+    assert np.allclose(rows[:,3], df["mu"].to_numpy())
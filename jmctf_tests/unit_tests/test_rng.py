@@ -0,0 +1,53 @@
+"""Unit tests for stateless, counter-based seeding of toy generation"""
+
+import pytest
+import numpy as np
+import tensorflow as tf
+from jmctf import JointDistribution
+from jmctf.normal_analysis import NormalAnalysis
+from jmctf.binned_analysis import BinnedAnalysis
+from jmctf.importance import ImportanceSampler
+from jmctf import rng
+
+@pytest.fixture(scope="module")
+def joint():
+    bins = [("SR1", 10, 9, 2), ("SR2", 50, 55, 4)]
+    analyses = [NormalAnalysis("normal",5,2.), BinnedAnalysis("binned",bins)]
+    return JointDistribution(analyses, {"normal": {"mu": [0.]}, "binned": {"s": [(0.,0.)]}})
+
+def assert_samples_equal(s1,s2):
+    assert s1.keys() == s2.keys()
+    for k in s1.keys():
+        assert np.array_equal(s1[k].numpy(),s2[k].numpy())
+
+def test_chunk_seed():
+    assert np.array_equal(rng.chunk_seed(123,4), rng.chunk_seed(123,4))
+    assert np.array_equal(rng.chunk_seed(2**40,4,"stream"), rng.chunk_seed(2**40,4,"stream"))
+    seeds = [tuple(rng.chunk_seed(s,i,k).numpy()) for s in [1,2] for i in range(3) for k in [0,"x"]]
+    assert len(set(seeds)) == len(seeds)
+
+def test_shard_chunks():
+    N, chunk_size, n_shards = 1003, 100, 3
+    shards = [rng.shard_chunks(N,chunk_size,i,n_shards) for i in range(n_shards)]
+    assert sorted(sum(shards,[])) == list(range(11))
+    assert rng.shard_chunks(N,chunk_size,1,n_shards,start_chunk=5) == [7,10]
+    assert list(rng.chunk_events(N,chunk_size,10)) == [1000,1001,1002]
+
+def test_regenerate_chunk(joint):
+    """Chunks generated out of order, by shard, or one at a time, must be identical"""
+    N, chunk_size, seed = 50, 20, 99
+    tf.random.set_seed(1)
+    full = list(joint.sample_chunks(N,chunk_size,seed))
+    tf.random.set_seed(2) # Global random state must not matter
+    shard = list(joint.sample_chunks(N,chunk_size,seed,chunks=rng.shard_chunks(N,chunk_size,1,2)))
+    ids, single = joint.sample_chunk(2,chunk_size,seed,N)
+    assert [list(i) for i,s in shard] == [list(range(20,40))]
+    assert_samples_equal(shard[0][1],full[1][1])
+    assert list(ids) == list(range(40,50))
+    assert_samples_equal(single,full[2][1])
+
+def test_importance_sampler_seed(joint):
+    s1, logw1 = ImportanceSampler(joint, bias=[1.,2.]).sample(30,seed=rng.chunk_seed(5,0))
+    s2, logw2 = ImportanceSampler(joint, bias=[1.,2.]).sample(30,seed=rng.chunk_seed(5,0))
+    assert_samples_equal(s1,s2)
+    assert np.array_equal(logw1.numpy(),logw2.numpy())
@@ -0,0 +1,119 @@
+"""Unit tests for sqlite helpers and binary array serialisation"""
+
+import io
+import pytest
+import sqlite3
+import numpy as np
+import pandas as pd
+import jmctf.common as c
+import jmctf.sql_helpers as sql
+
+arrays = [np.arange(12,dtype=np.float32).reshape(3,4),
+          np.zeros((0,2),dtype=np.int64),
+          np.array(3.5),
+          np.asfortranarray(np.random.default_rng(0).normal(size=(5,7))),
+          np.array([True,False])]
+
+@pytest.mark.parametrize("arr",arrays)
+@pytest.mark.parametrize("compression",[None,"zlib","bz2","lzma"])
+def test_encode_decode(arr,compression):
+    out = c.decode_array(c.encode_array(arr,compression))
+    assert out.dtype == arr.dtype
+    assert out.shape == arr.shape
+    assert np.array_equal(out,arr)
+
+def test_decode_legacy():
+    buf = io.BytesIO()
+    np.save(buf,arrays[0])
+    assert np.array_equal(c.decode_array(buf.getvalue()),arrays[0])
+
+def test_choose_compression():
+    assert c.choose_compression(np.zeros(100000)) is not None
+    assert c.choose_compression(np.random.default_rng(1).normal(size=100000)) is None
+
+def test_insert_and_migrate():
+    con = sqlite3.connect(":memory:",detect_types=sqlite3.PARSE_DECLTYPES)
+    cur = con.cursor()
+    sql.create_table(cur,"arrays",[("x","array"),("n","array")])
+    df = pd.DataFrame({"x": np.linspace(0,1,50), "n": np.arange(50)})
+    sql.insert_as_arrays(cur,"arrays",df,compression={"n": "zlib"})
+    # A row in the old np.save format
+    legacy = [io.BytesIO(), io.BytesIO()]
+    np.save(legacy[0],df["x"].to_numpy())
+    np.save(legacy[1],df["n"].to_numpy())
+    cur.execute("INSERT INTO arrays (x,n) VALUES (?,?)",[sqlite3.Binary(b.getvalue()) for b in legacy])
+    assert sql.migrate_array_columns(cur,"arrays",["x","n"],compression="zlib") == 2
+    assert sql.migrate_array_columns(cur,"arrays",["x","n"]) == 0
+    for x,n in cur.execute("SELECT x,n from arrays").fetchall():
+        assert np.array_equal(x,df["x"].to_numpy())
+        assert np.array_equal(n,df["n"].to_numpy())
+        x[0] = -1 # Arrays loaded from the database are writable
+        n[0] = -1
+
+@pytest.fixture
+def results_table():
+    con = sqlite3.connect(":memory:")
+    cur = con.cursor()
+    sql.create_table(cur,"results",[("EventID","integer primary key"),("neg2logL","real"),("mu","real")])
+    df = pd.DataFrame({"neg2logL": np.linspace(0,1,1000), "mu": np.arange(1000.)}, index=pd.Index(np.arange(1000),name="EventID"))
+    sql.upsert(cur,"results",df,"EventID")
+    return cur
+
+def test_iter_load(results_table):
+    keys = np.concatenate([np.arange(0,100,2),np.arange(500,700)]) # Many separate ranges
+    rows = sql.load(results_table,"results",["EventID","mu"],keys,"EventID")
+    chunks = list(sql.iter_load(results_table,"results",["EventID","mu"],keys,"EventID",chunk_size=64))
+    assert all(len(ch["mu"]) <= 64 for ch in chunks)
+    eid = np.concatenate([ch["EventID"] for ch in chunks])
+    mu = np.concatenate([ch["mu"] for ch in chunks])
+    assert np.array_equal(eid, [r[0] for r in rows])
+    assert np.array_equal(np.sort(eid), keys)
+    assert np.array_equal(mu, eid.astype(float))
+
+def test_iter_load_preallocated(results_table):
+    out = np.zeros(1000,dtype=[("EventID",np.int64),("neg2logL",np.float64)])
+    n = sum(len(ch) for ch in sql.iter_load(results_table,"results",["EventID","neg2logL"],chunk_size=300,out=out))
+    assert n == 1000
+    assert np.array_equal(np.sort(out["EventID"]), np.arange(1000))
+    with pytest.raises(ValueError):
+        list(sql.iter_load(results_table,"results",["EventID"],chunk_size=300,out=np.zeros(10,dtype=[("EventID",np.int64)])))
+
+def test_sqlite_writer(tmp_path):
+    """Results submitted from several threads should all be written, with
+       upsert_if_smaller semantics preserved"""
+    import threading
+    fname = str(tmp_path / "results.db")
+    rng = np.random.default_rng(3)
+    batches = [pd.DataFrame({"neg2logL": rng.normal(size=100)}, index=pd.Index(np.arange(i*50,i*50+100),name="EventID")) for i in range(20)]
+    with sql.SQLiteWriter(fname,batch_rows=300) as writer:
+        writer.create_table("results",[("EventID","integer primary key"),("neg2logL","real")])
+        threads = [threading.Thread(target=lambda b=b: writer.upsert_if_smaller("results",b,"EventID")) for b in batches]
+        for t in threads: t.start()
+        for t in threads: t.join()
+        writer.flush()
+        n = sqlite3.connect(fname).execute("SELECT COUNT(*) from results").fetchone()[0]
+        assert n == 20*50+50
+    expected = pd.concat(batches).groupby(level=0).min()
+    cur = sqlite3.connect(fname).cursor()
+    rows = np.array(sql.load(cur,"results",["EventID","neg2logL"]))
+    assert np.array_equal(rows[:,0], expected.index.to_numpy())
+    assert np.allclose(rows[:,1], expected["neg2logL"].to_numpy())
+    assert cur.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+
+def test_sqlite_writer_arrays(tmp_path):
+    fname = str(tmp_path / "arrays.db")
+    df = pd.DataFrame({"x": np.zeros(1000), "n": np.arange(1000)})
+    with sql.SQLiteWriter(fname) as writer:
+        writer.create_table("arrays",[("x","array"),("n","array")])
+        writer.insert_as_arrays("arrays",df,compression={"x": "zlib"})
+    con = sqlite3.connect(fname,detect_types=sqlite3.PARSE_DECLTYPES)
+    x, n = con.execute("SELECT x,n from arrays").fetchone()
+    assert np.array_equal(x,df["x"].to_numpy()) and np.array_equal(n,df["n"].to_numpy())
+    raw = con.execute("SELECT length(x), length(n) from arrays").fetchone()
+    assert raw[0] < raw[1] # Only x was compressed
+
+def test_sqlite_writer_error(tmp_path):
+    writer = sql.SQLiteWriter(str(tmp_path / "results.db"))
+    writer.upsert("no_such_table",pd.DataFrame({"x": [1.]},index=pd.Index([0],name="EventID")),"EventID")
+    with pytest.raises(RuntimeError):
+        writer.close()
@@ -0,0 +1,80 @@
+"""Unit tests for stage-level timing and throughput telemetry"""
+
+import json
+import csv
+import sqlite3
+import pytest
+import threading
+import pandas as pd
+from jmctf import JointDistribution, telemetry
+from jmctf import sql_helpers as sql
+from jmctf.binned_analysis import BinnedAnalysis
+
+@pytest.fixture
+def enabled():
+    telemetry.reset()
+    telemetry.enable()
+    yield
+    telemetry.disable()
+    telemetry.reset()
+
+def test_disabled_records_nothing():
+    telemetry.reset()
+    with telemetry.stage("test") as s:
+        pass
+    assert s is None
+    assert telemetry.report() == {}
+
+def test_stage_nesting(enabled):
+    with telemetry.stage("outer", items=10):
+        with telemetry.stage("inner", items=5):
+            telemetry.add_iterations(3)
+    r = telemetry.report()
+    assert r["outer"]["calls"] == 1 and r["inner"]["calls"] == 1
+    assert r["outer"]["iterations"] == 3 and r["inner"]["iterations"] == 3
+    assert r["outer"]["wall_time"] >= r["inner"]["wall_time"]
+    assert r["outer"]["items_per_second"] > 0
+    assert r["outer"]["peak_memory_bytes"] > 0
+    assert r["outer"]["peak_memory_scope"] in ["stage", "process"]
+
+def test_threads_have_separate_stacks(enabled):
+    def worker():
+        for i in range(100):
+            with telemetry.stage("worker"):
+                telemetry.add_iterations(1)
+    with telemetry.stage("main"):
+        thread = threading.Thread(target=worker)
+        thread.start()
+        with telemetry.stage("main_inner"):
+            telemetry.add_iterations(2)
+        thread.join()
+    r = telemetry.report()
+    assert r["worker"]["calls"] == 100 and r["worker"]["iterations"] == 100
+    assert r["main"]["iterations"] == 2 and r["main_inner"]["iterations"] == 2
+
+def test_fit_telemetry(enabled, tmp_path):
+    sr = [("SR1", 10, 9, 2), ("SR2", 20, 24, 3)]
+    cov = [[4., 4.], [4., 9.]] # With a covariance matrix, so numerical fits are needed
+    joint = JointDistribution([BinnedAnalysis("binned", sr, cov, "use SR order")], {"binned": {"s": [0., 0.], "theta": [0., 0.]}})
+    samples = joint.sample(100)
+    joint.fit_nuisance(samples, {"binned": {"s": [3., -2.]}}, optimizer="LBFGS")
+    r = telemetry.report()
+    assert r["fit_nuisance"]["items"] == 100
+    assert r["optimize"]["iterations"] > 0
+    assert r["optimize"]["retraces"] > 0
+    telemetry.to_json(tmp_path / "t.json")
+    with open(tmp_path / "t.json") as f:
+        assert json.load(f)["fit_nuisance"]["calls"] == 1
+    telemetry.to_csv(tmp_path / "t.csv")
+    with open(tmp_path / "t.csv") as f:
+        assert "optimize" in [row["stage"] for row in csv.DictReader(f)]
+
+def test_sql_telemetry(enabled):
+    cur = sqlite3.connect(":memory:").cursor()
+    sql.create_table(cur, "t", [("EventID", "integer primary key"), ("x", "real")])
+    df = pd.DataFrame({"x": [1., 2., 3.]}, index=pd.Index([0, 1, 2], name="EventID"))
+    sql.upsert(cur, "t", df, "EventID")
+    sql.load(cur, "t", ["x"], [0, 1, 2], "EventID")
+    r = telemetry.report()
+    assert r["sql:upsert"]["items"] == 3
+    assert r["sql:load"]["items"] == 3
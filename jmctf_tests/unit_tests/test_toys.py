@@ -0,0 +1,53 @@
+"""Unit tests for adaptive toy generation and p-value estimation"""
+
+import pytest
+import numpy as np
+import tensorflow as tf
+import scipy.stats as sps
+from jmctf import JointDistribution
+from jmctf.normal_analysis import NormalAnalysis
+from jmctf.importance import ImportanceSampler
+from jmctf.toys import PValueEstimate, sequential_pvalue
+
+@pytest.fixture(scope="module")
+def joint():
+    tf.random.set_seed(4321)
+    return JointDistribution([NormalAnalysis("normal",5,1.)], {"normal": {"mu": [0.]}})
+
+def stat(samples):
+    return samples["normal::x"].numpy()
+
+def test_pvalue_estimate_incremental():
+    rng = np.random.default_rng(3)
+    t = rng.normal(size=(5000,1))
+    whole = PValueEstimate(1.)
+    whole.update(t)
+    parts = PValueEstimate(1.)
+    for i in range(0,5000,700):
+        parts.update(t[i:i+700])
+    assert parts.N == whole.N
+    assert np.all(parts.p == whole.p)
+    lower, upper = parts.interval()
+    assert np.all(lower < parts.p) and np.all(parts.p < upper)
+
+def test_sequential_precision(joint):
+    est = sequential_pvalue(joint, stat, 2., rel_precision=0.1, batch_size=500)
+    assert est.stop_reason == "precision"
+    assert np.all(est.rel_precision() <= 0.1)
+    lower, upper = est.interval()
+    assert np.all(np.abs(est.p - sps.norm.sf(2)) < 3*(upper - lower))
+
+def test_sequential_budget(joint):
+    est = sequential_pvalue(joint, stat, [1.,3.], rel_precision=0.01, batch_size=500, max_toys=2000, keep_values=True)
+    assert est.stop_reason == "max_toys"
+    assert est.N == 2000
+    t_sorted, cdf = est.eCDF()
+    assert t_sorted.shape == (2000,1)
+    assert np.isclose(cdf[-1],1)
+
+def test_sequential_weighted(joint):
+    sampler = ImportanceSampler(joint, bias=4., seed=5)
+    est = sequential_pvalue(joint, stat, 4., rel_precision=0.05, sampler=sampler, max_toys=1e5)
+    assert est.stop_reason == "precision"
+    assert est.N < 1e5
+    assert np.all(np.abs(est.p - sps.norm.sf(4)) < 4*est.err)